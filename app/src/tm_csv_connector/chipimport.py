@@ -0,0 +1,171 @@
+"""import trident chip log files in a background job, in chunks
+
+Each chunk of CHIPIMPORT_CHUNK_LINES lines is saved with trident2db_batch() and committed together
+with the import's progress, so a large log doesn't hold one giant transaction or the http request.
+If an import is interrupted, importing the same file for the same race resumes after the last
+committed chunk, and so can a cancelled import. Progress is retrieved with getprogress(), see 
+views.public.api.ChipImportStatusApi.
+"""
+
+# standard
+from datetime import timedelta
+from hashlib import sha1
+from os import remove
+from os.path import getsize
+from traceback import format_exception_only
+
+# pypi
+from flask import current_app
+from sqlalchemy import func, select as sqlselect
+
+# homegrown
+from .model import db, ChipImport
+from .trident import trident2db_batch
+from .jobs import jobfunction, submitjob, JobCancelled
+
+def _filedigest(filepath):
+    digest = sha1()
+    with open(filepath, 'rb') as stream:
+        for block in iter(lambda: stream.read(1024*1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def _dbnow():
+    return db.session.execute(sqlselect(func.now())).scalar()
+
+def _isstale(chipimport, now):
+    stale = timedelta(seconds=current_app.config.get('CHIPIMPORT_STALE', 60))
+    return chipimport.status == 'running' and chipimport.update_time < now - stale
+
+def startimport(raceid, filepath):
+    """start importing a chip log file in the background, or resume an interrupted import of the same file
+
+    Args:
+        raceid (int): race to import chip reads into
+        filepath (str): path of uploaded file
+
+    Returns:
+        (ChipImport, Job): import, and job running it; job is None if the import was started by an earlier request
+    """
+    digest = _filedigest(filepath)
+    now = _dbnow()
+    chipimport = db.session.execute(
+        sqlselect(ChipImport)
+        .filter_by(race_id=raceid, digest=digest)
+        .filter(ChipImport.status != 'done')
+        .order_by(ChipImport.id.desc())
+    ).scalars().first()
+
+    # already importing this file, maybe in another worker process
+    if chipimport and chipimport.status == 'running' and not _isstale(chipimport, now):
+        remove(filepath)
+        return chipimport, None
+
+    # resume from where the interrupted or failed import left off, using the new upload
+    if chipimport:
+        current_app.logger.info(f'resuming chip import {chipimport.id} at line {chipimport.lines}')
+        if chipimport.filepath != filepath:
+            try:
+                remove(chipimport.filepath)
+            except FileNotFoundError:
+                pass
+
+    else:
+        chipimport = ChipImport(race_id=raceid, digest=digest, size=getsize(filepath), position=0, lines=0)
+        db.session.add(chipimport)
+
+    chipimport.filepath = filepath
+    chipimport.status = 'running'
+    chipimport.error = None
+    chipimport.start_lines = chipimport.lines
+    chipimport.start_time = now
+    db.session.commit()
+
+    job = submitjob('chipimport', chipimport_id=chipimport.id)
+    return chipimport, job
+
+@jobfunction('chipimport')
+def _chipimport_job(job, chipimport_id):
+    try:
+        return _importchunks(job, chipimport_id, current_app.config.get('CHIPIMPORT_CHUNK_LINES', 5000))
+
+    # record why the import stopped, the job runner logs the exception
+    except Exception as e:
+        db.session.rollback()
+        chipimport = db.session.get(ChipImport, chipimport_id)
+        if isinstance(e, JobCancelled):
+            chipimport.status = 'cancelled'
+        else:
+            chipimport.status = 'failed'
+            chipimport.error = ''.join(format_exception_only(type(e), e))
+        db.session.commit()
+        raise
+
+    # delete temporary file, a resumed import uses its own upload of the same file
+    finally:
+        try:
+            remove(db.session.get(ChipImport, chipimport_id).filepath)
+        except FileNotFoundError:
+            pass
+
+def _importchunks(job, chipimport_id, chunklines):
+    chipimport = db.session.get(ChipImport, chipimport_id)
+    raceid = chipimport.race_id
+
+    with open(chipimport.filepath, 'rb') as stream:
+        stream.seek(chipimport.position)
+        lines = []
+        while True:
+            line = stream.readline()
+            if line:
+                lines.append(line.decode())
+
+            # commit this chunk's reads with the position after it, so a resumed import starts after it
+            if len(lines) >= chunklines or (lines and not line):
+                trident2db_batch(raceid, lines, 'file')
+                chipimport.position = stream.tell()
+                chipimport.lines += len(lines)
+                db.session.commit()
+                lines = []
+                job.checkcancel()
+
+            if not line:
+                break
+
+    chipimport.status = 'done'
+    db.session.commit()
+    current_app.logger.info(f'chip import {chipimport.id} done, {chipimport.lines} lines')
+    return {'lines': chipimport.lines}
+
+def getprogress(chipimport_id=None):
+    """get progress of an import
+
+    Args:
+        chipimport_id (int, optional): import id. Defaults to None, for the latest running import.
+
+    Returns:
+        dict: {'id', 'race_id', 'status', 'lines', 'percent', 'rate', 'error'}, or None if not found.
+        status is 'running', 'done', 'failed', 'cancelled', or 'interrupted'; rate is lines/sec for the current run
+    """
+    if chipimport_id:
+        chipimport = db.session.get(ChipImport, chipimport_id)
+    else:
+        chipimport = db.session.execute(
+            sqlselect(ChipImport).filter_by(status='running').order_by(ChipImport.id.desc())
+        ).scalars().first()
+    if not chipimport:
+        return None
+
+    now = _dbnow()
+    status = 'interrupted' if _isstale(chipimport, now) else chipimport.status
+    end = now if status == 'running' else chipimport.update_time
+    elapsed = (end - chipimport.start_time).total_seconds() if chipimport.start_time else 0
+    return {
+        'id': chipimport.id,
+        'race_id': chipimport.race_id,
+        'status': status,
+        'lines': chipimport.lines,
+        'percent': round(100 * chipimport.position / chipimport.size, 1) if chipimport.size else 100,
+        'rate': round((chipimport.lines - chipimport.start_lines) / elapsed) if elapsed > 0 else 0,
+        'error': chipimport.error,
+    }
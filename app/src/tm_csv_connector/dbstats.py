@@ -0,0 +1,81 @@
+"""count SQL statements issued by a view, to catch N+1 lazy loads
+
+    with countstatements('results') as counter:
+        ...
+    counter.count   # statements issued by this thread within the block
+
+The counts for each label are kept for this worker process, see getstatementstats(),
+and a warning is logged if a block issues more than DB_STATEMENT_WARN statements.
+"""
+
+# standard
+from threading import local, Lock
+from contextlib import contextmanager
+
+# pypi
+from flask import current_app
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# active counters for this thread
+_counters = local()
+
+# {label: {'count': n, 'statements_max': n, 'statements_total': n}}
+statementstats = {}
+_statementstats_lock = Lock()
+
+class StatementCounter():
+    def __init__(self):
+        self.count = 0
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _countstatement(conn, cursor, statement, parameters, context, executemany):
+    for counter in getattr(_counters, 'active', []):
+        counter.count += 1
+
+@contextmanager
+def countstatements(label=None):
+    """count the SQL statements issued by this thread within the block
+
+    Args:
+        label (str, optional): label to accumulate statistics under, and for warning. Defaults to None.
+
+    Yields:
+        StatementCounter: .count has the number of statements
+    """
+    counter = StatementCounter()
+    active = getattr(_counters, 'active', None)
+    if active is None:
+        active = _counters.active = []
+    active.append(counter)
+    try:
+        yield counter
+    finally:
+        active.remove(counter)
+        if label:
+            _recordstatementstat(label, counter.count)
+
+def _recordstatementstat(label, count):
+    with _statementstats_lock:
+        stats = statementstats.setdefault(label, {'count': 0, 'statements_max': 0, 'statements_total': 0})
+        stats['count'] += 1
+        stats['statements_total'] += count
+        stats['statements_max'] = max(stats['statements_max'], count)
+
+    warn = current_app.config.get('DB_STATEMENT_WARN', None)
+    if warn and count > warn:
+        current_app.logger.warning(f'{label}: {count} SQL statements issued, more than DB_STATEMENT_WARN={warn}')
+
+def getstatementstats():
+    """get SQL statement statistics for this worker process
+
+    Returns:
+        {label: {'count', 'statements_avg', 'statements_max'}, ...}
+    """
+    with _statementstats_lock:
+        return {label: {
+                    'count': stats['count'],
+                    'statements_avg': stats['statements_total'] / stats['count'] if stats['count'] else 0,
+                    'statements_max': stats['statements_max'],
+                }
+                for label, stats in statementstats.items()}
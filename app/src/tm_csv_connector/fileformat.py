@@ -1,20 +1,22 @@
 """results csv output file management, including transformation from database formatting
 """
 # standard
-from threading import Lock
-from os.path import join
-from shutil import copyfile
-from csv import DictWriter
+from threading import Lock, local
+from os import fsync, replace, remove, chmod, stat
+from os.path import join, exists, getsize, dirname, basename
+from tempfile import mkstemp
+from json import dumps, loads
 from threading import get_native_id
-from time import sleep
+from time import sleep, monotonic
+from math import ceil
+from functools import lru_cache
 
 # pypi
 from flask import current_app
-from loutilities.transform import Transform
-from loutilities.renderrun import rendertime
+from sqlalchemy import text
 
 # homegrown
-from .model import Setting
+from .model import db, Setting, OutputFile, Race
 
 # test_lock is true only for testing
 test_lock = False
@@ -22,8 +24,204 @@ test_lock = False
 # these names must match the message keys from tm-reader-client to the backend server
 filecolumns = ['pos', 'bibno', 'time']
 
-# provide lock for file update and multirow/multitable database manipulation
-filelock = Lock()
+class LockTimeout(Exception): pass
+
+class ThreadLockBackend(object):
+    """lock within a single process, using threading.Lock per key
+    
+    only suitable when gunicorn is run with one worker
+    
+    a key's lock is dropped when no thread holds or is waiting for it, so there isn't an entry
+    for every race and simulation run ever locked
+    """
+    def __init__(self):
+        # {key: [Lock, number of threads holding or waiting], ...}
+        self.locks = {}
+        self.guard = Lock()
+    
+    def acquire(self, key):
+        with self.guard:
+            entry = self.locks.setdefault(key, [Lock(), 0])
+            entry[1] += 1
+        try:
+            entry[0].acquire()
+        except BaseException:
+            self._done(key, entry)
+            raise
+    
+    def release(self, key):
+        entry = self.locks[key]
+        entry[0].release()
+        self._done(key, entry)
+    
+    def _done(self, key, entry):
+        with self.guard:
+            entry[1] -= 1
+            if not entry[1]:
+                del self.locks[key]
+
+class MysqlLockBackend(object):
+    """lock across processes using MySQL GET_LOCK()
+    
+    GET_LOCK() is held by the database session, so a dedicated connection is checked 
+    out of the pool for the duration of the lock, and kept per thread so the release
+    happens on the same connection
+    """
+    def __init__(self):
+        self.handles = local()
+    
+    def _name(self, key):
+        # lock names are server wide, so qualify with database name; mysql limits names to 64 characters
+        return f'{db.engine.url.database}.{key}'[-64:]
+    
+    def acquire(self, key):
+        timeout = current_app.config.get('RESULTS_LOCK_TIMEOUT', 60)
+        conn = db.engine.connect()
+        try:
+            got = conn.execute(text('SELECT GET_LOCK(:name, :timeout)'), {'name': self._name(key), 'timeout': timeout}).scalar()
+        except Exception:
+            conn.close()
+            raise
+        if got != 1:
+            conn.close()
+            raise LockTimeout(f'timed out waiting for lock {key}')
+        setattr(self.handles, key, conn)
+    
+    def release(self, key):
+        conn = getattr(self.handles, key)
+        delattr(self.handles, key)
+        try:
+            conn.execute(text('SELECT RELEASE_LOCK(:name)'), {'name': self._name(key)})
+        finally:
+            # closing the connection would release the lock anyway
+            conn.close()
+
+class FlockLockBackend(object):
+    """lock across processes using fcntl.flock() on a lock file
+    
+    lock files are kept in RESULTS_LOCK_DIR (default /output_dir), which needs to be 
+    shared by all the processes and support flock()
+    """
+    def __init__(self):
+        self.handles = local()
+    
+    def acquire(self, key):
+        # import here because fcntl is not available on all platforms
+        from fcntl import flock, LOCK_EX
+        lockdir = current_app.config.get('RESULTS_LOCK_DIR', '/output_dir')
+        f = open(join(lockdir, f'.{key}.lock'), mode='a')
+        try:
+            flock(f.fileno(), LOCK_EX)
+        except Exception:
+            f.close()
+            raise
+        setattr(self.handles, key, f)
+    
+    def release(self, key):
+        from fcntl import flock, LOCK_UN
+        f = getattr(self.handles, key)
+        delattr(self.handles, key)
+        try:
+            flock(f.fileno(), LOCK_UN)
+        finally:
+            f.close()
+
+lockbackends = {
+    'thread': ThreadLockBackend(),
+    'mysql': MysqlLockBackend(),
+    'flock': FlockLockBackend(),
+}
+
+# lock wait and hold statistics for this process, {key: {'count': n, 'wait_total': secs, 'wait_max': secs, 'hold_total': secs, 'hold_max': secs}}
+lockstats = {}
+lockstats_guard = Lock()
+
+def _recordlockstat(key, stat, secs):
+    with lockstats_guard:
+        keystats = lockstats.setdefault(key, {'count': 0, 'wait_total': 0.0, 'wait_max': 0.0, 'hold_total': 0.0, 'hold_max': 0.0})
+        if stat == 'wait':
+            keystats['count'] += 1
+        keystats[f'{stat}_total'] += secs
+        keystats[f'{stat}_max'] = max(keystats[f'{stat}_max'], secs)
+
+def getlockstats():
+    """return lock statistics for this process
+
+    Returns:
+        dict: {key: {'count': n, 'wait_avg': secs, 'wait_max': secs, 'hold_avg': secs, 'hold_max': secs}, ...}
+    """
+    with lockstats_guard:
+        return {key: {
+                    'count': keystats['count'],
+                    'wait_avg': keystats['wait_total'] / keystats['count'],
+                    'wait_max': keystats['wait_max'],
+                    'hold_avg': keystats['hold_total'] / keystats['count'],
+                    'hold_max': keystats['hold_max'],
+                }
+                for key, keystats in lockstats.items()}
+
+class ResultsLock(object):
+    """lock identified by key, using the backend configured by RESULTS_LOCK_BACKEND
+    ('thread', 'mysql', or 'flock')
+    
+    wait and hold times are recorded per key, see getlockstats()
+    
+    Args:
+        key (str): name of lock
+    """
+    def __init__(self, key):
+        self.key = key
+        self.timing = local()
+    
+    def __repr__(self):
+        return f'<ResultsLock {self.key}>'
+    
+    def _backend(self):
+        return lockbackends[current_app.config.get('RESULTS_LOCK_BACKEND', 'thread')]
+    
+    def acquire(self):
+        requested = monotonic()
+        self._backend().acquire(self.key)
+        self.timing.acquired = monotonic()
+        
+        waited = self.timing.acquired - requested
+        _recordlockstat(self.key, 'wait', waited)
+        if waited > current_app.config.get('RESULTS_LOCK_WARN', 1.0):
+            current_app.logger.warning(f'waited {waited:.3f} seconds for {self}')
+    
+    def release(self):
+        self._backend().release(self.key)
+        _recordlockstat(self.key, 'hold', monotonic() - self.timing.acquired)
+        self.timing.acquired = None
+    
+    def held(self):
+        """return True if this thread holds the lock, e.g., to decide whether to release it after an exception"""
+        return getattr(self.timing, 'acquired', None) is not None
+
+# provide lock for file update and multirow/multitable database manipulation, when 
+# there is no race or simulation run context. see resultslock()
+filelock = ResultsLock('results')
+
+# the output file is shared by all races and simulation runs, so writes are serialized
+# separately. this is always acquired while holding the race or simulation run lock
+outputfilelock = ResultsLock('outputfile')
+
+def resultslock(race_id=None, simulationrun_id=None):
+    """return lock for results and scanned bibs of a race or simulation run, so
+    independent races and simulation runs don't serialize on each other
+    
+    Args:
+        race_id (int, optional): race id. Defaults to None.
+        simulationrun_id (int, optional): simulation run id. Defaults to None.
+
+    Returns:
+        ResultsLock: lock for use with lock(), unlock()
+    """
+    if simulationrun_id:
+        return ResultsLock(f'simulationrun-{simulationrun_id}')
+    if race_id:
+        return ResultsLock(f'race-{race_id}')
+    return filelock
 
 # lock/unlock functions
 def lock(thelock):
@@ -45,94 +243,342 @@ def unlock(thelock):
 def fulltime(timesecs):
     """convert seconds to hh:mm:ss.dd
 
+    rounds up to the next hundredth, same as loutilities.renderrun.rendertime()
+
     Args:
-        r (_type_): result in seconds
+        timesecs (float): result in seconds
 
     Returns:
         string: hh:mm:ss.dd
     """
-    thetime = rendertime(timesecs, 2)
-    timesplit = thetime.split(':')
-    
-    # make sure hours, minutes, seconds
-    while len(timesplit) < 3:
-        timesplit = ['0'] + timesplit
-    
-    for i in range(0,2):
-        timesplit[i] = f'{int(timesplit[i]):02d}'
-    timesplit[2] = f'{float(timesplit[2]):05.2f}'
+    hundredths = ceil(timesecs * 100)
+    seconds, hundredths = divmod(hundredths, 100)
+    minutes, seconds = divmod(seconds, 60)
+    hours, minutes = divmod(minutes, 60)
+    return f'{hours:02d}:{minutes:02d}:{seconds:02d}.{hundredths:02d}'
 
-    return ':'.join(timesplit)
-    
+def fulltimes(timesecs, offset=0):
+    """convert a column of seconds to hh:mm:ss.dd in one pass
 
-def db2file(result):
-    """convert database result (elapsed time) to file dict (time of day)
-    
     Args:
-        result (model.Result): result as received from time machine (elapsed time)
+        timesecs ([float, ...]): results in seconds
+        offset (float, optional): offset to add to each time, e.g., race start time. Defaults to 0.
+
+    Returns:
+        [string, ...]: hh:mm:ss.dd for each time
+    """
+    formatted = []
+    append = formatted.append
+    for t in timesecs:
+        seconds, hundredths = divmod(ceil((t + offset) * 100), 100)
+        minutes, seconds = divmod(seconds, 60)
+        hours, minutes = divmod(minutes, 60)
+        append(f'{hours:02d}:{minutes:02d}:{seconds:02d}.{hundredths:02d}')
+    return formatted
+
+def _tod_offset(result):
+    """get time of day offset for result
+
+    Args:
+        result (model.Result or Row): result as received from time machine (elapsed time), 
+            needs race_id
 
     Returns:
-        dict: result row for file, with time as time of day, see db2filet Transform
+        float: race start time in seconds since midnight, or 0 for simulation result
     """
     # if the result has a race, this is a normal result
-    if result.race:
-        tod_offset = result.race.start_time
+    # session.get() uses the identity map, so the race is only retrieved once
+    if result.race_id:
+        return db.session.get(Race, result.race_id).start_time
     
     # if no race, this is a simulation result
     else:
-        tod_offset = 0
+        return 0
+
+def db2file(result, start_time=None):
+    """convert database result (elapsed time) to file dict (time of day)
     
-    transform = {
-        'pos': 'tmpos',
-        'time': lambda r: fulltime(r.time + tod_offset),
-        'bibno': 'bibno'
+    Args:
+        result (model.Result): result as received from time machine (elapsed time)
+        start_time (float, optional): time of day offset, if already known by caller. 
+            Defaults to None, meaning retrieve from result's race.
+
+    Returns:
+        dict: result row for file, with time as time of day, keys are filecolumns
+    """
+    tod_offset = start_time if start_time is not None else _tod_offset(result)
+    return {
+        'pos': result.tmpos,
+        'bibno': result.bibno,
+        'time': fulltime(result.time + tod_offset),
     }
 
-    db2filet = Transform(transform, sourceattr=True, targetattr=False)
+def _csvfield(value):
+    """format value as csv field, quoting as csv.QUOTE_MINIMAL would
+
+    Args:
+        value (any): value to format
+
+    Returns:
+        str: csv field
+    """
+    if value is None:
+        return ''
+    value = str(value)
+    if ',' in value or '"' in value or '\r' in value or '\n' in value:
+        return '"' + value.replace('"', '""') + '"'
+    return value
+
+@lru_cache(maxsize=32)
+def rowformatter(tod_offset):
+    """return formatter for csv output file rows, built once for each race start time
+
+    Args:
+        tod_offset (float): time of day offset, race start time or 0 for simulation
+
+    Returns:
+        function(rows) returning [bytes, ...], csv line for each row
+    """
+    def formatrows(rows):
+        times = fulltimes([row.time for row in rows], tod_offset)
+        return [f'{_csvfield(row.tmpos)},{_csvfield(row.bibno)},{t}\r\n'.encode() 
+                for row, t in zip(rows, times)]
+    
+    return formatrows
+
+def _outputfile():
+    """get output file name and path from settings
+
+    Returns:
+        (filename, filepath), or (None, None) if output-file setting is not configured
+    """
+    filesetting = Setting.query.filter_by(name='output-file').one_or_none()
+    if not filesetting:
+        return None, None
+    return filesetting.value, join('/output_dir', filesetting.value)
+
+def _outputstate():
+    """get the persistent record of what's in the output file, creating if needed
+    
+    the row is locked until the caller commits, so other workers see a consistent state
+
+    Returns:
+        OutputFile: output file state
+    """
+    state = OutputFile.query.populate_existing().with_for_update().order_by(OutputFile.id).first()
+    if not state:
+        state = OutputFile(rowcount=None)
+        db.session.add(state)
+    return state
+
+def _statevalid(state, filename, filepath, source):
+    """check the state matches the file on disk, for this race or simulation run
+
+    Args:
+        state (OutputFile): output file state
+        filename (str): output file name
+        filepath (str): output file path
+        source (tuple): (race_id, simulationrun_id)
+
+    Returns:
+        bool: True if the state can be used for incremental update
+    """
+    if state.filename != filename or state.rowcount is None:
+        return False
+    # an empty file can be used by any race or simulation run
+    if state.rowcount and (state.race_id, state.simulationrun_id) != source:
+        return False
+    # size check catches if file was changed outside of this application
+    return exists(filepath) and getsize(filepath) == state.byteoffset
+
+def _rowlines(rows):
+    """format rows as csv lines for the output file; lines match csv.DictWriter with filecolumns
+
+    Args:
+        rows ([Result, ...]): rows to format, all from the same race or simulation run; Row
+            objects with race_id, tmpos, bibno, time can be used to avoid loading Results
+
+    Returns:
+        [bytes, ...]: csv line for each row
+    """
+    if not rows:
+        return []
+    return rowformatter(_tod_offset(rows[0]))(rows)
+
+def _syncfile(f):
+    """flush file to disk if configured by OUTPUT_FILE_FSYNC
 
-    resultrow = {}
-    db2filet.transform(result, resultrow)
+    Args:
+        f (file): open file
+    """
+    if current_app.config.get('OUTPUT_FILE_FSYNC', False):
+        f.flush()
+        fsync(f.fileno())
+
+def _replacefile(filepath, lines):
+    """replace file atomically, by writing a temporary file in the same directory and
+    renaming it over the file, so readers never see a partially written file
+
+    Args:
+        filepath (str): output file path
+        lines ([bytes, ...]): file contents
 
-    return resultrow
+    Raises:
+        OSError: if the file can't be replaced, e.g., some bind mounts don't support rename 
+            over a file which is open by another program
+    """
+    # temporary file is created with owner only permissions, so use the file's permissions
+    mode = stat(filepath).st_mode & 0o777 if exists(filepath) else 0o644
+    fd, tmppath = mkstemp(dir=dirname(filepath), prefix=f'.{basename(filepath)}.', suffix='.tmp')
+    try:
+        with open(fd, mode='wb') as f:
+            f.write(b''.join(lines))
+            f.flush()
+            fsync(f.fileno())
+        chmod(tmppath, mode)
+        replace(tmppath, filepath)
+    except OSError:
+        if exists(tmppath):
+            remove(tmppath)
+        raise
+
+def _writerows(state, filepath, start, rows):
+    """truncate the file after row index start, then write rows, updating state
+    
+    if the whole file is being written and OUTPUT_FILE_REPLACE is configured (default), 
+    the file is replaced atomically
+    
+    NOTE: caller must acquire/release outputfilelock
+
+    Args:
+        state (OutputFile): output file state, valid for this file
+        filepath (str): output file path
+        start (int): index of first row to write
+        rows ([Result, ...]): rows to write, starting at start
+    """
+    offsets = loads(state.rowoffsets) if start else []
+    offset = offsets[start] if start < len(offsets) else (state.byteoffset if start else 0)
+    offsets = offsets[:start]
+    lines = _rowlines(rows)
+    
+    replaced = False
+    if start == 0 and current_app.config.get('OUTPUT_FILE_REPLACE', True):
+        try:
+            _replacefile(filepath, lines)
+            replaced = True
+        except OSError as e:
+            current_app.logger.warning(f'could not replace {filepath}, rewriting in place: {e}')
+    
+    # append mode always writes at the end of file, which is offset after truncate
+    if not replaced:
+        with open(filepath, mode='ab') as f:
+            f.truncate(offset)
+            f.write(b''.join(lines))
+            _syncfile(f)
+    
+    for line in lines:
+        offsets.append(offset)
+        offset += len(line)
+    
+    state.rowcount = len(offsets)
+    state.byteoffset = offset
+    state.rowoffsets = dumps(offsets)
 
 def clearfile():
     """truncate the csv output file to empty
 
-    NOTE: caller must acquire/release filelock
+    NOTE: caller must acquire/release resultslock(), and commit
     """
-    filesetting = Setting.query.filter_by(name='output-file').one_or_none()
-    if filesetting:
-        filepath = join('/output_dir', filesetting.value)
-        open(filepath, mode='w').close()
+    filename, filepath = _outputfile()
+    if filename:
+        lock(outputfilelock)
+        try:
+            open(filepath, mode='w').close()
+            
+            state = _outputstate()
+            state.filename = filename
+            state.race_id = state.simulationrun_id = None
+            state.rowcount = state.byteoffset = 0
+            state.rowoffsets = dumps([])
+            db.session.flush()
+        finally:
+            unlock(outputfilelock)
 
-def refreshfile(rows):
-    """rewrite csv file
+def appendrows(rows):
+    """append newly confirmed rows to the csv file
     
-    NOTE: caller must acquire/release filelock
+    NOTE: caller must acquire/release resultslock(), and commit
 
     Args:
-        rows ([Result, ...]): list of Result rows to write, in place order
+        rows ([Result, ...]): list of Result rows to append, in place order; Row objects with 
+            race_id, simulationrun_id, tmpos, bibno, time can be used, see views.common.confirm_results()
     """
-    filesetting = Setting.query.filter_by(name='output-file').one_or_none()
-    if filesetting:
-        filepath = join('/output_dir', filesetting.value)
-        
-        # create temporary file
-        from tempfile import TemporaryDirectory
-        fdir = TemporaryDirectory()
-        tmpfname = join(fdir.name, filesetting.value)
-        with open(tmpfname, mode='w') as f:
-            csvf = DictWriter(f, fieldnames=filecolumns, extrasaction='ignore')
+    filename, filepath = _outputfile()
+    if filename and rows:
+        source = (rows[0].race_id, rows[0].simulationrun_id)
+        lock(outputfilelock)
+        try:
+            state = _outputstate()
             for row in rows:
-                # this assumes when an unconfirmed row is encountered, no more rows should be sent to the file
-                if not row.is_confirmed: break
-                
-                # write confirmed rows to the file
-                rowdict = db2file(row)
-                csvf.writerow(rowdict)
-
-        # overwrite file
-        current_app.logger.debug(f'overwriting {filesetting.value}')
-        copyfile(tmpfname, filepath)
-        fdir.cleanup()
+                current_app.logger.debug(f'appending to {filename}: {row.tmpos, row.bibno, row.time}')
+            
+            if _statevalid(state, filename, filepath, source):
+                _writerows(state, filepath, state.rowcount, rows)
+                state.race_id, state.simulationrun_id = source
+            
+            # don't know what's in the file, so just append and the next refreshfile() will rewrite
+            else:
+                with open(filepath, mode='ab') as f:
+                    f.write(b''.join(_rowlines(rows)))
+                    _syncfile(f)
+                state.rowcount = None
+            db.session.flush()
+        finally:
+            unlock(outputfilelock)
+
+def refreshfile(rows, fromplace=None):
+    """update csv file to hold the confirmed rows
+    
+    if the persistent record of the file shows it holds the confirmed rows for this race or 
+    simulation run, only rows starting at fromplace, and new rows at the end, are rewritten. 
+    Otherwise the whole file is rewritten
+    
+    NOTE: caller must acquire/release resultslock(), and commit
+
+    Args:
+        rows ([Result, ...]): list of Result rows to write, in place order
+        fromplace (int, optional): place of first row which may have changed. Defaults to None,
+            meaning only new rows are written.
+    """
+    filename, filepath = _outputfile()
+    if filename:
+        # this assumes when an unconfirmed row is encountered, no more rows should be sent to the file
+        confirmed = []
+        for row in rows:
+            if not row.is_confirmed: break
+            confirmed.append(row)
+        source = (confirmed[0].race_id, confirmed[0].simulationrun_id) if confirmed else (None, None)
+
+        lock(outputfilelock)
+        try:
+            state = _outputstate()
+            
+            # only write from the first changed row
+            if _statevalid(state, filename, filepath, source):
+                start = min(state.rowcount, len(confirmed))
+                if fromplace is not None:
+                    start = min(start, max(fromplace-1, 0))
+                current_app.logger.debug(f'updating {filename} from row {start+1}')
+            
+            # rewrite the whole file
+            else:
+                current_app.logger.debug(f'overwriting {filename}')
+                state.filename = filename
+                state.rowcount = 0
+                start = 0
             
+            _writerows(state, filepath, start, confirmed[start:])
+            state.race_id, state.simulationrun_id = source
+            db.session.flush()
+        finally:
+            unlock(outputfilelock)
@@ -0,0 +1,221 @@
+"""run long imports and scoring in the background, so they don't tie up a request thread
+
+    @jobfunction('chip2bib')
+    def chip2bib_job(job, race_id, filepath):
+        ...
+        job.checkcancel()   # raises JobCancelled if cancel was requested
+        ...
+        return {...}        # json serializable result
+
+    job = submitjob('chip2bib', race_id=race_id, filepath=filepath)
+
+Jobs are kept in the Job table, so their status can be retrieved from any worker process, and
+are run by a pool of JOBS_WORKERS threads in the process which submitted them. The job function
+runs in its own app context and session. The runner commits after the job function returns, and
+rolls back if it raises.
+
+The Job row is updated using a separate connection, so status changes and cancel requests are
+visible while the job's own transaction is still open.
+
+While a process has queued or running jobs, it updates their heartbeat every JOBS_HEARTBEAT seconds.
+If the process exits, e.g., gunicorn restarts or recycles the worker, its jobs stop getting 
+heartbeats, and getjob() marks them failed once they've had none for JOBS_STALE seconds.
+
+NOTE: job functions must be registered when the application starts, i.e., in a module which is
+imported by the application
+"""
+
+# standard
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock, Thread
+from time import sleep
+from datetime import timedelta
+from json import dumps, loads
+from traceback import format_exception_only, format_exc
+
+# pypi
+from flask import current_app
+from sqlalchemy import update, func, select as sqlselect
+
+# homegrown
+from .model import db, Job
+
+class JobCancelled(Exception): pass
+
+# {kind: function, ...}
+_jobfunctions = {}
+
+def jobfunction(kind):
+    """decorator to register a job function, called as function(job, **params)
+
+    Args:
+        kind (str): kind of job, used in submitjob()
+    """
+    def register(function):
+        _jobfunctions[kind] = function
+        return function
+    return register
+
+class JobContext():
+    """passed to the job function
+
+    Args:
+        job_id (int): Job id
+    """
+    def __init__(self, job_id):
+        self.id = job_id
+
+    def checkcancel(self):
+        """raise JobCancelled if the job has been cancelled
+
+        Raises:
+            JobCancelled: job was cancelled
+        """
+        with db.engine.connect() as conn:
+            if conn.execute(sqlselect(Job.cancel_requested).where(Job.id == self.id)).scalar():
+                raise JobCancelled
+
+# one pool per worker process, created on first use
+_executor = None
+_executor_lock = Lock()
+
+# {job_id: future, ...} for jobs queued or running in this process
+_futures = {}
+_futures_lock = Lock()
+
+def _getexecutor():
+    global _executor
+    with _executor_lock:
+        if not _executor:
+            _executor = ThreadPoolExecutor(max_workers=current_app.config.get('JOBS_WORKERS', 2),
+                                           thread_name_prefix='job')
+            Thread(target=_heartbeat, args=(current_app._get_current_object(),), name='job-heartbeat', daemon=True).start()
+    return _executor
+
+def _heartbeat(app):
+    """update the heartbeat of this process's queued and running jobs, forever"""
+    with app.app_context():
+        interval = app.config.get('JOBS_HEARTBEAT', 10)
+        while True:
+            sleep(interval)
+            with _futures_lock:
+                job_ids = list(_futures)
+            if not job_ids:
+                continue
+            try:
+                with db.engine.begin() as conn:
+                    conn.execute(update(Job).where(Job.id.in_(job_ids)).values(heartbeat_time=func.now()))
+            except Exception:
+                # try again next time, if the database stays unavailable the jobs will be seen as stale
+                app.logger.error(format_exc())
+
+def _updatejob(job_id, **values):
+    with db.engine.begin() as conn:
+        conn.execute(update(Job).where(Job.id == job_id).values(**values))
+
+def submitjob(kind, **params):
+    """submit a job to run in the background
+
+    Args:
+        kind (str): kind of job, see jobfunction()
+        params: json serializable parameters for the job function
+
+    Returns:
+        Job: submitted job; the caller's session is committed
+    """
+    if kind not in _jobfunctions:
+        raise ValueError(f'unknown job kind {kind}')
+
+    job = Job(kind=kind, params=dumps(params), status='queued', cancel_requested=False, heartbeat_time=func.now())
+    db.session.add(job)
+    db.session.commit()
+
+    with _futures_lock:
+        _futures[job.id] = _getexecutor().submit(_runjob, current_app._get_current_object(), job.id)
+    return job
+
+def _runjob(app, job_id):
+    with app.app_context():
+        try:
+            with db.engine.connect() as conn:
+                job = conn.execute(sqlselect(Job.kind, Job.params, Job.cancel_requested).where(Job.id == job_id)).one()
+            if job.cancel_requested:
+                raise JobCancelled
+
+            _updatejob(job_id, status='running', start_time=func.now())
+            result = _jobfunctions[job.kind](JobContext(job_id), **loads(job.params))
+            db.session.commit()
+            _updatejob(job_id, status='done', result=dumps(result), end_time=func.now())
+
+        except JobCancelled:
+            db.session.rollback()
+            _updatejob(job_id, status='cancelled', end_time=func.now())
+            current_app.logger.info(f'job {job_id} cancelled')
+
+        except Exception as e:
+            db.session.rollback()
+            _updatejob(job_id, status='failed', error=''.join(format_exception_only(type(e), e)), end_time=func.now())
+            current_app.logger.error(format_exc())
+
+        finally:
+            db.session.remove()
+            with _futures_lock:
+                _futures.pop(job_id, None)
+
+def getjob(job_id):
+    """get status of a job
+
+    Args:
+        job_id (int): Job id
+
+    Returns:
+        dict: {'id', 'kind', 'status', 'result', 'error'}, or None if not found
+    """
+    job = db.session.get(Job, job_id)
+    if not job:
+        return None
+    
+    # process running the job exited
+    if job.status in ['queued', 'running']:
+        now = db.session.execute(sqlselect(func.now())).scalar()
+        stale = timedelta(seconds=current_app.config.get('JOBS_STALE', 60))
+        if job.heartbeat_time and job.heartbeat_time < now - stale:
+            current_app.logger.error(f'job {job_id} has no heartbeat since {job.heartbeat_time}, marking failed')
+            job.status = 'failed'
+            job.error = 'interrupted, the process running the job exited'
+            job.end_time = now
+            db.session.commit()
+    return {
+        'id': job.id,
+        'kind': job.kind,
+        'status': job.status,
+        'result': loads(job.result) if job.result else None,
+        'error': job.error,
+    }
+
+def canceljob(job_id):
+    """request that a job be cancelled. A queued job is cancelled immediately, a running job
+    is cancelled when the job function next calls job.checkcancel()
+
+    Args:
+        job_id (int): Job id
+
+    Returns:
+        bool: False if the job was already finished
+    """
+    with db.engine.begin() as conn:
+        cancelled = conn.execute(
+            update(Job)
+            .where(Job.id == job_id, Job.status.in_(['queued', 'running']))
+            .values(cancel_requested=True)
+        ).rowcount
+
+    # don't wait for a thread if it hasn't started yet in this process
+    with _futures_lock:
+        future = _futures.get(job_id, None)
+    if future and future.cancel():
+        with _futures_lock:
+            _futures.pop(job_id, None)
+        _updatejob(job_id, status='cancelled', end_time=func.now())
+
+    return bool(cancelled)
@@ -51,6 +51,10 @@ class User(Base, fsqla.FsUserMixin):
 
 class ScannedBib(Base):
     __tablename__ = 'scannedbib'
+    __table_args__ = (
+        Index('ix_scannedbib_race_order', 'race_id', 'order'),
+        Index('ix_scannedbib_simrun_order', 'simulationrun_id', 'order'),
+    )
     id           = Column(Integer(), primary_key=True)
     # has race_id or simrun_id, but not both
     race_id      = mapped_column(ForeignKey('race.id'))
@@ -58,7 +62,8 @@ class ScannedBib(Base):
     simulationrun_id = mapped_column(ForeignKey('simulationrun.id'))
     simulationrun    = relationship('SimulationRun', back_populates='scannedbibs', foreign_keys=[simulationrun_id])
 
-    order        = Column(Integer)
+    # has gaps, so a scanned bib can be inserted between two others without renumbering
+    order        = Column(Double)
     bibno        = Column(Text)
     result       = relationship("Result", uselist=False, back_populates="scannedbib")
     
@@ -85,16 +90,47 @@ class ChipRead(Base):
                          )
 
     # lookups by date/tag and date/tag/time need to be fast
-    __tableargs__ = (
+    # a read is unique by race/reader/date/tag/time, see trident.trident2db_batch()
+    __table_args__ = (
         Index('rdr_date_tag_idx', reader_id, date, tag_id),
         Index('rdr_date_bib_idx', reader_id, date, bib),
         Index('rdr_date_tag_time_idx', reader_id, date, tag_id, time),
+        UniqueConstraint(race_id, reader_id, date, tag_id, time, name='uq_chipread_read'),
     )
 
     @hybrid_property
     def display_date(self):
         return func.date_format(self.date, '%Y-%m-%d')
     
+
+class ChipImport(Base):
+    """progress of a chip log file import, see chipimport.py"""
+    __tablename__ = 'chipimport'
+    __table_args__ = (
+        Index('ix_chipimport_race_digest', 'race_id', 'digest'),
+    )
+    id          = Column(Integer(), primary_key=True)
+    # not a foreign key, the race may be deleted
+    race_id     = Column(Integer)
+    # identifies the file contents, so an interrupted import can be resumed from a new upload
+    digest      = Column(String(40))
+    filepath    = Column(String(256))
+    size        = Column(Integer)
+    # bytes and lines committed so far
+    position    = Column(Integer, default=0)
+    lines       = Column(Integer, default=0)
+    # lines committed before this run started, and when it started, for lines/sec
+    start_lines = Column(Integer, default=0)
+    start_time  = Column(DateTime)
+    status      = Column(String(16))  # running, done, failed, cancelled
+    error       = Column(Text)
+
+    # track last update - https://docs.sqlalchemy.org/en/20/dialects/mysql.html#mysql-timestamp-onupdate
+    update_time = Column(DateTime,
+                         server_default=text("CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP"),
+                         server_onupdate=FetchedValue()
+                         )
+
 class ChipBib(Base):
     __tablename__ = 'chipbib'
     id          = Column(Integer(), primary_key=True)
@@ -110,7 +146,7 @@ class ChipBib(Base):
                          )
 
     # lookups by race, tag need to be fast
-    __tableargs__ = (
+    __table_args__ = (
         Index('race_tag_idx', race_id, tag_id),
     )
 
@@ -126,6 +162,7 @@ class Race(Base):
     chipreads   = relationship('ChipRead', back_populates='race', foreign_keys=[ChipRead.race_id], cascade='all, delete, delete-orphan')
     chipbibs    = relationship('ChipBib', back_populates='race', foreign_keys=[ChipBib.race_id], cascade='all, delete, delete-orphan')
     resultssnapshots = relationship('ResultsSnapshot', back_populates='race', cascade='all, delete, delete-orphan')
+    resultssequence = relationship('ResultsSequence', back_populates='race', uselist=False, cascade='all, delete, delete-orphan')
     
     # next_scannedbib is set when there are more scanned bibs than there are results
     # OBSOLETE
@@ -146,6 +183,9 @@ class Result(Base):
     __table_args__ = (
         Index('ix_result_race_place', 'race_id', 'place'),
         Index('ix_result_simrun_place', 'simulationrun_id', 'place'),
+        # for retrieving rows changed since last poll
+        Index('ix_result_race_update', 'race_id', 'update_time'),
+        Index('ix_result_simrun_update', 'simulationrun_id', 'update_time'),
     )
     id           = Column(Integer(), primary_key=True)
     # has race_id or simrun_id, but not both
@@ -168,6 +208,67 @@ class Result(Base):
                          server_onupdate=FetchedValue()
                          )
 
+class ResultTombstone(Base):
+    """ids of deleted Results, so polling clients can remove them, see ResultsView.open()"""
+    __tablename__ = 'resulttombstone'
+    __table_args__ = (
+        Index('ix_resulttombstone_race_delete', 'race_id', 'delete_time'),
+        Index('ix_resulttombstone_simrun_delete', 'simulationrun_id', 'delete_time'),
+    )
+    id           = Column(Integer(), primary_key=True)
+    # not foreign keys, the result is gone and the race or simulation run may be deleted
+    result_id    = Column(Integer)
+    race_id      = Column(Integer)
+    simulationrun_id = Column(Integer)
+    delete_time  = Column(DateTime, server_default=text("CURRENT_TIMESTAMP"))
+
+class ResultChange(Base):
+    """log of Result changes, used to fan out change events to results streams in all
+    worker processes, see resultstream.py, and for the results version, see views.common.results_version()"""
+    __tablename__ = 'resultchange'
+    __table_args__ = (
+        Index('ix_resultchange_race', 'race_id', 'id'),
+        Index('ix_resultchange_simrun', 'simulationrun_id', 'id'),
+    )
+    id           = Column(Integer(), primary_key=True)
+    # not foreign keys, the result, race or simulation run may be deleted
+    race_id      = Column(Integer)
+    simulationrun_id = Column(Integer)
+    # None if the change affects multiple results
+    result_id    = Column(Integer)
+    action       = Column(String(16))
+    change_time  = Column(DateTime, server_default=text("CURRENT_TIMESTAMP"))
+
+class ClientMessage(Base):
+    """messages accepted from the reader clients, so a message replayed from a client's outbox
+    is only applied once, see views.common.accept_clientmessage()"""
+    __tablename__ = 'clientmessage'
+    __table_args__ = (
+        UniqueConstraint('client', 'seq', name='uq_clientmessage_client_seq'),
+    )
+    id           = Column(Integer(), primary_key=True)
+    # identifies the client's outbox, see outbox.py in the clients
+    client       = Column(String(64))
+    seq          = Column(Integer)
+    receive_time = Column(DateTime, server_default=text("CURRENT_TIMESTAMP"))
+
+class Job(Base):
+    """background job, see jobs.py"""
+    __tablename__ = 'job'
+    id           = Column(Integer(), primary_key=True)
+    kind         = Column(String(32))
+    # json
+    params       = Column(Text)
+    result       = Column(Text)
+    status       = Column(String(16))  # queued, running, done, failed, cancelled
+    cancel_requested = Column(Boolean, default=False)
+    error        = Column(Text)
+    submit_time  = Column(DateTime, server_default=text("CURRENT_TIMESTAMP"))
+    start_time   = Column(DateTime)
+    end_time     = Column(DateTime)
+    # updated periodically by the process running the job
+    heartbeat_time = Column(DateTime)
+
 class BluetoothType(Base):
     __tablename__ = 'bluetoothtype'
     id          = Column(Integer(), primary_key=True)
@@ -296,6 +397,7 @@ class SimulationRun(Base):
     simresults  = relationship('SimulationResult', back_populates='simulationrun', cascade='all, delete, delete-orphan')
     results     = relationship('Result', back_populates='simulationrun', cascade='all, delete, delete-orphan')
     scannedbibs = relationship('ScannedBib', back_populates='simulationrun', foreign_keys=[ScannedBib.simulationrun_id], cascade='all, delete, delete-orphan')
+    resultssequence = relationship('ResultsSequence', back_populates='simulationrun', uselist=False, cascade='all, delete, delete-orphan')
 
     # next_scannedbib is set when there are more scanned bibs than there are results
     # OBSOLETE
@@ -336,6 +438,40 @@ class ResultsSnapshot(Base):
     results_json     = Column(Text)
     scannedbibs_json = Column(Text)
 
+class ResultsSequence(Base):
+    """last Result place and ScannedBib order allocated for a race or simulation run, see sequence.py"""
+    __tablename__ = 'resultssequence'
+    __table_args__ = (
+        UniqueConstraint('race_id', name='uq_resultssequence_race'),
+        UniqueConstraint('simulationrun_id', name='uq_resultssequence_simrun'),
+    )
+    id           = Column(Integer(), primary_key=True)
+    # has race_id or simrun_id, but not both
+    race_id      = mapped_column(ForeignKey('race.id'))
+    race         = relationship('Race', back_populates='resultssequence')
+    simulationrun_id = mapped_column(ForeignKey('simulationrun.id'))
+    simulationrun    = relationship('SimulationRun', back_populates='resultssequence')
+    place        = Column(Integer, default=0)
+    order        = Column(Integer, default=0)
+
+class OutputFile(Base):
+    """confirmed rows already written to the output file, see fileformat.refreshfile()"""
+    __tablename__ = 'outputfile'
+    id           = Column(Integer(), primary_key=True)
+    filename     = Column(Text)
+    # race or simulation run whose rows are in the file; not foreign keys as the file outlives these
+    race_id      = Column(Integer)
+    simulationrun_id = Column(Integer)
+    rowcount     = Column(Integer) # None if file contents are unknown
+    byteoffset   = Column(Integer) # end of last row
+    rowoffsets   = Column(Text)    # json list of byte offset for the start of each row
+
+    # track last update - https://docs.sqlalchemy.org/en/20/dialects/mysql.html#mysql-timestamp-onupdate
+    update_time = Column(DateTime,
+                         server_default=text("CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP"),
+                         server_onupdate=FetchedValue()
+                         )
+
 class SimulationResult(Base):
     __tablename__ = 'simulationresult'
     id      = Column(Integer(), primary_key=True)
@@ -0,0 +1,219 @@
+"""push Result changes to browsers over a websocket
+
+Writers call publishchange() within their transaction, which adds a ResultChange row. Each
+worker process runs a single listener thread which polls the ResultChange table for new rows
+while any browser is connected to that process, and fans the changes out to the websocket
+handlers subscribed to the race or simulation run. Because the change log is in the database,
+changes made by any worker process reach browsers connected to every worker process.
+
+The browser responds to a change event by retrieving the changed rows using the results
+delta retrieval (/rest?since=<token>), so the row rendering stays in ResultsView.
+
+ResultChange ids are assigned when the row is inserted, but a transaction which got a lower id may 
+commit after one with a higher id has been read. So the listener reads again the last 
+RESULTS_STREAM_RESCAN ids before the highest it has seen, and skips the changes it already passed on.
+
+Each stream holds a worker thread while it is open, so each process accepts at most 
+RESULTS_STREAM_MAX streams; the browser polls if its stream is refused.
+
+NOTE: caller of publishchange() needs to commit
+"""
+
+# standard
+from json import dumps
+from queue import Queue, Empty
+from threading import Thread, Lock
+from time import sleep
+
+# pypi
+from flask import current_app
+from flask_sock import Sock
+from sqlalchemy import insert, delete, func, select as sqlselect
+
+# homegrown
+from .model import db, ResultChange
+
+# websocket routes are added by the views, see views.public.home and views.admin.simulation
+sock = Sock()
+
+def _streamkey(race_id=None, simulationrun_id=None):
+    if simulationrun_id:
+        return f'simulationrun-{simulationrun_id}'
+    return f'race-{race_id}'
+
+def publishchange(action, race_id=None, simulationrun_id=None, result_ids=None):
+    """log a change to results for a race or simulation run. Caller needs to commit
+
+    Args:
+        action (str): 'insert', 'update', 'delete', or 'refresh' if many results may have changed
+        race_id (int, optional): race id, for race results. Defaults to None.
+        simulationrun_id (int, optional): simulation run id, for simulation results. Defaults to None.
+        result_ids ([int, ...], optional): changed result ids, None if many results may have changed. Defaults to None.
+    """
+    if result_ids:
+        rows = [{'race_id': race_id, 'simulationrun_id': simulationrun_id, 'result_id': result_id, 'action': action}
+                for result_id in result_ids]
+    else:
+        rows = [{'race_id': race_id, 'simulationrun_id': simulationrun_id, 'result_id': None, 'action': action}]
+    db.session.execute(insert(ResultChange), rows)
+
+class ChangeListener(Thread):
+    """poll the ResultChange table, and pass changes to the subscribers for the race or simulation run
+
+    Args:
+        app (Flask): application, for app context and configuration
+    """
+    def __init__(self, app):
+        super().__init__(name='resultstream-listener', daemon=True)
+        self.app = app
+        self.poll = app.config.get('RESULTS_STREAM_POLL', 0.05)
+        self.keep = app.config.get('RESULTS_STREAM_KEEP', 10000)
+        self.rescan = app.config.get('RESULTS_STREAM_RESCAN', 500)
+        self.maxsubscribers = app.config.get('RESULTS_STREAM_MAX', 4)
+        self.subscribers = {}
+        self.subscriberslock = Lock()
+        self.lastid = None
+        # ids already passed on, within the rescan window
+        self.seen = set()
+        self.polls = 0
+
+    def subscribe(self, key):
+        """subscribe to changes for a race or simulation run
+
+        Args:
+            key (str): see _streamkey()
+
+        Returns:
+            Queue: receives [change, ...] lists, None if this process has RESULTS_STREAM_MAX subscribers
+        """
+        queue = Queue()
+        with self.subscriberslock:
+            if sum(len(queues) for queues in self.subscribers.values()) >= self.maxsubscribers:
+                return None
+            self.subscribers.setdefault(key, []).append(queue)
+        return queue
+
+    def unsubscribe(self, key, queue):
+        with self.subscriberslock:
+            queues = self.subscribers.get(key, [])
+            if queue in queues:
+                queues.remove(queue)
+            if not queues:
+                self.subscribers.pop(key, None)
+
+    def run(self):
+        with self.app.app_context():
+            while True:
+                sleep(self.poll)
+                try:
+                    self.check()
+                except Exception:
+                    current_app.logger.exception('resultstream listener error')
+                    self.lastid = None
+                    sleep(1)
+
+    def check(self):
+        """retrieve new changes and pass them to the subscribers"""
+        with self.subscriberslock:
+            active = bool(self.subscribers)
+
+        # nothing to do if no browsers are connected to this process; start from the latest
+        # change when the next one connects, as it retrieves the rows when it connects
+        if not active:
+            self.lastid = None
+            self.seen = set()
+            return
+
+        with db.engine.connect() as conn:
+            if self.lastid is None:
+                self.lastid = conn.execute(sqlselect(func.max(ResultChange.id))).scalar() or 0
+                return
+
+            # changes before lastid may have been committed since the last poll
+            changes = [change for change in conn.execute(
+                sqlselect(ResultChange.id, ResultChange.race_id, ResultChange.simulationrun_id,
+                          ResultChange.result_id, ResultChange.action)
+                .where(ResultChange.id > self.lastid - self.rescan)
+                .order_by(ResultChange.id)
+            ).all() if change.id > self.lastid or change.id not in self.seen]
+            if not changes:
+                return
+            self.lastid = max(self.lastid, changes[-1].id)
+            self.seen.update(change.id for change in changes)
+            self.seen = {id for id in self.seen if id > self.lastid - self.rescan}
+
+            # the log only needs to be long enough for the listeners to catch up
+            self.polls += 1
+            if self.polls % 100 == 0:
+                conn.execute(delete(ResultChange).where(ResultChange.id <= self.lastid - self.keep))
+                conn.commit()
+
+        bykey = {}
+        for change in changes:
+            key = _streamkey(change.race_id, change.simulationrun_id)
+            bykey.setdefault(key, []).append({'id': change.id, 'result_id': change.result_id, 'action': change.action})
+
+        with self.subscriberslock:
+            for key, keychanges in bykey.items():
+                for queue in self.subscribers.get(key, []):
+                    queue.put(keychanges)
+
+# one listener per worker process, started on first connection
+_listener = None
+_listener_lock = Lock()
+
+def getlistener():
+    global _listener
+    with _listener_lock:
+        if not _listener:
+            _listener = ChangeListener(current_app._get_current_object())
+            _listener.start()
+    return _listener
+
+def streamresults(ws, race_id=None, simulationrun_id=None):
+    """send change events for a race or simulation run until the browser disconnects
+
+    messages are json {'event': 'open'|'change'|'ping'|'busy', 'changes': [{'id', 'result_id', 'action'}, ...]}
+
+    Args:
+        ws (simple_websocket.Server): websocket from flask_sock
+        race_id (int, optional): race id, for race results. Defaults to None.
+        simulationrun_id (int, optional): simulation run id, for simulation results. Defaults to None.
+    """
+    # don't hold a database transaction for the life of the connection
+    db.session.commit()
+
+    ping = current_app.config.get('RESULTS_STREAM_PING', 25)
+    key = _streamkey(race_id, simulationrun_id)
+    listener = getlistener()
+    queue = listener.subscribe(key)
+    
+    # too many streams for this process's threads, browser polls and tries again later
+    if not queue:
+        current_app.logger.warning(f'refusing results stream for {key}, {listener.maxsubscribers} streams already open')
+        ws.send(dumps({'event': 'busy'}))
+        return
+    
+    try:
+        # browser retrieves rows on open, in case changes were missed while disconnected
+        ws.send(dumps({'event': 'open'}))
+        while True:
+            try:
+                changes = queue.get(timeout=ping)
+            except Empty:
+                # raises ConnectionClosed if the browser has gone away
+                ws.send(dumps({'event': 'ping'}))
+                continue
+
+            # coalesce anything else which has arrived
+            while True:
+                try:
+                    # queued lists are shared between subscribers, so don't extend in place
+                    changes = changes + queue.get_nowait()
+                except Empty:
+                    break
+
+            ws.send(dumps({'event': 'change', 'changes': changes}))
+
+    finally:
+        listener.unsubscribe(key, queue)
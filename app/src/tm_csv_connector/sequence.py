@@ -0,0 +1,123 @@
+"""allocation of Result place and ScannedBib order for a race or simulation run
+
+The last allocated values are kept in ResultsSequence, one row per race or simulation
+run, so the next value is an atomic increment of a single row rather than a
+SELECT ... ORDER BY ... DESC FOR UPDATE against the result or scannedbib index.
+
+The sequence row is created lazily from the current maximum, and is reset whenever
+places or orders are renumbered, so it is recreated from the renumbered rows on next use.
+
+NOTE: caller must acquire/release resultslock() for the race or simulation run
+"""
+
+# standard
+from math import ceil
+
+# pypi
+from sqlalchemy import update, delete, func, select as sqlselect
+
+# homegrown
+from .model import db, Result, ScannedBib, ResultsSequence
+
+def _sequence_filter(race_id, simulationrun_id):
+    if simulationrun_id:
+        return ResultsSequence.simulationrun_id == simulationrun_id
+    return ResultsSequence.race_id == race_id
+
+def _init_sequence(race_id, simulationrun_id):
+    """create sequence row from the current maximum place and order
+    
+    Args:
+        race_id (int): race id, or None for simulation run
+        simulationrun_id (int): simulation run id, or None for race
+    """
+    if simulationrun_id:
+        resultfilter = Result.simulationrun_id == simulationrun_id
+        scannedbibfilter = ScannedBib.simulationrun_id == simulationrun_id
+    else:
+        resultfilter = Result.race_id == race_id
+        scannedbibfilter = ScannedBib.race_id == race_id
+    
+    place = db.session.execute(sqlselect(func.max(Result.place)).where(resultfilter)).scalar() or 0
+    # ScannedBib.order may have gaps, and next order must be greater than any
+    order = ceil(db.session.execute(sqlselect(func.max(ScannedBib.order)).where(scannedbibfilter)).scalar() or 0)
+    
+    sequence = ResultsSequence(
+        race_id=None if simulationrun_id else race_id,
+        simulationrun_id=simulationrun_id,
+        place=place,
+        order=order,
+    )
+    db.session.add(sequence)
+    db.session.flush()
+
+def _next(column, race_id, simulationrun_id):
+    """increment sequence column and return the new value
+    
+    Args:
+        column (str): 'place' or 'order'
+        race_id (int): race id, or None for simulation run
+        simulationrun_id (int): simulation run id, or None for race
+    
+    Returns:
+        int: next value
+    """
+    thefilter = _sequence_filter(race_id, simulationrun_id)
+    thecolumn = getattr(ResultsSequence, column)
+    
+    updated = db.session.execute(
+        update(ResultsSequence)
+        .where(thefilter)
+        .values({column: thecolumn + 1})
+        .execution_options(synchronize_session=False)
+    )
+    
+    # first use for this race or simulation run
+    if updated.rowcount == 0:
+        _init_sequence(race_id, simulationrun_id)
+        db.session.execute(
+            update(ResultsSequence)
+            .where(thefilter)
+            .values({column: thecolumn + 1})
+            .execution_options(synchronize_session=False)
+        )
+    
+    return db.session.execute(sqlselect(thecolumn).where(thefilter)).scalar_one()
+
+def nextplace(race_id=None, simulationrun_id=None):
+    """allocate the next Result place
+
+    Args:
+        race_id (int, optional): race id. Defaults to None.
+        simulationrun_id (int, optional): simulation run id. Defaults to None.
+
+    Returns:
+        int: next place
+    """
+    return _next('place', race_id, simulationrun_id)
+
+def nextorder(race_id=None, simulationrun_id=None):
+    """allocate the next ScannedBib order
+
+    Args:
+        race_id (int, optional): race id. Defaults to None.
+        simulationrun_id (int, optional): simulation run id. Defaults to None.
+
+    Returns:
+        int: next order
+    """
+    return _next('order', race_id, simulationrun_id)
+
+def resetsequence(race_id=None, simulationrun_id=None):
+    """reset sequence after places or orders have been renumbered, or the results
+    have been cleared or restored. The sequence is recreated on next use.
+
+    Args:
+        race_id (int, optional): race id. Defaults to None.
+        simulationrun_id (int, optional): simulation run id. Defaults to None.
+    """
+    db.session.execute(
+        delete(ResultsSequence)
+        .where(_sequence_filter(race_id, simulationrun_id))
+        .execution_options(synchronize_session=False)
+    )
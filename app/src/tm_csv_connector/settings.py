@@ -35,6 +35,57 @@ class Config(object):
     # avoid warning
     SQLALCHEMY_TRACK_MODIFICATIONS = False
 
+    # results lock backend, 'thread' is only safe with a single gunicorn worker
+    # see fileformat.ResultsLock
+    RESULTS_LOCK_BACKEND = 'thread'
+    RESULTS_LOCK_TIMEOUT = 60
+
+    # output file rewrites replace the file atomically; appends are optionally synced to disk
+    # see fileformat._writerows()
+    OUTPUT_FILE_REPLACE = True
+    OUTPUT_FILE_FSYNC = False
+
+    # results delta retrieval token is backed off from the latest committed change by this many seconds, 
+    # to catch writes committed after a later one, see views.common.ResultsView.open()
+    RESULTS_SINCE_LOOKBACK = 5
+
+    # results stream (websocket) change log polling interval (seconds), ping interval (seconds), 
+    # number of change log rows to keep, and number of change log ids before the last one seen which are 
+    # checked again for changes committed out of id order, see resultstream.py
+    RESULTS_STREAM_POLL = 0.05
+    RESULTS_STREAM_PING = 25
+    RESULTS_STREAM_KEEP = 10000
+    RESULTS_STREAM_RESCAN = 500
+    
+    # each open results stream holds one of the worker process's gunicorn threads (--threads), so this 
+    # needs to be less than the number of threads, leaving threads for _postresult, _postbib, etc. Browsers 
+    # beyond this poll for results instead
+    RESULTS_STREAM_MAX = 4
+
+    # reader client messages are remembered this many days, so a replayed message is only applied once, 
+    # and old ones are deleted every this many messages, see views.common.accept_clientmessage()
+    CLIENTMESSAGE_KEEP_DAYS = 30
+    CLIENTMESSAGE_PRUNE_EVERY = 100
+
+    # largest chip read batch accepted from trident-reader-client, after decompression, 
+    # see views.public.api.LiveChipReadsApi
+    LIVECHIPREADS_MAX_BYTES = 1024*1024
+
+    # warn if a view issues more SQL statements than this, see dbstats.py
+    DB_STATEMENT_WARN = 25
+
+    # chip log imports commit every this many lines, and a running import which hasn't 
+    # committed for this many seconds was interrupted, see chipimport.py
+    CHIPIMPORT_CHUNK_LINES = 5000
+    CHIPIMPORT_STALE = 60
+
+    # number of background job threads in each worker process, and seconds between heartbeats for the 
+    # process's queued and running jobs. A job without a heartbeat for JOBS_STALE seconds had its 
+    # worker process exit, see jobs.py
+    JOBS_WORKERS = 2
+    JOBS_HEARTBEAT = 10
+    JOBS_STALE = 60
+
     # branding
     THISAPP_PRODUCTNAME = '<span class="brand-all"><span class="brand-left">tm</span><span class="brand-right">tility</span></span>'
     THISAPP_PRODUCTNAME_TEXT = 'tmtility'
@@ -57,6 +108,9 @@ class Testing(Config):
 
 
 class RealDb(Config):
+    # gunicorn may run multiple workers, so results need to be locked across processes
+    RESULTS_LOCK_BACKEND = 'mysql'
+
     def __init__(self, configfiles):
         if type(configfiles) == str:
             configfiles = [configfiles]
@@ -103,8 +103,13 @@ var simulationevents_import_saeditor = new SaEditor({
 
                 } else {
                     sae.saeditor.field('force').set('false');
-                    // show new data
-                    refresh_table_data(_dt_table, '/admin/simulationevents/rest', 'full-hold')
+                    // import runs in the background, show new data when it's done
+                    wait_for_job(json.job, function(job) {
+                        if (job.status != 'done') {
+                            job_error(job);
+                        }
+                        refresh_table_data(_dt_table, '/admin/simulationevents/rest', 'full-hold')
+                    });
                 }
             });
     },
@@ -211,8 +216,13 @@ var simulationexpected_import_saeditor = new SaEditor({
 
                 } else {
                     sae.saeditor.field('force').set('false');
-                    // show new data
-                    refresh_table_data(_dt_table, '/admin/simulationexpected/rest', 'full-hold')
+                    // import runs in the background, show new data when it's done
+                    wait_for_job(json.job, function(job) {
+                        if (job.status != 'done') {
+                            job_error(job);
+                        }
+                        refresh_table_data(_dt_table, '/admin/simulationexpected/rest', 'full-hold')
+                    });
                 }
             });
     },
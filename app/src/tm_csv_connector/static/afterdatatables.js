@@ -52,37 +52,56 @@ function afterdatatables() {
         });
 
         editor.on('postCreate', function(e, json, data, id) {
-            let resturl = window.location.pathname + `/rest?since=${last_draw}`;
+            let resturl = window.location.pathname + '/rest';
             last_draw = moment().format();
-            refresh_table_data(_dt_table, resturl, 'full-hold');
+            refresh_table_delta(_dt_table, resturl, 'full-hold');
         });
 
+        function update_table() {
+            results_cookie_mutex.promise()
+                .then(function(mutex) {
+                    mutex.lock();
+                    let resturl = window.location.pathname + '/rest';
+                    last_draw = moment().format();
+                    refresh_table_delta(_dt_table, resturl, 'full-hold');
+                    mutex.unlock();
+                })
+                .catch(function(err) {
+                    mutex.unlock();
+                    throw err;
+                });
+        }
+
+        let updates_suspended = false;
+
         function start_updates() {
+            // pick up anything which changed while updates were suspended
+            updates_suspended = false;
+            update_table();
+
             let draw_interval = setInterval(function() {
                 // if (scan_mousedown) return;
-                results_cookie_mutex.promise()
-                    .then(function(mutex) {
-                        mutex.lock();
-                        let resturl = window.location.pathname + `/rest?since=${last_draw}`;
-                        last_draw = moment().format();
-                        refresh_table_data(_dt_table, resturl, 'full-hold');
-                        mutex.unlock();
-                    })
-                    .catch(function(err) {
-                        mutex.unlock();
-                        throw err;
-                    });
+                // changes are pushed while the results stream is connected, but still do the periodic full refresh
+                if (results_stream_connected && Date.now() - results_last_full < CHECK_TABLE_FULL_REFRESH) return;
+                update_table();
             }, CHECK_TABLE_UPDATE);
 
             return draw_interval;
         }
 
         function stop_updates() {
+            updates_suspended = true;
             clearInterval(draw_interval);
         }
 
         let draw_interval = start_updates();
 
+        results_stream_open(window.location.pathname + '/stream', function(msg) {
+            if (!updates_suspended) {
+                update_table();
+            }
+        });
+
         _dt_table.on('select.dt', function(e, dt, type, indexes) {
             $('#updates-suspended').show();
             stop_updates();
@@ -116,37 +135,56 @@ function afterdatatables() {
         });
 
         editor.on('postCreate', function(e, json, data, id) {
-            let resturl = window.location.pathname + `/rest?since=${last_draw}`;
+            let resturl = window.location.pathname + '/rest';
             last_draw = moment().format();
-            refresh_table_data(_dt_table, resturl, 'full-hold');
+            refresh_table_delta(_dt_table, resturl, 'full-hold');
         });
 
+        function update_table() {
+            if (scan_mousedown) return;
+            results_cookie_mutex.promise()
+                .then(function(mutex) {
+                    mutex.lock();
+                    let resturl = window.location.pathname + '/rest';
+                    refresh_table_delta(_dt_table, resturl, 'full-hold');
+                    mutex.unlock();
+                })
+                .catch(function(err) {
+                    mutex.unlock();
+                    throw err;
+                });
+        }
+
+        let updates_suspended = false;
+
         function start_updates() {
+            // pick up anything which changed while updates were suspended
+            updates_suspended = false;
+            update_table();
+
             // TODO: need to send simulation state
             let draw_interval = setInterval(function() {
-                if (scan_mousedown) return;
-                results_cookie_mutex.promise()
-                    .then(function(mutex) {
-                        mutex.lock();
-                        let resturl = window.location.pathname + `/rest?`;
-                        refresh_table_data(_dt_table, resturl, 'full-hold');
-                        mutex.unlock();
-                    })
-                    .catch(function(err) {
-                        mutex.unlock();
-                        throw err;
-                    });
+                // changes are pushed while the results stream is connected, but still do the periodic full refresh
+                if (results_stream_connected && Date.now() - results_last_full < CHECK_TABLE_FULL_REFRESH) return;
+                update_table();
             }, CHECK_TABLE_UPDATE);
 
             return draw_interval;
         }
 
         function stop_updates() {
+            updates_suspended = true;
             clearInterval(draw_interval);
         }
 
         let draw_interval = start_updates();
 
+        results_stream_open(window.location.pathname + '/stream', function(msg) {
+            if (!updates_suspended) {
+                update_table();
+            }
+        });
+
         _dt_table.on('select.dt', function(e, dt, type, indexes) {
             $('#updates-suspended').show();
             stop_updates();
@@ -175,17 +213,26 @@ function afterdatatables() {
         chipreads_import_saeditor.init();
 
         chipreads_import_saeditor.saeditor.on('submitComplete', function(e, json, data, action) {
-            // draw will retrieve data from server because it's server side
-            _dt_table.draw();
+            // import continues in the background, table is redrawn as it progresses
+            chipreads_import_progress(json.chipimport, _dt_table);
         });
 
+        // show progress of any import which is already running
+        chipreads_import_progress(null, _dt_table);
+
     } else if (pathname == '/chip2bib') {
         // initialize import button handling
         chip2bib_import_saeditor.init();
 
         chip2bib_import_saeditor.saeditor.on('submitComplete', function(e, json, data, action) {
-            // draw will retrieve data from server because it's server side
-            _dt_table.draw();
+            // import runs in the background
+            if (json.job) {
+                wait_for_job(json.job, function(job) {
+                    job_error(job);
+                    // draw will retrieve data from server because it's server side
+                    _dt_table.draw();
+                });
+            }
         });
 
     } else if (pathname == '/chipreaders') {
@@ -49,3 +49,45 @@ var chipreads_import = function(url) {
     return chipreads_import_saeditor.edit_button_hook(url);
 }
 
+
+const CHIPIMPORT_POLL = 1000; // ms, interval to check import progress
+
+/**
+ * show progress of chip log import until it's finished, then redraw the table
+ * 
+ * @param {int} chipimport - import id from Import response, null for the latest running import
+ * @param {DataTable} table - chip reads table
+ */
+function chipreads_import_progress(chipimport, table) {
+    let progress = $('#chipimport-progress');
+    if (progress.length == 0) {
+        progress = $('<div id="chipimport-progress"></div>');
+        $(table.table().container()).before(progress);
+    }
+
+    let args = chipimport ? {id: chipimport} : {};
+    $.getJSON('/_chipimport/status', args, function(json) {
+        if (json.status != 'success' || !json.chipimport) {
+            progress.hide();
+            return;
+        }
+        let imp = json.chipimport;
+        let text = 'Import ' + imp.status + ': ' + imp.lines + ' lines, ' + imp.percent + '% done';
+        if (imp.status == 'running') {
+            text += ', ' + imp.rate + ' lines/sec';
+        }
+        if (imp.status == 'interrupted') {
+            text += ' - import the same file again to resume';
+        }
+        if (imp.error) {
+            text += ' - ' + imp.error;
+        }
+        progress.html(text).show();
+
+        // draw will retrieve data from server because it's server side
+        table.draw(false);
+        if (imp.status == 'running') {
+            setTimeout(chipreads_import_progress, CHIPIMPORT_POLL, imp.id, table);
+        }
+    });
+}
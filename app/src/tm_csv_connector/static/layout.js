@@ -18,3 +18,31 @@ $( function() {
     buttons.button();    
 });
 
+
+const JOB_POLL = 1000; // ms, interval to check background job status
+
+// wait for a background job to finish, then call callback(job), see jobs.py
+// job.status is 'done', 'failed', or 'cancelled'; job.result is from the job function
+function wait_for_job(job_id, callback) {
+    $.getJSON('/_jobs/' + job_id, function(json) {
+        if (json.status != 'success') {
+            callback({id: job_id, status: 'failed', error: json.error});
+            return;
+        }
+        let job = json.job;
+        if (job.status == 'queued' || job.status == 'running') {
+            setTimeout(wait_for_job, JOB_POLL, job_id, callback);
+        } else {
+            callback(job);
+        }
+    });
+}
+
+// show error for a job which did not complete
+function job_error(job) {
+    if (job.status == 'failed') {
+        alert('Error Occurred: ' + job.error);
+    } else if (job.status == 'cancelled') {
+        alert('Cancelled');
+    }
+}
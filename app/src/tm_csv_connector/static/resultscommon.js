@@ -4,3 +4,143 @@ const RESULTS_COOKIE_TIMEOUT = 5000; // ms, timeout for cookie mutex
 
 // mutex
 let results_cookie_mutex = new MutexPromise('results-cookie', {timeout: RESULTS_COOKIE_TIMEOUT});
+
+const CHECK_TABLE_FULL_REFRESH = 30000; // ms, interval to retrieve all rows, in case a delta update was missed
+
+// since token from the server's last delta response, null to retrieve all rows
+let results_since = null;
+let results_last_full = 0;
+// version of the results when last retrieved, server responds 304 if unchanged
+let results_etag = null;
+
+/**
+ * update table with rows which changed since the last update, and remove deleted rows
+ * 
+ * uses /rest?since=<token>, see views.common.ResultsView.open(). When there's no since token 
+ * (or periodically) all rows are retrieved, and rows which aren't in the response are removed
+ * 
+ * @param {DataTable} table - table to update
+ * @param {string} resturl - rest url for table, without since parameter
+ * @param {string} paging - paging parameter for table.draw(), default 'full-reset'
+ * @returns promise
+ */
+function refresh_table_delta(table, resturl, paging) {
+    if (paging === undefined) {
+        paging = 'full-reset';
+    }
+    if (Date.now() - results_last_full > CHECK_TABLE_FULL_REFRESH) {
+        results_since = null;
+    }
+    let full = (results_since === null);
+    let sep = resturl.includes('?') ? '&' : '?';
+    let url = resturl + sep + 'since=' + encodeURIComponent(full ? '' : results_since);
+    
+    // share the lock with loutilities refresh_table_data() so updates don't interleave
+    return rtd_mutex.promise()
+        .then(function(mutex) {
+            mutex.lock();
+            // full retrieval is unconditional, in case a delta update was missed
+            let headers = {};
+            if (!full && results_etag) {
+                headers['If-None-Match'] = results_etag;
+            }
+            return $.ajax({url: url, headers: headers})
+                .then(function(data, textStatus, jqXHR) {
+                    return {data: data, status: jqXHR.status, etag: jqXHR.getResponseHeader('ETag')};
+                });
+        })
+        .then(function(resp) {
+            // nothing changed, keep the current since token
+            if (resp.status == 304) {
+                rtd_mutex.unlock();
+                return;
+            }
+            results_etag = resp.etag;
+            let respdata = resp.data;
+            let rowId = table.settings()[0].rowId;
+            
+            // for full retrieval, rows which aren't in the response need to be deleted
+            let currrows = {};
+            if (full) {
+                table.rows().every(function() {
+                    currrows[this.id()] = true;
+                });
+                results_last_full = Date.now();
+            }
+            
+            // replace row if it exists, add row if it is new
+            for (let i=0; i<respdata.data.length; i++) {
+                let resprow = respdata.data[i];
+                let row = table.row('#' + resprow[rowId]);
+                if (row.any()) {
+                    row.data(resprow);
+                } else {
+                    table.row.add(resprow);
+                }
+                delete currrows[resprow[rowId]];
+            }
+            
+            for (let i=0; i<respdata.deleted.length; i++) {
+                let row = table.row('#' + respdata.deleted[i]);
+                if (row.any()) {
+                    row.remove();
+                }
+            }
+            $.each(currrows, function(k, v) {
+                table.row('#' + k).remove();
+            });
+            
+            // only redraw if something changed
+            if (full || respdata.data.length > 0 || respdata.deleted.length > 0) {
+                table.draw(paging);
+            }
+            results_since = respdata.since;
+            rtd_mutex.unlock();
+        })
+        .catch(function(e) {
+            rtd_mutex.unlock();
+            throw e;
+        });
+}
+
+const RESULTS_STREAM_RETRY = 5000; // ms, wait before reconnecting the results stream
+const RESULTS_STREAM_BUSY_RETRY = 60000; // ms, wait before reconnecting if the server refused the stream
+
+// results stream pushes change events, so polling isn't needed while it's connected
+let results_stream = null;
+let results_stream_connected = false;
+
+/**
+ * open websocket to receive result change events, reconnecting if it closes
+ * 
+ * see resultstream.streamresults() for the messages
+ * 
+ * @param {string} streampath - path for stream, e.g., /results/stream
+ * @param {function} onchange - called with the message when connected and when results change
+ */
+function results_stream_open(streampath, onchange) {
+    let scheme = (window.location.protocol == 'https:') ? 'wss:' : 'ws:';
+    results_stream = new WebSocket(`${scheme}//${window.location.host}${streampath}`);
+    
+    results_stream.onmessage = function(e) {
+        let msg = JSON.parse(e.data);
+        // changes may have been missed while disconnected, so treat open as a change
+        if (msg.event == 'open') {
+            results_stream_connected = true;
+            onchange(msg);
+        } else if (msg.event == 'change') {
+            onchange(msg);
+        // server has too many streams open, keep polling and try again later
+        } else if (msg.event == 'busy') {
+            busy = true;
+        }
+    };
+    
+    let busy = false;
+    results_stream.onclose = function(e) {
+        results_stream_connected = false;
+        setTimeout(function() {
+            results_stream_open(streampath, onchange);
+        }, busy ? RESULTS_STREAM_BUSY_RETRY : RESULTS_STREAM_RETRY);
+    };
+}
@@ -186,8 +186,14 @@ function stopSimulation() {
         },
         success: function ( json ) {
             if (json.status == 'success') {
-                // update the last time
-                alert(`Simulation finished. Score: ${json.score}`);
+                // score is calculated in the background
+                wait_for_job(json.job, function(job) {
+                    if (job.status == 'done') {
+                        alert(`Simulation finished. Score: ${job.result.score}`);
+                    } else {
+                        job_error(job);
+                    }
+                });
             } else {
                 alert(json.error);
             }
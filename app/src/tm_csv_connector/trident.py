@@ -3,9 +3,12 @@
 
 # standard
 from decimal import Decimal
+from threading import Lock
+from time import monotonic
 
 # pypi
-from sqlalchemy import and_, select as sqlselect
+from sqlalchemy import and_, tuple_, insert, func, case, select as sqlselect
+from sqlalchemy.dialects.mysql import insert as mysqlinsert
 from loutilities.timeu import asctime
 
 # homegrown
@@ -17,7 +20,101 @@ Ymdfmt = asctime('%Y-%m-%d')
 
 class Trident(object): pass
 
-def tridentread2obj(raceid, line):
+# per race tag_id -> bib cache, {raceid: {'chip2bib': {tag_id: bib, ...}, 'version': (count, max update_time), 'checked': monotonic time}}
+# the ChipBib table rarely changes during an event, so this avoids a query per chip read
+# the version is checked against the database at most every CHIPBIB_CACHE_CHECK seconds,
+# which lets other worker processes see updates; this process resets explicitly on update
+CHIPBIB_CACHE_CHECK = 2.0
+_chipbib_cache = {}
+_chipbib_cache_lock = Lock()
+
+# maximum keys in a single IN (...) query, so large batches from trident-reader-client stay index range lookups
+IN_CHUNK = 500
+# maximum rows in a single INSERT ... ON DUPLICATE KEY UPDATE, so a file import chunk stays well under max_allowed_packet
+UPSERT_CHUNK = 1000
+
+def _chunks(keys, size=IN_CHUNK):
+    """split keys into lists of at most size
+
+    Args:
+        keys (iterable): keys
+        size (int, optional): maximum keys per chunk. Defaults to IN_CHUNK.
+
+    Yields:
+        [key, ...]
+    """
+    keys = list(keys)
+    for start in range(0, len(keys), size):
+        yield keys[start:start+size]
+
+def _chipbib_version(raceid):
+    """return version of ChipBib rows for this race
+
+    Args:
+        raceid (int): race id
+
+    Returns:
+        tuple: (count, max update_time)
+    """
+    return tuple(db.session.execute(
+        sqlselect(func.count(ChipBib.id), func.max(ChipBib.update_time))
+            .where(ChipBib.race_id == raceid)
+    ).one())
+
+def get_chip2bib(raceid):
+    """get the tag_id to bib mapping for a race, from cache if up to date
+
+    Args:
+        raceid (int): race id
+
+    Returns:
+        dict: {tag_id: bib, ...}
+    """
+    raceid = int(raceid)
+    now = monotonic()
+    with _chipbib_cache_lock:
+        cached = _chipbib_cache.get(raceid, None)
+        if cached and now - cached['checked'] < CHIPBIB_CACHE_CHECK:
+            return cached['chip2bib']
+
+    version = _chipbib_version(raceid)
+    if cached and cached['version'] == version:
+        with _chipbib_cache_lock:
+            cached['checked'] = now
+        return cached['chip2bib']
+
+    chip2bib = dict(db.session.execute(
+        sqlselect(ChipBib.tag_id, ChipBib.bib)
+            .where(ChipBib.race_id == raceid)
+    ).all())
+    with _chipbib_cache_lock:
+        _chipbib_cache[raceid] = {'chip2bib': chip2bib, 'version': version, 'checked': now}
+    return chip2bib
+
+def reset_chipbib_cache(raceid=None):
+    """reset the tag_id to bib cache, call after ChipBib is updated
+
+    Args:
+        raceid (int, optional): race id to reset, or None to reset all races. Defaults to None.
+    """
+    with _chipbib_cache_lock:
+        if raceid is None:
+            _chipbib_cache.clear()
+        else:
+            _chipbib_cache.pop(int(raceid), None)
+
+def tridentread2obj(raceid, line, chip2bib=None):
+    """convert trident chip read line to object
+
+    Args:
+        raceid (int): raceid to associate with this read
+        line (str): 'aa' line from Trident reader
+        chip2bib (dict, optional): {tag_id: bib, ...} already retrieved by caller. If
+            None, the cached mapping for raceid is used. Defaults to None.
+
+    Returns:
+        Trident: chip read object
+    """
     # print(f'tridentread2obj({line})')
     trident = Trident()
     trident.reader_id = line[2]
@@ -36,19 +133,10 @@ def tridentread2obj(raceid, line):
         trident.rssi = int(line[38:40], 16)
 
     # chip2bib mapping may not be available, but should be
-    trident.bib = None
-    chipbib = db.session.execute(
-            sqlselect(ChipBib)
-                .where(and_(
-                    ChipBib.race_id == raceid,
-                    ChipBib.tag_id == trident.tag_id,
-                    )
-                )
-        ).one_or_none()
-    if chipbib:
-        chipbib = chipbib[0]
-        trident.bib = chipbib.bib
-        
+    if chip2bib is None:
+        chip2bib = get_chip2bib(raceid)
+    trident.bib = chip2bib.get(trident.tag_id, None)
+
     return trident
 
 def tridentmarker2obj(line):
@@ -70,100 +158,131 @@ def trident2db(raceid, line, source):
         line (raw): input line from Trident reader
         source (str): 'file' or 'live'
     """
-    # only process chip reads (aa) or guntime (ab)
-    if len(line) < 2 or line[0:2] not in ['aa', 'ab']: return
-    
-    # process read https://www.manula.com/manuals/tridentrfid/timemachine/1/en/topic/tag-data-message-format
-    if line[0:2] == 'aa':
-        tridentread = tridentread2obj(raceid, line.strip())
-        reader_id = tridentread.reader_id
-        receiver_id = tridentread.receiver_id
-        tag_id = tridentread.tag_id
-        counter = tridentread.counter
-        date = tridentread.date
-        time = tridentread.time
-        rtype = tridentread.rtype
-        rssi = tridentread.rssi
-        bib = tridentread.bib
-
-        # we might already have this record, if we're reading both filtered and raw chip files
-        chipread = db.session.execute(
-            sqlselect(ChipRead)
-                .where(and_(
-                    ChipRead.race_id == raceid,
-                    ChipRead.reader_id == reader_id,
-                    ChipRead.date == date,
-                    ChipRead.tag_id == tag_id,
-                    ChipRead.time == time,
-                    )
-                )
-        ).one_or_none()
-        
-        # read not found, add row
-        if not chipread:
-            chipread = ChipRead(
-                race_id=raceid,
-                reader_id=reader_id,
-                receiver_id=receiver_id,
-                tag_id=tag_id,
-                contig_ctr=counter,
-                date=date,
-                time=time,
-                rssi=rssi,
-                bib=bib,
-                types=rtype,
-                source=source,
-            )
-            db.session.add(chipread)
-            db.session.flush()
-        
-        # read found, update types, possibly rssi, and bib
+    trident2db_batch(raceid, [line], source)
+
+def trident2db_batch(raceid, lines, source):
+    """Put a batch of lines from trident reader into database, using set-based
+    queries rather than per-line lookups. Caller needs to commit
+
+    The whole batch is parsed first, using the cached tag to bib mapping. Chip reads are
+    saved with a single INSERT ... ON DUPLICATE KEY UPDATE on the ChipRead unique key, which merges
+    types, rssi and bib into reads we already have, e.g., if we're reading both filtered and raw 
+    chip files. Markers have no tag_id so aren't covered by the unique key, and are looked up instead.
+
+    Args:
+        raceid (int): raceid to associate with these reads
+        lines ([str, ...]): input lines from Trident reader
+        source (str): 'file' or 'live'
+
+    Returns:
+        dict: {'saved': int, 'merged': int, 'ignored': int}, merged is the number of saved 
+            reads which changed a read already in the database or earlier in the batch
+    """
+    counts = {'saved': 0, 'merged': 0, 'ignored': 0}
+
+    # tag -> bib mapping comes from the per race cache
+    chip2bib = get_chip2bib(raceid)
+
+    # parse the whole batch first; only process chip reads (aa) or guntime (ab)
+    reads = []
+    markers = []
+    for line in lines:
+        line = line.strip()
+        if len(line) < 2 or line[0:2] not in ['aa', 'ab']:
+            # empty lines are just message separators, don't count them
+            if line:
+                counts['ignored'] += 1
+            continue
+
+        if line[0:2] == 'aa':
+            reads.append(tridentread2obj(raceid, line, chip2bib=chip2bib))
         else:
-            chipread = chipread[0]
-            types = chipread.types.split(',')
-            if rtype not in types:
-                types.append(rtype)
-                types.sort()
-            chipread.types = ','.join(types)
-            
-            if not chipread.rssi:
-                chipread.rssi = rssi
-            
-            # this really shouldn't change, but if the
-            # chipbib table was added after the fact this
-            # will be used
-            chipread.bib = bib
-                
-    # handle marker / start trigger
-    elif line[0:2] == 'ab':
-        tridentmarker = tridentmarker2obj(line.strip())
-        reader_id = tridentmarker.reader_id
-        date = tridentmarker.date
-        time = tridentmarker.time
-        rtype = tridentmarker.rtype
-
-        # we might already have this record, if we're reading both filtered and raw chip files
-        chipread = db.session.execute(
-            sqlselect(ChipRead)
-                .where(and_(
-                    ChipRead.race_id == raceid,
-                    ChipRead.reader_id == reader_id,
-                    ChipRead.date == date,
-                    ChipRead.time == time,
-                    ChipRead.types == rtype,
-                    )
-                )
-        ).one_or_none()
+            markers.append(tridentmarker2obj(line))
+
+    if reads:
+        rows = [dict(
+                    race_id=raceid,
+                    reader_id=r.reader_id,
+                    receiver_id=r.receiver_id,
+                    tag_id=r.tag_id,
+                    contig_ctr=r.counter,
+                    date=r.date,
+                    time=r.time,
+                    rssi=r.rssi,
+                    bib=r.bib,
+                    types=r.rtype,
+                    source=source,
+                ) for r in reads]
         
-        # add if not there already; ignore if already there
-        if not chipread:
-            chipread = ChipRead(
+        # duplicates within the batch are merged by the same statement, row by row
+        # the connection reports found rows, so rowcount is 1 per row, plus 1 for each row which changed an existing row
+        for chunk in _chunks(rows, UPSERT_CHUNK):
+            result = db.session.execute(_upsert_reads(chunk))
+            counts['saved'] += len(chunk)
+            counts['merged'] += max(result.rowcount - len(chunk), 0)
+
+    if markers:
+        # add markers if not there already; ignore if already there
+        markerkey = lambda m: (m.reader_id, m.date, m.time)
+        keys = {markerkey(m) for m in markers}
+        seen = set()
+        for chunk in _chunks(keys):
+            seen.update(tuple(row) for row in db.session.execute(
+                sqlselect(ChipRead.reader_id, ChipRead.date, ChipRead.time)
+                    .where(and_(
+                        ChipRead.race_id == raceid,
+                        ChipRead.types == 'GUNTIME',
+                        tuple_(ChipRead.reader_id, ChipRead.date, ChipRead.time).in_(chunk),
+                        )
+                    )
+            ).all())
+
+        newrows = []
+        for m in markers:
+            key = markerkey(m)
+            if key in seen:
+                counts['ignored'] += 1
+                continue
+            seen.add(key)
+            newrows.append(dict(
                 race_id=raceid,
-                reader_id=reader_id,
-                date=date,
-                time=time,
-                types=rtype,
+                reader_id=m.reader_id,
+                date=m.date,
+                time=m.time,
+                types=m.rtype,
                 source=source,
-            )
-            db.session.add(chipread)
-            db.session.flush()
+            ))
+        
+        if newrows:
+            db.session.execute(insert(ChipRead), newrows)
+            counts['saved'] += len(newrows)
+
+    return counts
+
+def _upsert_reads(rows):
+    """INSERT ... ON DUPLICATE KEY UPDATE statement for chip reads, keyed by uq_chipread_read
+
+    when a read is already there, rtype is added to its comma separated types if it's not already 
+    in them (before or after, to keep the usual one or two types sorted), rssi is set if it 
+    wasn't, and bib is updated. bib really shouldn't change, but if the chipbib table was 
+    added after the fact this will be used
+
+    NOTE: MySQL only, as are FIND_IN_SET() and the ChipRead update_time default
+
+    Args:
+        rows ([dict, ...]): ChipRead rows
+
+    Returns:
+        Insert: single multi-row statement
+    """
+    stmt = mysqlinsert(ChipRead).values(rows)
+    new = stmt.inserted
+    return stmt.on_duplicate_key_update(
+        types=case(
+            (func.find_in_set(new.types, ChipRead.types) > 0, ChipRead.types),
+            (new.types < ChipRead.types, func.concat(new.types, ',', ChipRead.types)),
+            else_=func.concat(ChipRead.types, ',', new.types),
+        ),
+        rssi=func.coalesce(ChipRead.rssi, new.rssi),
+        bib=new.bib,
+    )
@@ -8,7 +8,7 @@ from os import remove
 from os import environ
 from uuid import uuid4
 from traceback import format_exception_only, format_exc
-from csv import DictReader, DictWriter
+from csv import DictReader
 from datetime import datetime
 from requests import post
 from re import compile
@@ -19,7 +19,7 @@ from dominate.tags import div, button, span, select, option, i, input_
 from flask import request, jsonify, current_app, url_for, session
 from flask_security import current_user
 from flask.views import MethodView
-from sqlalchemy import update, and_, select as sqlselect
+from sqlalchemy import func, insert, select as sqlselect
 from loutilities.user.tables import DbCrudApiRolePermissions
 from loutilities.filters import filtercontainerdiv, filterdiv, yadcfoption
 from loutilities.tables import rest_url_for
@@ -33,12 +33,13 @@ from . import bp
 from ...model import User
 from ...model import db, Simulation, SimulationEvent, SimulationResult, SimulationRun, SimulationExpected, Result
 from ...model import ScannedBib
-from ...model import Setting
 from ...model import etype_type
 from ...times import asc2time, time2asc
 from ..common import ResultsView, get_results_posttablehtml, results_dbmapping, results_formmapping, results_validate
-from ..common import PostResultApi, PostBibApi, ScanActionApi
-from ...fileformat import filecolumns, db2file, filelock, lock, unlock, fulltime
+from ..common import PostResultApi, PostBibApi, ScanActionApi, confirm_results
+from ...fileformat import resultslock, appendrows, lock, unlock, fulltime
+from ...resultstream import sock, streamresults, publishchange
+from ...jobs import jobfunction, submitjob, JobCancelled
 
 from ...roles import ROLE_SUPER_ADMIN, ROLE_TMSIM_ADMIN
 roles_accepted = [ROLE_SUPER_ADMIN, ROLE_TMSIM_ADMIN]
@@ -110,23 +111,14 @@ class ResultsViewSim(ResultsView, SimConnectorView):
         self.queryparams['simulationrun_id'] = simulationrun_id
         # current_app.logger.debug(f'queryparams: {self.queryparams}')
 
-    def set_queue_filters(self):
-        """sets queue filters
+    def get_lock(self):
+        """return the lock for the current simulation run
 
         Returns:
-            boolean: True if caller should update the queued scanned results
+            ResultsLock
         """
         simulationrun_id = session['_results_simulationrun_id'] if '_results_simulationrun_id' in session else None
-        simulationrun = SimulationRun.query.filter_by(id=simulationrun_id).one_or_none()
-        if simulationrun:
-            process_queue = True
-            self.result_queue_filter = [Result.simulationrun_id == simulationrun_id]
-            self.scannedbib_queue_filter = [ScannedBib.simulationrun_id == simulationrun_id]
-
-        else:
-            process_queue = False
-            
-        return process_queue
+        return resultslock(simulationrun_id=simulationrun_id)
 
     def createrow(self, formdata):
         '''
@@ -167,71 +159,44 @@ class ResultsViewSim(ResultsView, SimConnectorView):
 
         if 'confirm' in formdata and formdata['confirm'] == 'true':
             # LOCK file access
-            lock(filelock)
-            
-            # don't rewrite file when confirming
-            self.rewritefile = False
-
-            # set is_confirmed for all rows in this race which have place <= the selected row
-            updated = db.session.execute(
-                sqlselect(Result)
-                .where(and_(
-                    Result.simulationrun_id == self.result.simulationrun_id,
-                    Result.place <= self.result.place,
-                    Result.is_confirmed == False)
-                )
-                .order_by(Result.place)
-            ).all()
-            
-            # not sure why there is a need to for r[0] -- is this new in sqlalchemy 2.0?
-            updated = [r[0] for r in updated]
+            thelock = resultslock(simulationrun_id=self.result.simulationrun_id)
+            lock(thelock)
             
-            db.session.execute(
-                update(Result)
-                .where(Result.id.in_([r.id for r in updated]))
-                .values(is_confirmed=True)
-            )
-            db.session.flush()
-
-            # write the updated results to table
-            lastresult = db.session.execute(
-                sqlselect(SimulationResult)
-                .where(SimulationResult.simulationrun_id == self.simulationrun.id)
-                .order_by(SimulationResult.order.desc())
-            ).first()
-            if lastresult:
-                order = lastresult[0].order + 1
-            else:
-                order = 1
-            
-            for result in updated:
-                simulationresult = SimulationResult(
-                    simulationrun_id = self.simulationrun.id,
-                    bibno = result.bibno,
-                    time = result.time,
-                    order = order,
-                )
-                db.session.add(simulationresult)
-                order += 1
-            db.session.flush()
+            try:
+                # don't rewrite file when confirming
+                self.rewritefile = False
+
+                # set is_confirmed for all rows in this race which have place <= the selected row
+                updated = confirm_results(self.result.place, simulationrun_id=self.result.simulationrun_id)
+
+                # write the updated results to table
+                lastorder = db.session.execute(
+                    sqlselect(func.max(SimulationResult.order))
+                    .where(SimulationResult.simulationrun_id == self.simulationrun.id)
+                ).scalar() or 0
+                
+                if updated:
+                    db.session.execute(
+                        insert(SimulationResult),
+                        [{'simulationrun_id': self.simulationrun.id, 'bibno': result.bibno, 'time': result.time, 'order': lastorder + i}
+                         for i, result in enumerate(updated, start=1)]
+                    )
+                    
+                # if the simulation is configured to save results to csv file, write the updated results to file
+                if current_app.config['SIMULATION_SAVE_CSV']:
+                    # write the updated results to file
+                    appendrows(updated)
+                
+                publishchange('update', simulationrun_id=self.result.simulationrun_id, result_ids=[r.id for r in updated])
                 
-            # if the simulation is configured to save results to csv file, write the updated results to file
-            if current_app.config['SIMULATION_SAVE_CSV']:
-                # get output file pathname and write updated results to file
-                filesetting = Setting.query.filter_by(name='output-file').one_or_none()
-                if filesetting:
-                    filepath = join('/output_dir', filesetting.value)
-
-                    # write to the file
-                    with open(filepath, mode='a') as f:
-                        for result in updated:
-                            filedata = db2file(result)
-                            current_app.logger.debug(f'appending to {filesetting.value}: {filedata["pos"],filedata["bibno"],filedata["time"]}')
-                            csvf = DictWriter(f, fieldnames=filecolumns, extrasaction='ignore')
-                            csvf.writerow(filedata)
+                # UNLOCK file access
+                unlock(thelock)
             
-            # UNLOCK file access
-            unlock(filelock)
+            except:
+                # UNLOCK file access
+                if thelock.held():
+                    unlock(thelock)
+                raise
             
             thisrow = self.dte.get_response_data(self.result)
             return thisrow
@@ -314,6 +279,16 @@ results_view = ResultsViewSim(
 )
 results_view.register()
 
+@sock.route('/resultssim/stream', bp=bp)
+def resultssim_stream(ws):
+    '''
+    push result changes for the current simulation run, see resultstream.streamresults()
+    '''
+    if not any(current_user.has_role(role) for role in roles_accepted):
+        return
+    simulationrun_id = session['_results_simulationrun_id'] if '_results_simulationrun_id' in session else None
+    streamresults(ws, simulationrun_id=simulationrun_id)
+
 
 simulation_dbattrs = 'id,name,description'.split(',')
 simulation_formfields = 'rowid,name,description'.split(',')
@@ -442,12 +417,13 @@ class SimulationEventsApi(MethodView):
         return '.' in filename and \
             filename.rsplit('.', 1)[1].lower() in self.ALLOWED_EXTENSIONS
     
-    def import_csv_file(self, filepath, simid):
+    def import_csv_file(self, filepath, simid, job=None):
         """import csv file and save list of SimulationEvent objects
 
         Args:
             filepath (str): path to the csv file
             simid (int): simulation id to associate with the events
+            job (JobContext, optional): checked for cancel every 1000 lines. Defaults to None.
         """
         with open(filepath, newline='') as stream:
             csvfile = DictReader(stream)
@@ -463,6 +439,8 @@ class SimulationEventsApi(MethodView):
             lineno = 1  # skip header
             for line in csvfile:
                 lineno += 1
+                if job and lineno % 1000 == 0:
+                    job.checkcancel()
                 # check for valid etype
                 if line['etype'] not in etype_type:
                     raise ParameterError(f"line {lineno}: invalid etype '{line['etype']}'")
@@ -480,12 +458,13 @@ class SimulationEventsApi(MethodView):
                 )
                 db.session.add(simevent)
 
-    def import_log_file(self, filepath, simid):
+    def import_log_file(self, filepath, simid, job=None):
         """import tmtility log file and save list of SimulationEvent objects
 
         Args:
             filepath (str): log file path with txt extension
             simid (int): Simulation id to associate with the events
+            job (JobContext, optional): checked for cancel every 1000 lines. Defaults to None.
         """
         
         recdata = compile(r"^\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2} \[\d{4}-\d{2}-\d{2} (?P<time>\d{2}:\d{2}:\d{2},\d{3})\].*received data (?P<cmd>\{.*\})")
@@ -494,6 +473,8 @@ class SimulationEventsApi(MethodView):
             lineno = 0
             for line in stream:
                 lineno += 1
+                if job and lineno % 1000 == 0:
+                    job.checkcancel()
                 
                 recdata_match = recdata.match(line) # received data
                 
@@ -591,27 +572,15 @@ class SimulationEventsApi(MethodView):
                     db.session.rollback()
                     return jsonify(status='fail', cause='Overwrite events?', confirm=True)
 
-                # user has confirmed overwrite, so delete existing events for this simulation
-                SimulationEvent.query.filter_by(simulation_id=simid).delete()
-                
                 filepath = join('/tmp', request.form['data[keyless][file]'])
                 ext = filepath.rsplit('.', 1)[1].lower()
-                
-                if ext == 'csv':
-                    # import csv file
-                    self.import_csv_file(filepath, simid)
-                
-                elif ext == 'txt':
-                    # import tmtility log (txt) file
-                    self.import_log_file(filepath, simid)
-                    
-                else:
+                if ext not in self.ALLOWED_EXTENSIONS:
                     raise ParameterError(f"unsupported file extension '{ext}'")
 
-                # commit changes to database, delete temporary file, and declare success
-                db.session.commit()
-                remove(filepath)
-                return jsonify(status='success')
+                # user has confirmed overwrite, import is done in the background, see simulationevents_job()
+                db.session.rollback()
+                job = submitjob('simulationevents', simid=int(simid), filepath=filepath, start_time=self.start_time)
+                return jsonify(status='success', job=job.id)
             
             else:
                 raise ParameterError('invalid action')
@@ -629,6 +598,43 @@ class SimulationEventsApi(MethodView):
 simulationevents_api = SimulationEventsApi.as_view('_simulationevents')
 bp.add_url_rule('/_simulationevents', view_func=simulationevents_api, methods=['POST','GET'])
 
+@jobfunction('simulationevents')
+def simulationevents_job(job, simid, filepath, start_time):
+    """replace simulation events with those in the uploaded file, see SimulationEventsApi
+
+    Args:
+        job (JobContext): job context
+        simid (int): simulation id
+        filepath (str): uploaded csv or tmtility log (txt) file
+        start_time (float): race start time, seconds, used for log file import
+
+    Returns:
+        dict: {'events': number of events for the simulation}
+    """
+    importer = SimulationEventsApi()
+    importer.start_time = start_time
+
+    try:
+        # delete existing events for this simulation
+        SimulationEvent.query.filter_by(simulation_id=simid).delete()
+        
+        ext = filepath.rsplit('.', 1)[1].lower()
+        if ext == 'csv':
+            # import csv file
+            importer.import_csv_file(filepath, simid, job=job)
+        
+        else:
+            # import tmtility log (txt) file
+            importer.import_log_file(filepath, simid, job=job)
+        
+        # commit changes to database
+        db.session.commit()
+        return {'events': SimulationEvent.query.filter_by(simulation_id=simid).count()}
+    
+    # delete temporary file, even if the import failed or was cancelled
+    finally:
+        remove(filepath)
+
 
 simulationexpected_dbattrs = 'id,simulation,order,time,epsilon,bibno'.split(',')
 simulationexpected_formfields = 'rowid,simulation,order,time,epsilon,bibno'.split(',')
@@ -776,36 +782,11 @@ class SimulationExpectedApi(MethodView):
                     db.session.rollback()
                     return jsonify(status='fail', cause='Overwrite expected results?', confirm=True)
 
+                # import is done in the background, see simulationexpected_job()
+                db.session.rollback()
                 filepath = join('/tmp', request.form['data[keyless][file]'])
-                with open(filepath, newline='') as stream:
-                    csvfile = DictReader(stream)
-                    header = csvfile.fieldnames
-                    # check for required fields
-                    if 'order' not in header or 'time' not in header or 'bibno' not in header:
-                        raise ParameterError('missing required field')
-                    
-                    # delete all existing expected entries for this simulation
-                    db.session.query(SimulationExpected).filter(SimulationExpected.simulation_id == simid).delete()
-                    
-                    # read to end of file
-                    lineno = 1  # skip header
-                    for line in csvfile:
-                        lineno += 1
-                        
-                        # create new SimulationExpected object
-                        simexpected = SimulationExpected(
-                            simulation_id = simid,
-                            order = line['order'],
-                            time = timesecs(line['time']),
-                            bibno = line['bibno'],
-                            epsilon = line['epsilon'] if 'epsilon' in line and line['epsilon'] else 0,
-                        )
-                        db.session.add(simexpected)
-                        
-                # commit changes to database, delete temporary file, and declare success
-                db.session.commit()
-                remove(filepath)
-                return jsonify(status='success')
+                job = submitjob('simulationexpected', simid=int(simid), filepath=filepath)
+                return jsonify(status='success', job=job.id)
             
             else:
                 raise ParameterError('invalid action')
@@ -826,6 +807,64 @@ class SimulationExpectedApi(MethodView):
 simulationexpected_api = SimulationExpectedApi.as_view('_simulationexpected')
 bp.add_url_rule('/_simulationexpected', view_func=simulationexpected_api, methods=['POST','GET'])
 
+@jobfunction('simulationexpected')
+def simulationexpected_job(job, simid, filepath):
+    """replace simulation expected results with those in the uploaded file, see SimulationExpectedApi
+
+    Args:
+        job (JobContext): job context
+        simid (int): simulation id
+        filepath (str): uploaded csv file
+
+    Returns:
+        dict: {'expected': number of expected results imported}
+    """
+    lineno = 0
+    try:
+        with open(filepath, newline='') as stream:
+            csvfile = DictReader(stream)
+            header = csvfile.fieldnames
+            # check for required fields
+            if 'order' not in header or 'time' not in header or 'bibno' not in header:
+                raise ParameterError('missing required field')
+            
+            # delete all existing expected entries for this simulation
+            db.session.query(SimulationExpected).filter(SimulationExpected.simulation_id == simid).delete()
+            
+            # read to end of file
+            lineno = 1  # skip header
+            for line in csvfile:
+                lineno += 1
+                if lineno % 1000 == 0:
+                    job.checkcancel()
+                
+                # create new SimulationExpected object
+                simexpected = SimulationExpected(
+                    simulation_id = simid,
+                    order = line['order'],
+                    time = timesecs(line['time']),
+                    bibno = line['bibno'],
+                    epsilon = line['epsilon'] if 'epsilon' in line and line['epsilon'] else 0,
+                )
+                db.session.add(simexpected)
+    
+        # commit changes to database
+        db.session.commit()
+        return {'expected': lineno - 1}
+    
+    except JobCancelled:
+        raise
+    
+    # job error is shown to the user, so say where the problem is
+    except Exception as e:
+        if lineno:
+            raise ParameterError(f'processing line {lineno}: {e}') from e
+        raise
+    
+    # delete temporary file, even if the import failed or was cancelled
+    finally:
+        remove(filepath)
+
 
 # note user.name and simulation.name are used rather than _treatment/relationship as this is a read only view
 simulationrun_dbattrs = 'id,user.name,simulation.name,start_time,timestarted,timeended,score'.split(',')
@@ -1200,29 +1239,12 @@ class SimFinishApi(MethodView):
             if not self.permission():
                 raise ParameterError('permission denied')
             
-            # get simulation run results
-            simrun_results = db.session.query(SimulationResult).filter(SimulationResult.simulationrun_id == self.simrun.id).order_by(SimulationResult.order).all()
-            num_results = len(simrun_results)
-            
-            # get expected results
-            simulation_id = self.simrun.simulation_id
-            expected_results = db.session.query(SimulationExpected).filter(SimulationExpected.simulation_id == simulation_id).order_by(SimulationExpected.order).all()
-            num_expected = len(expected_results)
-            
-            discrepancies = compare_sim_results_with_expected(expected_results, simrun_results)
-            # for debugging
-            current_app.logger.debug(f'Simulation run {self.simrun.userstart} discrepancies: {discrepancies}, num_results={num_results}, num_expected={num_expected}')
-            
-            # calculate score
-            num_errors = len(discrepancies['time_mismatches']) + len(discrepancies['missing_from_sim']) + len(discrepancies['extra_in_sim'])
-            # blank bibs don't count against score
-            divisor = max(num_expected, num_results-len(discrepancies['blank_bibno']))  
-            num_correct = divisor - num_errors if divisor > num_errors else 0
-            self.simrun.score = (num_correct / divisor) * 100 if divisor > 0 else 0
+            # run ended now, scoring is done in the background, see simfinish_job()
             self.simrun.timeended = datetime.now()
             db.session.commit()
+            job = submitjob('simfinish', simrun_id=self.simrun.id)
             
-            return jsonify({'status': 'success', 'score': f'{round(self.simrun.score)}%', })
+            return jsonify({'status': 'success', 'job': job.id, })
     
         except Exception as e:
             # report exception
@@ -1237,6 +1259,44 @@ class SimFinishApi(MethodView):
 simfinish_api = SimFinishApi.as_view('_simfinish')
 bp.add_url_rule('/_simfinish', view_func=simfinish_api, methods=['POST'])
 
+@jobfunction('simfinish')
+def simfinish_job(job, simrun_id):
+    """calculate score for a simulation run, see SimFinishApi
+
+    Args:
+        job (JobContext): job context
+        simrun_id (int): simulation run id
+
+    Returns:
+        dict: {'score': score as percent string}
+    """
+    simrun = db.session.get(SimulationRun, simrun_id)
+    
+    # get simulation run results
+    simrun_results = db.session.query(SimulationResult).filter(SimulationResult.simulationrun_id == simrun.id).order_by(SimulationResult.order).all()
+    num_results = len(simrun_results)
+    
+    # get expected results
+    simulation_id = simrun.simulation_id
+    expected_results = db.session.query(SimulationExpected).filter(SimulationExpected.simulation_id == simulation_id).order_by(SimulationExpected.order).all()
+    num_expected = len(expected_results)
+    job.checkcancel()
+    
+    discrepancies = compare_sim_results_with_expected(expected_results, simrun_results)
+    job.checkcancel()
+    # for debugging
+    current_app.logger.debug(f'Simulation run {simrun.userstart} discrepancies: {discrepancies}, num_results={num_results}, num_expected={num_expected}')
+    
+    # calculate score
+    num_errors = len(discrepancies['time_mismatches']) + len(discrepancies['missing_from_sim']) + len(discrepancies['extra_in_sim'])
+    # blank bibs don't count against score
+    divisor = max(num_expected, num_results-len(discrepancies['blank_bibno']))  
+    num_correct = divisor - num_errors if divisor > num_errors else 0
+    simrun.score = (num_correct / divisor) * 100 if divisor > 0 else 0
+    db.session.commit()
+    
+    return {'score': f'{round(simrun.score)}%'}
+
 class SimPostResultApi(PostResultApi):
     def set_query(self):
         """initializes query parameters to retrieve Result records
@@ -1264,6 +1324,15 @@ class SimPostResultApi(PostResultApi):
         result.simulationrun_id = msg['simulationrun_id']
         return result
 
+    def get_source_ids(self):
+        """return the message's simulation run
+
+        Returns:
+            {'simulationrun_id': id}
+        """
+        msg = request.json
+        return {'simulationrun_id': msg['simulationrun_id']}
+
 simpostresult_api = SimPostResultApi.as_view('_simpostresult')
 bp.add_url_rule('/_simpostresult', view_func=simpostresult_api, methods=['POST',])
 
@@ -1292,6 +1361,15 @@ class SimPostBibApi(PostBibApi):
         scannedbib.simulationrun_id = msg['simulationrun_id']
 
         return scannedbib
+
+    def get_source_ids(self):
+        """return the message's simulation run
+
+        Returns:
+            {'simulationrun_id': id}
+        """
+        msg = request.json
+        return {'simulationrun_id': msg['simulationrun_id']}
     
 simpostbib_api = SimPostBibApi.as_view('_simpostbib')
 bp.add_url_rule('/_simpostbib', view_func=simpostbib_api, methods=['POST',])
@@ -1391,5 +1469,20 @@ class SimScanActionApi(ScanActionApi):
         """
         return {'simulationrun': source}
 
+    def get_lock(self, resultid):
+        """return the lock for the result's simulation run
+        
+        Args:
+            resultid (int): id of result
+            
+        Returns:
+            ResultsLock
+        """
+        simulationrun_id = db.session.execute(
+            sqlselect(Result.simulationrun_id)
+            .where(Result.id == resultid)
+        ).scalar_one_or_none()
+        return resultslock(simulationrun_id=simulationrun_id)
+
 scanaction_api = SimScanActionApi.as_view('_simscanaction')
 bp.add_url_rule('/_simscanaction', view_func=scanaction_api, methods=['POST',])
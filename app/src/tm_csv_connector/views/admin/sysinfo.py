@@ -13,6 +13,8 @@ from flask_security import roles_accepted
 # home grown
 from . import bp
 from ...model import db
+from ...fileformat import getlockstats
+from ...dbstats import getstatementstats
 from ...version import __version__
 from loutilities.flask_helpers.blueprints import add_url_rules
 from loutilities.user.roles import ROLE_SUPER_ADMIN
@@ -85,6 +87,31 @@ class ViewDebug(MethodView):
                 sessionconfig.append({'label':key, 'value':value})
             sysvars.append(['flask.session',sessionconfig])
             
+            # collect results lock statistics for this worker process
+            lockstats = getlockstats()
+            lockkeys = list(lockstats.keys())
+            lockkeys.sort()
+            lockconfig = []
+            for key in lockkeys:
+                keystats = lockstats[key]
+                value = (f'count={keystats["count"]} '
+                         f'wait avg/max={keystats["wait_avg"]:.3f}/{keystats["wait_max"]:.3f}s '
+                         f'hold avg/max={keystats["hold_avg"]:.3f}/{keystats["hold_max"]:.3f}s')
+                lockconfig.append({'label':key, 'value':value})
+            sysvars.append(['results locks (this process)',lockconfig])
+            
+            # collect SQL statement counts for this worker process
+            statementstats = getstatementstats()
+            statementkeys = list(statementstats.keys())
+            statementkeys.sort()
+            statementconfig = []
+            for key in statementkeys:
+                keystats = statementstats[key]
+                value = (f'count={keystats["count"]} '
+                         f'statements avg/max={keystats["statements_avg"]:.1f}/{keystats["statements_max"]}')
+                statementconfig.append({'label':key, 'value':value})
+            sysvars.append(['SQL statements (this process)',statementconfig])
+            
             # commit database updates and close transaction
             db.session.commit()
             return render_template('sysinfo.jinja2',pagename='Debug',
@@ -6,48 +6,74 @@ This module contains common view classes and methods for the TM CSV Connector ap
 # standard
 from copy import copy
 from traceback import format_exception_only, format_exc
-from os.path import join
+from datetime import datetime, timedelta
 
 # pypi
 from flask import current_app, jsonify, request
 from flask.views import MethodView
-from dominate.tags import div, button, span, p
-from dominate.util import text
-from sqlalchemy import select as sqlselect
+from dominate.tags import div, p
+from dominate.util import escape
+from sqlalchemy import func, update, delete, case, true, false, or_, select as sqlselect
+from sqlalchemy.orm import joinedload
+from sqlalchemy.exc import DataError
+from werkzeug.exceptions import BadRequest
 
 # homegrown
-from ..model import db, Result, ScannedBib, Setting
-from ..fileformat import filelock, refreshfile, lock, unlock
+from ..model import db, Result, ScannedBib, Setting, ResultTombstone, ResultChange, ClientMessage
+from ..fileformat import refreshfile, clearfile, lock, unlock, resultslock
+from ..sequence import nextplace, nextorder, resetsequence
+from ..dbstats import countstatements
+from ..resultstream import publishchange
 from ..times import asc2time, time2asc
 
 class ParameterError(Exception): pass
 
 BLANK_BIBNO = '0000' # blank bibno, used to indicate no bibno was scanned
+SINCE_FORMAT = '%Y-%m-%d %H:%M:%S' # since token for results delta retrieval, see ResultsView.open()
+
+# scanned_bibno() cell, matches what dominate rendered: span.scannedbib > span > 3 buttons + bibno
+# actions processed in api.ScanActionApi.post()
+_SCAN_BUTTON = ('<button class="ui-button ui-corner-all ui-widget scan-action-btn {{state}}" '
+                'onclick="scan_action(event, {{{{action: &quot;{action}&quot;, resultid: {{resultid}}, scanid: {{scanid}}}}}})" '
+                'type="button">{label}</button>')
+SCANNED_BIBNO_TEMPLATE = ''.join([
+    '<span class="scannedbib"><span style="margin-left: 2px;">',
+    _SCAN_BUTTON.format(action='use', label='Use').replace('{state}', '{use_state}'),
+    _SCAN_BUTTON.format(action='insert', label='Ins').replace('{state}', '{ins_state}'),
+    _SCAN_BUTTON.format(action='delete', label='Del').replace('{state}', '{del_state}'),
+    '{bibno}</span></span>',
+])
+
+# rendered scanned_bibno cells, keyed by everything the cell depends on
+SCANNED_BIBNO_CACHE_SIZE = 20000
+_scanned_bibno_cache = {}
+
+# accept_clientmessage() calls in this process, for pruning ClientMessage
+_clientmessage_accepts = 0
 
 def scanned_bibno(dbrow):
-    bibno = dbrow.scannedbib.bibno if dbrow.scannedbib else ''
-    scanid = dbrow.scannedbib.id if dbrow.scannedbib else 'null'
+    scannedbib = dbrow.scannedbib
+    bibno = scannedbib.bibno if scannedbib else ''
+    scanid = scannedbib.id if scannedbib else 'null'
+    
+    key = (dbrow.id, dbrow.had_scannedbib, dbrow.is_confirmed, dbrow.bibno, scanid, bibno)
+    render = _scanned_bibno_cache.get(key, False)
+    if render is not False:
+        return render
     
     # if scannedbib has been received for this row, show the scanned bib number and buttons
     render = None
     if dbrow.had_scannedbib:
-        scannedbib = span(_class="scannedbib", __pretty=False)
         use_state = 'ui-state-disabled' if bibno == dbrow.bibno or bibno == BLANK_BIBNO or not bibno or dbrow.is_confirmed else ''
-        ins_state = ''
-        del_state = ''
-        with scannedbib:
-            with span(style="margin-left: 2px;"):
-                # actions processed in api.ScanActionApi.post()
-                button('Use', type='button', _class=f"ui-button ui-corner-all ui-widget scan-action-btn {use_state}",
-                        onclick=f'scan_action(event, {{action: "use", resultid: {dbrow.id}, scanid: {scanid}}})')
-                button('Ins', type='button', _class=f"ui-button ui-corner-all ui-widget scan-action-btn {ins_state}",
-                        onclick=f'scan_action(event, {{action: "insert", resultid: {dbrow.id}, scanid: {scanid}}})')
-                button('Del', type='button', _class=f"ui-button ui-corner-all ui-widget scan-action-btn {del_state}",
-                        onclick=f'scan_action(event, {{action: "delete", resultid: {dbrow.id}, scanid: {scanid}}})')
-                text(f'{bibno}')
-    
-        render = scannedbib.render()
+        render = SCANNED_BIBNO_TEMPLATE.format(
+            use_state=use_state, ins_state='', del_state='',
+            resultid=dbrow.id, scanid=scanid, bibno=escape(f'{bibno}'),
+        )
     
+    # rows only change a few at a time, so just start over when the cache is full
+    if len(_scanned_bibno_cache) >= SCANNED_BIBNO_CACHE_SIZE:
+        _scanned_bibno_cache.clear()
+    _scanned_bibno_cache[key] = render
     return render
 
 def get_results_posttablehtml():
@@ -75,14 +101,317 @@ results_formmapping = dict(zip(results_formfields, results_dbattrs))
 results_dbmapping['time'] = lambda formrow: asc2time(formrow['time'])
 results_formmapping['time'] = lambda dbrow: time2asc(dbrow.time)
 results_formmapping['scanned_bibno'] = scanned_bibno
-results_formmapping['is_confirmed'] = lambda dbrow: '<i class="fa-solid fa-file-circle-check"></i>' \
-    if dbrow.is_confirmed else ''
-results_formmapping['bibalert'] = lambda dbrow: '<i class="fa-solid fa-not-equal checkscanned"></i>' \
-    if dbrow.scannedbib and dbrow.scannedbib.bibno != dbrow.bibno and dbrow.scannedbib.bibno != BLANK_BIBNO else ''
+IS_CONFIRMED_HTML = '<i class="fa-solid fa-file-circle-check"></i>'
+BIBALERT_HTML = '<i class="fa-solid fa-not-equal checkscanned"></i>'
+def bibalert(dbrow):
+    scannedbib = dbrow.scannedbib
+    return BIBALERT_HTML if scannedbib and scannedbib.bibno != dbrow.bibno and scannedbib.bibno != BLANK_BIBNO else ''
+results_formmapping['is_confirmed'] = lambda dbrow: IS_CONFIRMED_HTML if dbrow.is_confirmed else ''
+results_formmapping['bibalert'] = bibalert
+
+def reconcile_queue(race_id=None, simulationrun_id=None):
+    """pair the earliest Result which hasn't had a scanned bib with the earliest ScannedBib which
+    hasn't been assigned to a Result
+    
+    called after each Result or ScannedBib is added, so there is at most one of these queued, and 
+    it will be the newly added row. Caller needs to commit
+    
+    NOTE: caller must acquire/release resultslock() for the race or simulation run
+    
+    Args:
+        race_id (int, optional): race id, for race results. Defaults to None.
+        simulationrun_id (int, optional): simulation run id, for simulation results. Defaults to None.
+
+    Returns:
+        Result: the result which was assigned a scanned bib, or None
+    """
+    source = {'simulationrun_id': simulationrun_id} if simulationrun_id else {'race_id': race_id}
+    
+    # session doesn't autoflush, and the caller may have just added the row
+    db.session.flush()
+    
+    result = (Result.query.filter_by(**source).filter(Result.had_scannedbib == False)
+              .populate_existing().with_for_update()
+              .order_by(Result.place).first())
+    if not result:
+        return None
+    
+    # scanned bibs after the last one which was assigned are queued
+    lastresult = (Result.query.filter_by(**source).filter(Result.scannedbib_id.isnot(None))
+                  .order_by(Result.place.desc()).first())
+    filters = [ScannedBib.order > lastresult.scannedbib.order] if lastresult else []
+    scannedbib = (ScannedBib.query.filter_by(**source).filter(*filters)
+                  .populate_existing().with_for_update()
+                  .order_by(ScannedBib.order).first())
+    if not scannedbib:
+        return None
+    
+    result.scannedbib = scannedbib
+    result.had_scannedbib = True
+    db.session.flush()
+    return result
+
+def _sourcefilters(model, race_id, simulationrun_id):
+    if simulationrun_id:
+        return [model.simulationrun_id == simulationrun_id]
+    return [model.race_id == race_id]
+
+def _renumberorders(race_id=None, simulationrun_id=None):
+    """renumber ScannedBib.order 1, 2, 3... for a race or simulation run, when the gap between 
+    two orders is too small to insert between them
+
+    Args:
+        race_id (int, optional): race id, for race results. Defaults to None.
+        simulationrun_id (int, optional): simulation run id, for simulation results. Defaults to None.
+    """
+    numbered = (
+        sqlselect(ScannedBib.id, func.row_number().over(order_by=ScannedBib.order).label('neworder'))
+        .where(*_sourcefilters(ScannedBib, race_id, simulationrun_id))
+        .subquery()
+    )
+    db.session.execute(
+        update(ScannedBib)
+        .where(ScannedBib.id == numbered.c.id)
+        .values(order=numbered.c.neworder)
+        .execution_options(synchronize_session=False)
+    )
+    # max order may have changed
+    resetsequence(race_id=race_id, simulationrun_id=simulationrun_id)
+
+def order_before(scannedbib, race_id=None, simulationrun_id=None):
+    """return an order value between scannedbib and the ScannedBib before it
+    
+    ScannedBib.order has gaps, so a scanned bib can be inserted without renumbering the later 
+    scanned bibs. The orders are renumbered only if there's no room left between the two
+
+    Args:
+        scannedbib (ScannedBib): scanned bib to insert before
+        race_id (int, optional): race id, for race results. Defaults to None.
+        simulationrun_id (int, optional): simulation run id, for simulation results. Defaults to None.
+
+    Returns:
+        float: order value
+    """
+    prevorder = db.session.execute(
+        sqlselect(func.max(ScannedBib.order))
+        .where(ScannedBib.order < scannedbib.order, *_sourcefilters(ScannedBib, race_id, simulationrun_id))
+    ).scalar()
+    if prevorder is None:
+        return scannedbib.order - 1
+    
+    order = (prevorder + scannedbib.order) / 2
+    if prevorder < order < scannedbib.order:
+        return order
+    
+    # out of precision, make room
+    _renumberorders(race_id=race_id, simulationrun_id=simulationrun_id)
+    db.session.refresh(scannedbib)
+    return scannedbib.order - 0.5
+
+def shift_scannedbibs(place, direction, race_id=None, simulationrun_id=None):
+    """move the scanned bibs assigned to the result at place and the later results by one result, 
+    using a single statement rather than updating each result
+    
+    for direction 'later', each of these results gets the scanned bib of the result before it, and 
+    the first result which hadn't had a scanned bib gets the last one. The result at place is not updated,
+    caller assigns its new scanned bib
+    
+    for direction 'earlier', each of these results gets the scanned bib of the result after it, and 
+    the last result which had a scanned bib no longer has one
+    
+    NOTE: caller must flush before calling, and objects for these results are stale after
+
+    Args:
+        place (int): place of the result where the shift starts
+        direction (str): 'later' or 'earlier'
+        race_id (int, optional): race id, for race results. Defaults to None.
+        simulationrun_id (int, optional): simulation run id, for simulation results. Defaults to None.
+    """
+    if direction == 'later':
+        window = func.lag
+    else:
+        window = func.lead
+    
+    # materialized, so this can be joined to the table being updated
+    neighbors = (
+        sqlselect(
+            Result.id,
+            Result.had_scannedbib,
+            window(Result.scannedbib_id).over(order_by=Result.place).label('neighbor_scannedbib_id'),
+            window(Result.had_scannedbib).over(order_by=Result.place).label('neighbor_had_scannedbib'),
+        )
+        .where(Result.place >= place, *_sourcefilters(Result, race_id, simulationrun_id))
+        .subquery()
+    )
+    
+    if direction == 'later':
+        db.session.execute(
+            update(Result)
+            .where(Result.id == neighbors.c.id, Result.place > place, neighbors.c.neighbor_had_scannedbib == true())
+            .values(scannedbib_id=neighbors.c.neighbor_scannedbib_id, had_scannedbib=True)
+            .execution_options(synchronize_session=False)
+        )
+    else:
+        db.session.execute(
+            update(Result)
+            .where(Result.id == neighbors.c.id, neighbors.c.had_scannedbib == true())
+            .values(
+                scannedbib_id=case((neighbors.c.neighbor_had_scannedbib == true(), neighbors.c.neighbor_scannedbib_id), else_=None),
+                had_scannedbib=func.coalesce(neighbors.c.neighbor_had_scannedbib, false()),
+            )
+            .execution_options(synchronize_session=False)
+        )
+
+def renumber_places(fromtime, queryparams, queryfilters=[]):
+    """set Result.place in (time, tmpos) order, using a single statement for the results at or after 
+    fromtime. The earlier results keep their places
+    
+    uses ROW_NUMBER(), so needs MySQL 8 or SQLite 3.33 (for UPDATE ... FROM)
+
+    Args:
+        fromtime (float): earliest time which may have changed, None to renumber all results
+        queryparams (dict): identifies the race or simulation run, e.g., {'race_id': race_id}
+        queryfilters (list, optional): additional filters. Defaults to [].
+    """
+    filters = list(queryfilters)
+    offset = 0
+    if fromtime is not None:
+        offset = db.session.execute(
+            sqlselect(func.count(Result.id))
+            .filter_by(**queryparams)
+            .where(*filters, Result.time < fromtime)
+        ).scalar()
+        filters.append(Result.time >= fromtime)
+    
+    numbered = (
+        sqlselect(Result.id, (func.row_number().over(order_by=(Result.time, Result.tmpos)) + offset).label('newplace'))
+        .filter_by(**queryparams)
+        .where(*filters)
+        .subquery()
+    )
+    
+    # only write the rows whose place changed
+    db.session.execute(
+        update(Result)
+        .where(Result.id == numbered.c.id, or_(Result.place == None, Result.place != numbered.c.newplace))
+        .values(place=numbered.c.newplace)
+        .execution_options(synchronize_session=False)
+    )
+
+def confirm_results(place, race_id=None, simulationrun_id=None):
+    """confirm the unconfirmed results up to and including place, for a race or simulation run
+    
+    only the columns needed for the output file are retrieved, rather than Result objects, and
+    the results are confirmed with a single statement. Caller needs to commit
+    
+    NOTE: caller must acquire/release resultslock() for the race or simulation run
+
+    Args:
+        place (int): place of last result to confirm
+        race_id (int, optional): race id, for race results. Defaults to None.
+        simulationrun_id (int, optional): simulation run id, for simulation results. Defaults to None.
+
+    Returns:
+        [Row, ...]: confirmed results in place order, with id, race_id, simulationrun_id, tmpos, bibno, time
+    """
+    confirmed = db.session.execute(
+        sqlselect(Result.id, Result.race_id, Result.simulationrun_id, Result.tmpos, Result.bibno, Result.time)
+        .where(*_sourcefilters(Result, race_id, simulationrun_id), Result.place <= place, Result.is_confirmed == False)
+        .order_by(Result.place)
+        .with_for_update()
+    ).all()
+    
+    if confirmed:
+        db.session.execute(
+            update(Result)
+            .where(Result.id.in_([r.id for r in confirmed]))
+            .values(is_confirmed=True)
+        )
+    return confirmed
+
+# errors caused by the contents of a reader client message, which retrying won't fix
+# the client drops a message which fails with one of these, see outbox.py in the clients
+INVALID_MESSAGE_ERRORS = (KeyError, ValueError, TypeError, ParameterError, BadRequest, DataError)
+
+def accept_clientmessage(msg):
+    """check a message from a reader client hasn't already been applied, and record it. Caller needs to commit
+    
+    the clients replay their outbox until a message is acknowledged, so a message may arrive 
+    more than once. If the same message is being applied concurrently, the unique key on 
+    (client, seq) fails the flush, and the client retries
+    
+    Args:
+        msg (dict): message from client, 'client' and 'seq' are removed
+
+    Returns:
+        bool: True if the message should be applied, False if it was already applied
+    """
+    client = msg.pop('client', None)
+    seq = msg.pop('seq', None)
+    
+    # message not from an outbox, e.g., simulation
+    if client is None or seq is None:
+        return True
+    
+    if db.session.execute(sqlselect(ClientMessage.id).filter_by(client=client, seq=seq)).first():
+        current_app.logger.info(f'ignoring replayed message: client {client} seq {seq}')
+        return False
+    
+    db.session.add(ClientMessage(client=client, seq=seq))
+    db.session.flush()
+    
+    # forget messages old enough that they won't be replayed, separately from the caller's transaction
+    global _clientmessage_accepts
+    _clientmessage_accepts += 1
+    if _clientmessage_accepts % current_app.config.get('CLIENTMESSAGE_PRUNE_EVERY', 100) == 0:
+        keep = timedelta(days=current_app.config.get('CLIENTMESSAGE_KEEP_DAYS', 30))
+        with db.engine.connect() as conn:
+            now = conn.execute(sqlselect(func.now())).scalar()
+            conn.execute(delete(ClientMessage).where(ClientMessage.receive_time < now - keep))
+            conn.commit()
+    
+    return True
+
+def results_version(queryparams):
+    """return a version token for the results of a race or simulation run, which changes
+    whenever a result is added, updated or deleted
+    
+    the change log id catches changes made by the write apis, and the count and last update time 
+    catch anything else
+
+    Args:
+        queryparams (dict): identifies the race or simulation run, e.g., {'race_id': race_id}
+
+    Returns:
+        str: version token
+    """
+    count, lastupdate = db.session.execute(
+        sqlselect(func.count(Result.id), func.max(Result.update_time))
+        .filter_by(**queryparams)
+    ).one()
+    changeid = db.session.execute(
+        sqlselect(func.max(ResultChange.id))
+        .filter_by(**queryparams)
+    ).scalar()
+    lastupdate = lastupdate.strftime('%Y%m%d%H%M%S') if lastupdate else ''
+    source = '-'.join(f'{k}{v}' for k, v in sorted(queryparams.items()))
+    return f'{source}-{changeid}-{count}-{lastupdate}'
 
 
 class ResultsView():
     
+    def get_lock(self):
+        """must be overridden to
+        return the lock for the current race or simulation run
+        
+        Returns:
+            ResultsLock, see fileformat.resultslock()
+
+        Raises:
+            NotImplementedError: if not implemented by inheriting class
+        """
+        raise NotImplementedError
+    
     def check_confirmed(self, thisid):
         # flag for editor_method_postcommit; only rewrite file if a previously
         # confirmed entry was edited
@@ -94,83 +423,104 @@ class ResultsView():
                 sqlselect(Result)
                 .where(Result.id == thisid)
             ).one()[0]
+            
+            # places are renumbered from the earlier of the row's original and new time
+            self.renumberids = getattr(self, 'renumberids', []) + [thisid]
+            self.renumbertimes = getattr(self, 'renumbertimes', []) + [self.result.time]
 
             # if the operator edited a previously confirmed entry, the file needs to be rewritten
-            # the rewrite happens in editor_method_postcommit()
+            # the rewrite happens in editor_method_postcommit(), starting from this row's original place
             if self.result.is_confirmed:
                 self.rewritefile = True
+                self.rewriteplace = self.result.place
                 
+    def get_since(self):
+        """check for delta retrieval, i.e., /rest?since=<token>
+        
+        since token is from the previous delta response; empty since token retrieves all rows
+        in delta format. Any other since value (older clients) retrieves the full list
+
+        Returns:
+            (delta, since): delta is True for delta retrieval, since is datetime or None for all rows
+        """
+        if request.path[-5:] != '/rest' or 'since' not in request.args:
+            return False, None
+        
+        since = request.args['since']
+        if not since:
+            return True, None
+        try:
+            return True, datetime.strptime(since, SINCE_FORMAT)
+        except ValueError:
+            return False, None
+    
     def open(self):
         '''
         retrieve all the data in the indicated table
         
         adapted from loutilities.tables.DbCrudApi.open()
         
+        for delta retrieval (see self.get_since()) only rows updated since the token are returned, 
+        with the ids of rows deleted since then, as {'data': [rows], 'deleted': [ids], 'since': token}
+        
+        for /rest, responds 304 if the results haven't changed since the version in If-None-Match, see self.get()
+        
         NOTE: assumes not server table
         '''
+        self.delta, since = self.get_since()
+        
+        # conditional retrieval; the delta and full responses differ, so the etag does too
+        self.etag = None
+        self.notmodified = False
+        if request.path[-5:] == '/rest':
+            self.etag = ('delta-' if self.delta else 'full-') + results_version(self.queryparams)
+            if request.if_none_match.contains(self.etag):
+                self.notmodified = True
+                self.rows = iter([])
+                return
+        
         # not server table, rows will be handled in nexttablerow()
         # added order_by(Result.place) to ensure the results are in place order
-        query = self.model.query.filter_by(**self.queryparams).filter(*self.queryfilters).order_by(Result.place)
+        # scannedbib is needed for each row by formmapping, so retrieve with the results rather than per row
+        query = (self.model.query.filter_by(**self.queryparams).filter(*self.queryfilters)
+                 .options(joinedload(Result.scannedbib))
+                 .order_by(Result.place))
+        
+        if self.delta:
+            # next token is the latest committed update or delete, in the same snapshot as the rows, backed 
+            # off by RESULTS_SINCE_LOOKBACK. update_time is from the start of the statement, and not all writes 
+            # hold resultslock() until they commit, e.g., the editor commits its own write before
+            # editor_method_postcommit() takes the lock, so a write which commits after this may have an 
+            # update_time a little older than the latest one seen here. Rows within the lookback are sent again
+            latest = [t for t in db.session.execute(sqlselect(
+                sqlselect(func.max(Result.update_time)).filter_by(**self.queryparams).scalar_subquery(),
+                sqlselect(func.max(ResultTombstone.delete_time)).filter_by(**self.queryparams).scalar_subquery(),
+            )).one() if t]
+            lookback = timedelta(seconds=current_app.config.get('RESULTS_SINCE_LOOKBACK', 5))
+            latest = max(latest) - lookback if latest else since
+            self.output_result = {'data': [], 'deleted': [], 'since': latest.strftime(SINCE_FORMAT) if latest else ''}
+            
+            if since:
+                query = query.filter(Result.update_time >= since)
+                self.output_result['deleted'] = [t.result_id for t in 
+                    ResultTombstone.query.filter_by(**self.queryparams).filter(ResultTombstone.delete_time >= since).all()]
+        
         self.rows = iter(query.all())
 
     def get(self):
-        # manage scanned bib queue before get
-        # this can happen if a scanned bib and results are processed in parallel, apparently, 
-        # because the database transactions may be concurrent
-        process_queue = self.set_queue_filters()
-        
-        # only process queue if in valid queue context
-        if process_queue:
-            # lock "file" to mutex with scan and timemachine api
-            lock(filelock)
+        # the number of statements shouldn't depend on the number of rows, see dbstats.py
+        with countstatements(f'GET {request.path}'):
+            response = super().get()
         
-            try:
-                # get the results which don't have a scanned bib
-                results = (Result.query.filter(
-                    Result.had_scannedbib == False, *self.result_queue_filter)
-                           .populate_existing().with_for_update()
-                           .order_by(Result.place).all())
-                resultsi = iter(results)
-                # current_app.logger.debug(f'{self.__class__.__name__}.get(): {len(results)} results without scanned bib')
-                
-                lastresult = (Result.query.filter(Result.scannedbib_id.isnot(None), *self.result_queue_filter)
-                              .populate_existing().with_for_update()
-                              .order_by(Result.place.desc()).first())
-
-                if lastresult:
-                    last_scannedbib = lastresult.scannedbib
-                    filters = [ScannedBib.order > last_scannedbib.order] + self.scannedbib_queue_filter
-                else:
-                    last_scannedbib = None
-                    filters = self.scannedbib_queue_filter
-                    
-                # get the remaining scanned bibs
-                scannedbibs = (ScannedBib.query.filter(*filters)
-                               .populate_existing().with_for_update()
-                               .order_by(ScannedBib.order).all())
-                scannedbibsi = iter(scannedbibs)
-                # current_app.logger.debug(f'{self.__class__.__name__}.get(): {len(scannedbibs)} scannedbibs after last_scannedbib {last_scannedbib}')
-                
-                try:
-                    # loop, adding scannedbibs to results
-                    while True:
-                        scannedbib = next(scannedbibsi)
-                        result = next(resultsi)
-                        
-                        result.scannedbib = scannedbib
-                        result.had_scannedbib = True
-                
-                except StopIteration:
-                    pass
-                    
-                db.session.commit()
-                unlock(filelock)
-                
-            except:
-                unlock(filelock)
-                raise
+        # see self.open()
+        if getattr(self, 'etag', None):
+            if self.notmodified:
+                response = current_app.response_class(status=304)
+            response.set_etag(self.etag)
+            # browser must check with the server before using a cached copy
+            response.cache_control.no_cache = True
         
-        return super().get()
+        return response
 
     def nexttablerow(self):
         """add result_confirmed class to row if is_confirmed
@@ -183,6 +533,10 @@ class ResultsView():
         if row['is_confirmed']:
             row['DT_RowClass'] = 'confirmed'
 
+        # for delta retrieval, loutilities returns self.output_result rather than the rows
+        if getattr(self, 'delta', False):
+            self.output_result['data'].append(row)
+
         return row
     
     def deleterow(self, thisid):
@@ -194,13 +548,22 @@ class ResultsView():
             self._error='cannot delete result which has scanned bib assigned - use Ins first'
             raise ParameterError('cannot delete result which has scanned bib assigned - use Ins first')
             
+        # let polling clients know this row is gone
+        tombstone = ResultTombstone(
+            result_id=thisresult.id,
+            race_id=thisresult.race_id,
+            simulationrun_id=thisresult.simulationrun_id,
+        )
+        db.session.add(tombstone)
+        
         # if edit for previously confirmed entry is done, this will cause the file to be rewritten
         self.check_confirmed(thisid)
         return super().deleterow(thisid)
     
     def editor_method_postcommit(self, form):
         # LOCK file access
-        lock(filelock)
+        thelock = self.get_lock()
+        lock(thelock)
         
         try:
             # # test lock
@@ -209,34 +572,56 @@ class ResultsView():
             # sleep(10)
             # current_app.logger.debug(f'awake')
 
-            # set place
-            rows = (Result.query.filter_by(**self.queryparams).filter(*self.queryfilters)
-                    .populate_existing().with_for_update()
-                    .order_by(Result.time, Result.tmpos).all())
-            place = 1
-            for row in rows:
-                row.place = place
-                place += 1
-            # need flush here else Result query below will not return updated rows
-            db.session.flush()
+            # set place, starting from the earliest time which may have changed
+            # created and edited rows are found by id, as they may have moved
+            renumberids = list(getattr(self, 'renumberids', []))
+            if self.action == 'create':
+                renumberids.append(self.created_id)
+            renumbertimes = list(getattr(self, 'renumbertimes', []))
+            if renumberids:
+                renumbertimes += db.session.execute(
+                    sqlselect(Result.time)
+                    .where(Result.id.in_(renumberids))
+                ).scalars().all()
+            renumbertimes = [t for t in renumbertimes if t is not None]
+            fromtime = min(renumbertimes) if renumbertimes else None
+            renumber_places(fromtime, self.queryparams, self.queryfilters)
+            
+            # places were renumbered, so place sequence needs to be recreated
+            resetsequence(**self.queryparams)
 
             # set had_scannedbib depending on whether the next result had a scanned bib
             if self.action == 'create':
-                thisresult = Result.query.filter_by(id=self.created_id).one()
+                thisresult = Result.query.filter_by(id=self.created_id).populate_existing().one()
                 filters = copy(self.queryfilters)
                 # current_app.logger.debug(f'thisresult.place={thisresult.place}')
                 filters.append(Result.place>thisresult.place)
                 next_result = Result.query.filter_by(**self.queryparams).filter(*filters).order_by(Result.place).first()
                 thisresult.had_scannedbib = next_result and next_result.had_scannedbib
+                
+                # a new last result may take a queued scanned bib
+                if not thisresult.had_scannedbib:
+                    thisresult.had_scannedbib = False
+                    reconcile_queue(**self.queryparams)
             
+            # places may have been renumbered, so let results streams know any row may have changed
+            publishchange('refresh', **self.queryparams)
+
             # commit again
             db.session.commit()
             # note table is refreshed after the create (afterdatatables.js editor.on('postCreate'))
             # so place display is correct
 
             # only rewrite the file if a previously confirmed row has been updated. see self.check_confirmed()
+            # rewrite from the earlier of the row's original and new place, as rows between these have moved
             if self.rewritefile:
-                refreshfile(rows)
+                rows = (Result.query.filter_by(**self.queryparams).filter(*self.queryfilters)
+                        .order_by(Result.place).all())
+                fromplace = self.rewriteplace
+                if self.action == 'edit':
+                    fromplace = min(fromplace, Result.query.filter_by(id=self.result.id).one().place)
+                refreshfile(rows, fromplace=fromplace)
+                db.session.commit()
             
             ## commented out logic was for #9 but the refresh_table_data in afterdatatables.js was removing rows 
             ## not present in the data. Need to revisit this later.
@@ -248,12 +633,13 @@ class ResultsView():
             #     self.getrowssince()
 
             # UNLOCK file access
-            unlock(filelock)
+            unlock(thelock)
             
         except:
             db.session.rollback()
             # UNLOCK file access
-            unlock(filelock)
+            if thelock.held():
+                unlock(thelock)
             raise
 
 
@@ -279,38 +665,50 @@ class PostResultApi(MethodView):
         """
         raise NotImplementedError
 
+    def get_source_ids(self):
+        """must be overridden to
+        return the message's race or simulation run
+
+        Returns:
+            {'race_id': id} or {'simulationrun_id': id}
+        """
+        raise NotImplementedError
+
     def post(self):
+        thelock = None
         try:
             ## LOCK file access
-            current_app.logger.debug(f'{self.__class__.__name__}: requesting lock(filelock)')
-            lock(filelock)
-            current_app.logger.debug(f'{self.__class__.__name__}: lock(filelock) granted')
+            thelock = resultslock(**self.get_source_ids())
+            current_app.logger.debug(f'{self.__class__.__name__}: requesting lock({thelock})')
+            lock(thelock)
+            current_app.logger.debug(f'{self.__class__.__name__}: lock({thelock}) granted')
             
             # receive message
             msg = request.json
+            
+            # already applied, client didn't get the response
+            if not accept_clientmessage(msg):
+                db.session.commit()
+                unlock(thelock)
+                return jsonify(status='success', duplicate=True)
+            
+            # logged only once per message, as the simulation log file import replays these lines
             current_app.logger.debug(f'received data {msg}')
             
-            # get output file pathname
+            # get output file name
             filesetting = Setting.query.filter_by(name='output-file').one_or_none()
-            if filesetting:
-                filepath = join('/output_dir', filesetting.value)
 
             # handle messages from tm-reader-client
             opcode = msg.pop('opcode', None)
             if opcode in ['primary', 'select']:
                 
                 # determine place. if no records yet, create the output file
-                lastrow = (Result.query.filter(*self.set_query())
-                           .populate_existing().with_for_update()
-                           .order_by(Result.place.desc()).first())
-                if lastrow:
-                    place = lastrow.place + 1
-                else:
-                    place = 1
+                place = nextplace(**self.get_source_ids())
+                if place == 1:
                     # create file
                     if filesetting:
-                        with open(filepath, mode='w') as f:
-                            current_app.logger.info(f'creating {filesetting.value}')
+                        current_app.logger.info(f'creating {filesetting.value}')
+                        clearfile()
                     
                 # write to database
                 result = self.new_result()
@@ -321,6 +719,11 @@ class PostResultApi(MethodView):
                 
                 current_app.logger.debug(f'{self.__class__.__name__}: add(result)')
                 db.session.add(result)
+                db.session.flush()
+                
+                # assign queued scanned bib, if any
+                reconcile_queue(**self.get_source_ids())
+                publishchange('insert', result_ids=[result.id], **self.get_source_ids())
             
             # how did this happen?
             else:
@@ -329,18 +732,20 @@ class PostResultApi(MethodView):
             db.session.commit()
                 
             ## UNLOCK file access and return
-            current_app.logger.debug(f'{self.__class__.__name__}: unlock(filelock)')
-            unlock(filelock)
+            current_app.logger.debug(f'{self.__class__.__name__}: unlock({thelock})')
+            unlock(thelock)
             return jsonify(status='success')
 
         except Exception as e:
-            ## UNLOCK file access
-            current_app.logger.debug(f'{self.__class__.__name__}: unlock(filelock) [exception]')
-            unlock(filelock)
+            ## UNLOCK file access, if the exception wasn't from getting it
+            if thelock and thelock.held():
+                current_app.logger.debug(f'{self.__class__.__name__}: unlock({thelock}) [exception]')
+                unlock(thelock)
             
-            # report exception
+            # report exception, client retries unless the message itself is bad
             exc = ''.join(format_exception_only(type(e), e))
-            output_result = {'status' : 'fail', 'error': 'exception occurred:<br>{}'.format(exc)}
+            output_result = {'status' : 'fail', 'error': 'exception occurred:<br>{}'.format(exc),
+                             'invalid': isinstance(e, INVALID_MESSAGE_ERRORS)}
             
             # roll back database updates and close transaction
             db.session.rollback()
@@ -378,30 +783,43 @@ class PostBibApi(MethodView):
         """Override to return True when a duplicate bib scan should be silently ignored."""
         return False
 
+    def get_source_ids(self):
+        """must be overridden to
+        return the message's race or simulation run
+
+        Returns:
+            {'race_id': id} or {'simulationrun_id': id}
+
+        Raises:
+            NotImplementedError: if not implemented by inheriting class
+        """
+        raise NotImplementedError
+
     def post(self):
+        thelock = None
 
         try:
             ## LOCK file access
-            current_app.logger.debug(f'{self.__class__.__name__}: requesting lock(filelock)')
-            lock(filelock)
-            current_app.logger.debug(f'{self.__class__.__name__}: lock(filelock) granted')
+            thelock = resultslock(**self.get_source_ids())
+            current_app.logger.debug(f'{self.__class__.__name__}: requesting lock({thelock})')
+            lock(thelock)
+            current_app.logger.debug(f'{self.__class__.__name__}: lock({thelock}) granted')
 
             # receive message
             msg = request.json
+            
+            # already applied, client didn't get the response
+            if not accept_clientmessage(msg):
+                db.session.commit()
+                unlock(thelock)
+                return jsonify(status='success', duplicate=True)
+            
+            # logged only once per message, as the simulation log file import replays these lines
             current_app.logger.debug(f'received data {msg}')
             
             # handle messages from barcode-scanner-client
             opcode = msg.pop('opcode', None)
             if opcode in ['scannedbib']:
-                # determine place. if no records yet, create the output file
-                lastrow = (ScannedBib.query.filter(*self.set_query())
-                           .populate_existing().with_for_update()
-                           .order_by(ScannedBib.order.desc()).first())
-                if lastrow:
-                    order = lastrow.order + 1
-                else:
-                    order = 1
-                    
                 # write to database
                 bibno = msg['bibno']
                 # remove leading 0's if not 0000 ('0000' is "blank" bibno BLANK_BIBNO)
@@ -412,16 +830,22 @@ class PostBibApi(MethodView):
                 if self.is_duplicate_bib(msg, bibno):
                     current_app.logger.info(f'ignoring duplicate bib scan: {bibno}')
                     db.session.commit()
-                    unlock(filelock)
+                    unlock(thelock)
                     return jsonify(status='success')
 
+                # determine order, after duplicate check so there's no gap
                 scannedbib = self.new_scannedbib()
                 scannedbib.bibno = bibno
-                scannedbib.order = order
+                scannedbib.order = nextorder(**self.get_source_ids())
                 
                 db.session.add(scannedbib)
                 db.session.flush()
                 
+                # assign to the earliest result waiting for a scanned bib, if any
+                result = reconcile_queue(**self.get_source_ids())
+                if result:
+                    publishchange('update', result_ids=[result.id], **self.get_source_ids())
+                
             # how did this happen?
             else:
                 current_app.logger.error(f'unknown opcode received: {opcode}')
@@ -431,18 +855,20 @@ class PostBibApi(MethodView):
                 
 
             ## UNLOCK file access and return
-            current_app.logger.debug(f'{self.__class__.__name__}: unlock(filelock)')
-            unlock(filelock)
+            current_app.logger.debug(f'{self.__class__.__name__}: unlock({thelock})')
+            unlock(thelock)
             return jsonify(status='success')
 
         except Exception as e:
-            ## UNLOCK file access
-            # current_app.logger.debug(f'{self.__class__.__name__}: unlock(filelock) [exception]')
-            unlock(filelock)
+            ## UNLOCK file access, if the exception wasn't from getting it
+            # current_app.logger.debug(f'{self.__class__.__name__}: unlock({thelock}) [exception]')
+            if thelock and thelock.held():
+                unlock(thelock)
             
-            # report exception
+            # report exception, client retries unless the message itself is bad
             exc = ''.join(format_exception_only(type(e), e))
-            output_result = {'status' : 'fail', 'error': 'exception occurred:<br>{}'.format(exc)}
+            output_result = {'status' : 'fail', 'error': 'exception occurred:<br>{}'.format(exc),
+                             'invalid': isinstance(e, INVALID_MESSAGE_ERRORS)}
             
             # roll back database updates and close transaction
             db.session.rollback()
@@ -478,10 +904,25 @@ class ScanActionApi(MethodView):
         """
         raise NotImplementedError
     
+    def get_lock(self, resultid):
+        """must be overridden to
+        return the lock for the result's race or simulation run
+        
+        Args:
+            resultid (int): id of result
+            
+        Returns:
+            ResultsLock, see fileformat.resultslock()
+
+        Raises:
+            NotImplementedError: if not implemented by inheriting class
+        """
+        raise NotImplementedError
     
     """update scan queue based on user action
     """
     def post(self):
+        thelock = None
         try:
             # options from home.scanned_bibno()
             options = request.form
@@ -489,9 +930,13 @@ class ScanActionApi(MethodView):
             resultid = options['resultid']
             scanid = options['scanid']
             current_app.logger.debug(f'_scanaction: action={action} resultid={resultid} scanid={scanid}')
+
+            # end the transaction used to find the lock, so the reads under the lock see the latest data
+            thelock = self.get_lock(resultid)
+            db.session.commit()
             
             # LOCK file access / place change / etc
-            lock(filelock)
+            lock(thelock)
             
             # get the relevant records
             thisresult = Result.query.filter_by(id=resultid).one_or_none()
@@ -511,6 +956,7 @@ class ScanActionApi(MethodView):
                 # save source and place for insert, delete
                 thissource = self.get_source(thisresult)
                 thisplace = thisresult.place
+                sourceids = {'race_id': thisresult.race_id, 'simulationrun_id': thisresult.simulationrun_id}
 
                 # TODO: is there any way to log this action so it can be imported into a simulation, i.e., without scan or result id?
 
@@ -523,83 +969,53 @@ class ScanActionApi(MethodView):
                     # insert blank scanned bibno before current result
                     # shift scanned bibnos to later results
                     case 'insert':
-                        # need strictly greater than thisplace to get the later results
-                        later_results = (Result.query.filter_by(**self.get_source_dict(thissource)).filter(Result.place > thisplace)
-                                         .populate_existing().with_for_update()
-                                         .order_by(Result.place).all())
-                        
-                        # bump this and later scanned bib order
-                        thisorder = thisscannedbib.order
-                        later_scannedbibs = (ScannedBib.query.filter_by(**self.get_source_dict(thissource)).filter(ScannedBib.order >= thisorder)
-                                             .populate_existing().with_for_update()
-                                             .all())
-                        for scannedbib in later_scannedbibs:
-                            scannedbib.order += 1
+                        # move the scanned bibs for this and later results to the next result
+                        db.session.flush()
+                        shift_scannedbibs(thisplace, 'later', **sourceids)
                         
-                        # get all scanned bibs assigned to these results, including this one
-                        scannedbibs_d = [thisscannedbib] + [r.scannedbib for r in later_results if r.had_scannedbib]
-                        scannedbibs = iter(scannedbibs_d)
-                        
-                        # move all the scanned bibs to the later results; stop when we run out of scanned bibs
-                        try:
-                            for r in later_results:
-                                r.scannedbib = next(scannedbibs)
-                                r.had_scannedbib = True
-                                
-                        # stop when there are some results for which scanned bibs have not been assigned
-                        except StopIteration:
-                            pass
-                        
-                        # insert blank scanned bib at this result
+                        # insert blank scanned bib at this result, before this result's scanned bib
                         scannedbib = ScannedBib(
                             bibno=BLANK_BIBNO,
-                            order=thisorder,
+                            order=order_before(thisscannedbib, **sourceids),
                             **self.get_source_dict(thissource),
                         )
-                        thisresult.scannedbib = scannedbib
+                        db.session.add(scannedbib)
+                        db.session.flush()
+                        db.session.execute(
+                            update(Result)
+                            .where(Result.id == thisresult.id)
+                            .values(scannedbib_id=scannedbib.id, had_scannedbib=True)
+                            .execution_options(synchronize_session=False)
+                        )
+                        db.session.expire_all()
                         
-                    
                     # delete scanned bibno from current result
                     # shift scanned bibnos to earlier results
                     case 'delete':
-                        # need greater than or equals to get this and all later results
-                        results_d = (Result.query.filter_by(**self.get_source_dict(thissource)).filter(Result.place >= thisplace).order_by(Result.place)
-                                     .populate_existing().with_for_update()
-                                     .all())
-                        results = iter(results_d)
-                        
-                        # get all scanned bibs assigned to these results, after this result
-                        scannedbibs_d = [r.scannedbib for r in results_d[1:] if r.had_scannedbib]
-                        scannedbibs = iter(scannedbibs_d)
+                        # move the scanned bibs for the later results to the previous result
+                        db.session.flush()
+                        shift_scannedbibs(thisplace, 'earlier', **sourceids)
                         
-                        # move all the later scanned bibs to the results
-                        # stop when we run out of scanned bibs or results
-                        try:
-                            for r in results:
-                                r.scannedbib = next(scannedbibs)
-                                r.had_scannedbib = True # probably not necessary as we're shifting earlier
-                        
-                        # we ran out of scanned bibs
-                        except StopIteration:
-                            # it should be ok to update only this r.scannedbib as we are only removing
-                            # one scanned bib from the queue
-                            r.scannedbib = None
-                            r.had_scannedbib = False
-                                        
-                        # delete the scanned bib from the table
+                        # delete the scanned bib from the table; the gap in order is ok
+                        # the loaded results are stale, so don't let the session update them for the delete
                         if thisscannedbib:
-                            # update the order for the remaining scanned bibs
-                            thisorder = thisscannedbib.order
-                            scannedbibs_d = (ScannedBib.query.filter_by(**self.get_source_dict(thissource)).filter(ScannedBib.order > thisorder).order_by(ScannedBib.order)
-                                             .populate_existing().with_for_update()
-                                             .all())
-                            for sb in scannedbibs_d:
-                                sb.order = thisorder
-                                thisorder += 1
-                                
-                            # remove this scanned bib from the database
-                            db.session.delete(thisscannedbib)
                             current_app.logger.debug(f'deleted scannedbib id {thisscannedbib.id} bibno {thisscannedbib.bibno}')
+                            db.session.execute(
+                                delete(ScannedBib)
+                                .where(ScannedBib.id == thisscannedbib.id)
+                                .execution_options(synchronize_session=False)
+                            )
+                        db.session.expire_all()
+                        
+                        # the result which lost its scanned bib may take a queued scanned bib
+                        reconcile_queue(**sourceids)
+                
+                # insert and delete move scanned bibs between many results
+                if action in ['insert', 'delete']:
+                    publishchange('refresh', **sourceids)
+                else:
+                    publishchange('update', race_id=thisresult.race_id, simulationrun_id=thisresult.simulationrun_id,
+                                  result_ids=[thisresult.id])
                     
                 # commit to db before unlocking
                 db.session.commit()
@@ -608,14 +1024,15 @@ class ScanActionApi(MethodView):
                 output_result = {'status' : 'success', 'error': error}
                 
             # UNLOCK file access
-            unlock(filelock)
+            unlock(thelock)
             
             # return appropriate response
             return jsonify(output_result)
 
         except Exception as e:
-            # UNLOCK file access
-            unlock(filelock)
+            # UNLOCK file access, if the exception wasn't from getting it
+            if thelock and thelock.held():
+                unlock(thelock)
 
             # report exception
             exc = ''.join(format_exception_only(type(e), e))
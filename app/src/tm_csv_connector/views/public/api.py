@@ -11,19 +11,25 @@ from uuid import uuid4
 from csv import DictReader
 from datetime import datetime, timezone
 from json import dumps, loads
+from zlib import decompressobj, MAX_WBITS, error as ZlibError
 
 # pypi
 from flask import session, request, current_app, jsonify
 from flask.views import MethodView
-from sqlalchemy import and_, select as sqlselect
+from sqlalchemy import and_, insert, select as sqlselect
 from loutilities.timeu import timesecs
 
 # homegrown
 from . import bp
 from ...model import db, Result, Setting, ScannedBib, Race, ChipBib, AppLog, BluetoothDevice, ResultsSnapshot
-from ..common import PostBibApi, PostResultApi, ScanActionApi, BLANK_BIBNO
-from ...fileformat import filelock, refreshfile, lock, unlock, clearfile
-from ...trident import trident2db
+from ...model import ResultTombstone
+from ..common import PostBibApi, PostResultApi, ScanActionApi, BLANK_BIBNO, accept_clientmessage, INVALID_MESSAGE_ERRORS
+from ...fileformat import resultslock, refreshfile, lock, unlock, clearfile
+from ...sequence import resetsequence
+from ...resultstream import publishchange
+from ...trident import trident2db_batch, reset_chipbib_cache
+from ...chipimport import startimport, getprogress
+from ...jobs import jobfunction, submitjob, getjob, canceljob
 
 class ParameterError(Exception): pass
 
@@ -54,6 +60,15 @@ class NormalPostResultApi(PostResultApi):
         result.race_id = msg['raceid']
         return result
 
+    def get_source_ids(self):
+        """return the message's race
+
+        Returns:
+            {'race_id': id}
+        """
+        msg = request.json
+        return {'race_id': msg['raceid']}
+
 postresult_api = NormalPostResultApi.as_view('_postresult')
 bp.add_url_rule('/_postresult', view_func=postresult_api, methods=['POST',])
 
@@ -82,6 +97,15 @@ class NormalPostBibApi(PostBibApi):
         scannedbib.race_id = msg['raceid']
         return scannedbib
 
+    def get_source_ids(self):
+        """return the message's race
+
+        Returns:
+            {'race_id': id}
+        """
+        msg = request.json
+        return {'race_id': msg['raceid']}
+
     def is_duplicate_bib(self, msg, bibno):
         """returns true if the bibno was just scanned, and the race is in progress"""
         if bibno == BLANK_BIBNO:
@@ -151,16 +175,11 @@ class ChipReadsApi(MethodView):
                 if not raceid:
                     return jsonify(status='fail', error='please choose a race')
             
+                # import is done in the background, in chunks; the browser polls ChipImportStatusApi for progress
+                # the temporary file is deleted when the import is done
                 filepath = join('/tmp', request.form['data[keyless][file]'])
-                with open(filepath, 'r') as stream:
-                    # read to end of file
-                    for line in stream:
-                        trident2db(raceid, line, 'file')
-                    
-                # delete temporary file, commit changes to database and declare success
-                db.session.commit()
-                remove(filepath)
-                return jsonify(status='success')
+                chipimport, job = startimport(int(raceid), filepath)
+                return jsonify(status='success', chipimport=chipimport.id, job=job.id if job else None)
             
             else:
                 raise ParameterError('invalid action')
@@ -179,24 +198,76 @@ chipreads_api = ChipReadsApi.as_view('_chipreads')
 bp.add_url_rule('/_chipreads/rest', view_func=chipreads_api, methods=['POST','GET'])
 
 
+class ChipImportStatusApi(MethodView):
+    """progress of chip log import, for import started by ChipReadsApi
+    
+    ?id=<chipimport id>, or latest running import if not specified
+    """
+    
+    def get(self):
+        try:
+            chipimport_id = request.args.get('id', None, type=int)
+            progress = getprogress(chipimport_id)
+            db.session.commit()
+            return jsonify(status='success', chipimport=progress)
+                
+        except Exception as e:
+            # report exception
+            exc = ''.join(format_exception_only(type(e), e))
+            output_result = {'status' : 'fail', 'error': 'exception occurred:<br>{}'.format(exc)}
+            
+            # roll back database updates and close transaction
+            db.session.rollback()
+            current_app.logger.error(format_exc())
+            return jsonify(output_result)
+        
+chipimportstatus_api = ChipImportStatusApi.as_view('_chipimportstatus')
+bp.add_url_rule('/_chipimport/status', view_func=chipimportstatus_api, methods=['GET'])
+
+
 class LiveChipReadsApi(MethodView):
     """receive chip read from trident-reader-client
+    
+    batches may be gzip compressed, with Content-Encoding: gzip. Batches larger than 
+    LIVECHIPREADS_MAX_BYTES, compressed or not, are rejected as invalid
     """
     
     def post(self):
         try:
-            raceid = request.json['raceid']
-            data = request.json['data']
+            maxbytes = current_app.config.get('LIVECHIPREADS_MAX_BYTES', 1024*1024)
+            if (request.content_length or 0) > maxbytes:
+                raise ValueError(f'batch is larger than {maxbytes} bytes')
+            
+            if request.content_encoding == 'gzip':
+                # decompress no more than maxbytes, in case this isn't from the client
+                decompressor = decompressobj(16 + MAX_WBITS)
+                try:
+                    data = decompressor.decompress(request.get_data(), maxbytes)
+                except ZlibError as e:
+                    raise ValueError(f'batch is not valid gzip: {e}')
+                if decompressor.unconsumed_tail or not decompressor.eof:
+                    raise ValueError(f'batch is truncated or larger than {maxbytes} bytes uncompressed')
+                msg = loads(data)
+            else:
+                msg = request.json
+            
+            # already applied, client didn't get the response
+            if not accept_clientmessage(msg):
+                db.session.commit()
+                return jsonify(status='success', duplicate=True)
+            
+            raceid = msg['raceid']
+            data = msg['data']
             lines = data.split('\r\n')
-            for line in lines:
-                trident2db(raceid, line, 'live')
+            counts = trident2db_batch(raceid, lines, 'live')
             db.session.commit()
-            return jsonify(status='success')
+            return jsonify(status='success', **counts)
                 
         except Exception as e:
-            # report exception
+            # report exception, client retries unless the message itself is bad
             exc = ''.join(format_exception_only(type(e), e))
-            output_result = {'status' : 'fail', 'error': 'exception occurred:<br>{}'.format(exc)}
+            output_result = {'status' : 'fail', 'error': 'exception occurred:<br>{}'.format(exc),
+                             'invalid': isinstance(e, INVALID_MESSAGE_ERRORS)}
             
             # roll back database updates and close transaction
             db.session.rollback()
@@ -211,14 +282,26 @@ class ClearResultsApi(MethodView):
     """delete all Results and ScannedBibs for a race; saves a snapshot for undo"""
 
     def post(self):
+        thelock = None
         try:
             raceid = request.json['raceid']
 
-            lock(filelock)
+            thelock = resultslock(race_id=raceid)
+            lock(thelock)
 
             # serialize current data into a snapshot before deleting
-            results = Result.query.filter_by(race_id=raceid).order_by(Result.place).all()
-            scannedbibs = ScannedBib.query.filter_by(race_id=raceid).order_by(ScannedBib.order).all()
+            # only the columns are needed, not the objects
+            results = db.session.execute(
+                sqlselect(Result.tmpos, Result.place, Result.bibno, Result.time, Result.is_confirmed,
+                          Result.had_scannedbib, Result.scannedbib_id)
+                .where(Result.race_id == raceid)
+                .order_by(Result.place)
+            ).all()
+            scannedbibs = db.session.execute(
+                sqlselect(ScannedBib.id, ScannedBib.order, ScannedBib.bibno)
+                .where(ScannedBib.race_id == raceid)
+                .order_by(ScannedBib.order)
+            ).all()
 
             results_data = [
                 {
@@ -251,19 +334,30 @@ class ClearResultsApi(MethodView):
                 race.next_scannedbib_id = None
                 db.session.flush()
 
+            # let polling clients know these rows are gone
+            db.session.execute(
+                insert(ResultTombstone)
+                .from_select(['result_id', 'race_id'],
+                             sqlselect(Result.id, Result.race_id).where(Result.race_id == raceid))
+            )
+
             # Results hold the FK to ScannedBib, so delete them first
             Result.query.filter_by(race_id=raceid).delete(synchronize_session=False)
             db.session.flush()
             ScannedBib.query.filter_by(race_id=raceid).delete(synchronize_session=False)
+            resetsequence(race_id=raceid)
+            publishchange('refresh', race_id=raceid)
             db.session.commit()
 
             clearfile()
+            db.session.commit()
 
-            unlock(filelock)
+            unlock(thelock)
             return jsonify(status='success')
 
         except Exception as e:
-            unlock(filelock)
+            if thelock and thelock.held():
+                unlock(thelock)
             exc = ''.join(format_exception_only(type(e), e))
             output_result = {'status': 'fail', 'error': 'exception occurred:<br>{}'.format(exc)}
             db.session.rollback()
@@ -278,14 +372,16 @@ class UndoClearResultsApi(MethodView):
     """restore Results and ScannedBibs from the snapshot saved by ClearResultsApi"""
 
     def post(self):
+        thelock = None
         try:
             raceid = request.json['raceid']
 
-            lock(filelock)
+            thelock = resultslock(race_id=raceid)
+            lock(thelock)
 
             snapshot = ResultsSnapshot.query.filter_by(race_id=raceid).one_or_none()
             if not snapshot:
-                unlock(filelock)
+                unlock(thelock)
                 return jsonify(status='fail', error='no snapshot to restore')
 
             scannedbibs_data = loads(snapshot.scannedbibs_json)
@@ -314,17 +410,21 @@ class UndoClearResultsApi(MethodView):
                 db.session.add(r)
 
             db.session.delete(snapshot)
+            resetsequence(race_id=raceid)
+            publishchange('refresh', race_id=raceid)
             db.session.commit()
 
             # rewrite CSV with the restored confirmed rows
             rows = Result.query.filter_by(race_id=raceid).order_by(Result.place).all()
             refreshfile(rows)
+            db.session.commit()
 
-            unlock(filelock)
+            unlock(thelock)
             return jsonify(status='success')
 
         except Exception as e:
-            unlock(filelock)
+            if thelock and thelock.held():
+                unlock(thelock)
             exc = ''.join(format_exception_only(type(e), e))
             output_result = {'status': 'fail', 'error': 'exception occurred:<br>{}'.format(exc)}
             db.session.rollback()
@@ -335,6 +435,63 @@ undoclearresults_api = UndoClearResultsApi.as_view('_undoclearresults')
 bp.add_url_rule('/_undoclearresults', view_func=undoclearresults_api, methods=['POST'])
 
 
+@jobfunction('chip2bib')
+def chip2bib_job(job, race_id, filepath):
+    """import chip to bibno mapping from csv file, see Chip2BibApi
+
+    Args:
+        job (JobContext): job context
+        race_id (int): race id
+        filepath (str): uploaded csv file
+
+    Returns:
+        dict: {'rows': number of rows imported}
+    """
+    try:
+        rows = 0
+        with open(filepath, 'r') as csvfile:
+            csv = DictReader(csvfile)
+            # read to end of file
+            for row in csv:
+                chip = row['chip']
+                bib  = row['bib']
+                chipbib = db.session.execute(
+                    sqlselect(ChipBib)
+                        .where(and_(
+                            ChipBib.race_id == race_id,
+                            ChipBib.tag_id == chip,
+                            )
+                        )
+                ).one_or_none()
+            
+                if not chipbib:
+                    chipbib = ChipBib(
+                        race_id = race_id,
+                        tag_id = chip,
+                        bib    = bib,
+                    )
+                    db.session.add(chipbib)
+                    db.session.flush()
+                
+                # this could happen a) if file reloaded, or b) if a new
+                # set of chips is used with overlapping chip numbers
+                else:
+                    chipbib = chipbib[0]
+                    chipbib.bib = bib
+            
+                rows += 1
+                if rows % 1000 == 0:
+                    job.checkcancel()
+        
+        # commit changes to database
+        db.session.commit()
+        reset_chipbib_cache(race_id)
+        return {'rows': rows}
+    
+    # delete temporary file, even if the import failed or was cancelled
+    finally:
+        remove(filepath)
+
 class Chip2BibApi(MethodView):
     """import chip to bibno mapping from csv file
 
@@ -389,41 +546,10 @@ class Chip2BibApi(MethodView):
                 if not race_id:
                     return jsonify(status='fail', error='please choose a race')
                 
+                # import is done in the background, the browser polls the job for completion
                 filepath = join('/tmp', request.form['data[keyless][file]'])
-                with open(filepath, 'r') as csvfile:
-                    csv = DictReader(csvfile)
-                    # read to end of file
-                    for row in csv:
-                        chip = row['chip']
-                        bib  = row['bib']
-                        chipbib = db.session.execute(
-                            sqlselect(ChipBib)
-                                .where(and_(
-                                    ChipBib.race_id == race_id,
-                                    ChipBib.tag_id == chip,
-                                    )
-                                )
-                        ).one_or_none()
-                        
-                        if not chipbib:
-                            chipbib = ChipBib(
-                                race_id = race_id,
-                                tag_id = chip,
-                                bib    = bib,
-                            )
-                            db.session.add(chipbib)
-                            db.session.flush()
-                            
-                        # this could happen a) if file reloaded, or b) if a new
-                        # set of chips is used with overlapping chip numbers
-                        else:
-                            chipbib = chipbib[0]
-                            chipbib.bib = bib
-                    
-                # delete temporary file, commit changes to database and declare success
-                db.session.commit()
-                remove(filepath)
-                return jsonify(status='success')
+                job = submitjob('chip2bib', race_id=int(race_id), filepath=filepath)
+                return jsonify(status='success', job=job.id)
             
             else:
                 raise ParameterError('invalid action')
@@ -442,8 +568,59 @@ chip2bib_api = Chip2BibApi.as_view('_chip2bib')
 bp.add_url_rule('/_chip2bib/rest', view_func=chip2bib_api, methods=['POST','GET'])
 
 
+class JobApi(MethodView):
+    """status of a background job, see jobs.py
+    """
+    
+    def get(self, job_id):
+        try:
+            job = getjob(job_id)
+            db.session.commit()
+            if not job:
+                return jsonify(status='fail', error=f'job {job_id} not found')
+            return jsonify(status='success', job=job)
+                
+        except Exception as e:
+            # report exception
+            exc = ''.join(format_exception_only(type(e), e))
+            output_result = {'status' : 'fail', 'error': 'exception occurred:<br>{}'.format(exc)}
+            
+            # roll back database updates and close transaction
+            db.session.rollback()
+            current_app.logger.error(format_exc())
+            return jsonify(output_result)
+        
+job_api = JobApi.as_view('_job')
+bp.add_url_rule('/_jobs/<int:job_id>', view_func=job_api, methods=['GET'])
+
+
+class CancelJobApi(MethodView):
+    """cancel a background job, see jobs.py
+    """
+    
+    def post(self, job_id):
+        try:
+            if not canceljob(job_id):
+                return jsonify(status='fail', error=f'job {job_id} is not queued or running')
+            return jsonify(status='success')
+                
+        except Exception as e:
+            # report exception
+            exc = ''.join(format_exception_only(type(e), e))
+            output_result = {'status' : 'fail', 'error': 'exception occurred:<br>{}'.format(exc)}
+            
+            # roll back database updates and close transaction
+            db.session.rollback()
+            current_app.logger.error(format_exc())
+            return jsonify(output_result)
+        
+canceljob_api = CancelJobApi.as_view('_canceljob')
+bp.add_url_rule('/_jobs/<int:job_id>/cancel', view_func=canceljob_api, methods=['POST'])
+
+
 class SetParamsApi(MethodView):
     def post(self):
+        thelock = None
         try:
             form = request.form
 
@@ -456,7 +633,8 @@ class SetParamsApi(MethodView):
             # rewrite csv file if race changed
             if 'race_changed' in form:
                 # LOCK file access
-                lock(filelock)
+                thelock = resultslock(race_id=form['raceid'])
+                lock(thelock)
                 
                 results = db.session.execute(
                     sqlselect(Result)
@@ -470,11 +648,13 @@ class SetParamsApi(MethodView):
                 # not sure why there is a need to for r[0] -- is this new in sqlalchemy 2.0?
                 results = [r[0] for r in results]
                 
-                # rewrite the file
+                # rewrite the file, only the tail if the file already has this race's results
                 refreshfile(results)
+                db.session.commit()
                 
                 # UNLOCK file access
-                unlock(filelock)
+                unlock(thelock)
+                thelock = None
                 
             output_result = {'status' : 'success'}
             session.permanent = True
@@ -483,7 +663,8 @@ class SetParamsApi(MethodView):
 
         except Exception as e:
             # UNLOCK file access
-            unlock(filelock)
+            if thelock and thelock.held():
+                unlock(thelock)
 
             # report exception
             exc = ''.join(format_exception_only(type(e), e))
@@ -523,6 +704,21 @@ class NormalScanActionApi(ScanActionApi):
         """
         return {'race': source}
 
+    def get_lock(self, resultid):
+        """return the lock for the result's race
+        
+        Args:
+            resultid (int): id of result
+            
+        Returns:
+            ResultsLock
+        """
+        race_id = db.session.execute(
+            sqlselect(Result.race_id)
+            .where(Result.id == resultid)
+        ).scalar_one_or_none()
+        return resultslock(race_id=race_id)
+
 scanaction_api = NormalScanActionApi.as_view('_scanaction')
 bp.add_url_rule('/_scanaction', view_func=scanaction_api, methods=['POST',])
 
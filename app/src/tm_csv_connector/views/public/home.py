@@ -4,8 +4,6 @@ home - public views
 '''
 # standard
 from datetime import timedelta
-from csv import DictWriter
-from os.path import join
 
 # pypi
 from flask import render_template, session, current_app, url_for, abort
@@ -13,7 +11,7 @@ from flask.views import MethodView
 from dominate.tags import div, button, span, select, option, p, i
 from dominate.tags import table, thead, tbody, tr, th, td
 from dominate.util import text
-from sqlalchemy import update, and_, select as sqlselect
+from sqlalchemy import select as sqlselect
 from loutilities.tables import DbCrudApi
 from loutilities.tables import rest_url_for
 from loutilities.timeu import asctime
@@ -21,11 +19,14 @@ from loutilities.filters import filtercontainerdiv, filterdiv, yadcfoption
 
 # homegrown
 from . import bp
-from ...model import db, Race, Result, ScannedBib, BluetoothDevice, BluetoothType
+from ...model import db, Race, Result, BluetoothDevice, BluetoothType
 from ...model import ChipRead, ChipBib, ChipReader, AppLog, Setting
 from ...times import asc2time, time2asc
 from ..common import ResultsView, get_results_posttablehtml, results_validate, results_dbmapping, results_formmapping
-from ...fileformat import filecolumns, db2file, filelock, lock, unlock
+from ..common import confirm_results
+from ...fileformat import resultslock, appendrows, lock, unlock
+from ...trident import reset_chipbib_cache
+from ...resultstream import sock, streamresults, publishchange
 
 # https://docs.python.org/3/library/datetime.html#datetime.tzinfo
 from datetime import tzinfo
@@ -197,23 +198,14 @@ class ResultsViewNormal(ResultsView, TmConnectorView):
         self.queryparams['race_id'] = race_id
         # current_app.logger.debug(f'queryparams: {self.queryparams}')
 
-    def set_queue_filters(self):
-        """sets queue filters
+    def get_lock(self):
+        """return the lock for the current race
 
         Returns:
-            boolean: True if caller should update the queued scanned results
+            ResultsLock
         """
         race_id = session['_results_raceid'] if '_results_raceid' in session else None
-        race = Race.query.filter_by(id=race_id).one_or_none()
-        if race:
-            process_queue = True
-            self.result_queue_filter = [Result.race_id == race_id]
-            self.scannedbib_queue_filter = [ScannedBib.race_id == race_id]
-
-        else:
-            process_queue = False
-            
-        return process_queue
+        return resultslock(race_id=race_id)
 
     def createrow(self, formdata):
         '''
@@ -254,47 +246,27 @@ class ResultsViewNormal(ResultsView, TmConnectorView):
 
         if 'confirm' in formdata and formdata['confirm'] == 'true':
             # LOCK file access
-            lock(filelock)
-            
-            # don't rewrite file when confirming
-            self.rewritefile = False
-
-            # set is_confirmed for all rows in this race which have place <= the selected row
-            updated = db.session.execute(
-                sqlselect(Result)
-                .where(and_(
-                    Result.race_id == self.result.race_id,
-                    Result.place <= self.result.place,
-                    Result.is_confirmed == False)
-                )
-                .order_by(Result.place)
-            ).all()
+            thelock = resultslock(race_id=self.result.race_id)
+            lock(thelock)
             
-            # not sure why there is a need to for r[0] -- is this new in sqlalchemy 2.0?
-            updated = [r[0] for r in updated]
+            try:
+                # don't rewrite file when confirming
+                self.rewritefile = False
+
+                # set is_confirmed for all rows in this race which have place <= the selected row
+                updated = confirm_results(self.result.place, race_id=self.result.race_id)
+
+                # write the updated results to file
+                appendrows(updated)
+                publishchange('update', race_id=self.result.race_id, result_ids=[r.id for r in updated])
+                
+                # UNLOCK file access
+                unlock(thelock)
             
-            db.session.execute(
-                update(Result)
-                .where(Result.id.in_([r.id for r in updated]))
-                .values(is_confirmed=True)
-            )
-            db.session.flush()
-
-            # get output file pathname and write updated results to file
-            filesetting = Setting.query.filter_by(name='output-file').one_or_none()
-            if filesetting:
-                filepath = join('/output_dir', filesetting.value)
-
-                # write to the file
-                with open(filepath, mode='a') as f:
-                    for result in updated:
-                        filedata = db2file(result)
-                        current_app.logger.debug(f'appending to {filesetting.value}: {filedata["pos"],filedata["bibno"],filedata["time"]}')
-                        csvf = DictWriter(f, fieldnames=filecolumns, extrasaction='ignore')
-                        csvf.writerow(filedata)
-            
-            # UNLOCK file access
-            unlock(filelock)
+            except:
+                # UNLOCK file access
+                unlock(thelock)
+                raise
             
             thisrow = self.dte.get_response_data(self.result)
             return thisrow
@@ -376,6 +348,18 @@ results_view = ResultsViewNormal(
 )
 results_view.register()
 
+@sock.route('/results/stream', bp=bp)
+def results_stream(ws):
+    '''
+    push result changes for the current race, see resultstream.streamresults()
+    '''
+    # same as ResultsViewNormal.permission()
+    if current_app.config.get('SIMULATION_MODE', False):
+        return
+    session.permanent = True
+    race_id = session['_results_raceid'] if '_results_raceid' in session else None
+    streamresults(ws, race_id=race_id)
+
 races_dbattrs = 'id,name,date,start_time'.split(',')
 races_formfields = 'rowid,name,date,start_time'.split(',')
 races_dbmapping = dict(zip(races_dbattrs, races_formfields))
@@ -714,7 +698,9 @@ def chip2bib_set_yadcf_data():
     return yadcf_data
 
 class ChipBibView(TmConnectorView):
-    pass
+    def editor_method_postcommit(self, form):
+        # chip read processing caches the chip to bib mapping
+        reset_chipbib_cache()
 
 chip2bib_view = ChipBibView(
     app=bp,  # use blueprint instead of app
@@ -1,12 +1,12 @@
 # standard
 from sys import stdout
-from asyncio import run, Future, Protocol, sleep, get_event_loop, new_event_loop, set_event_loop
+from asyncio import run, Future, Protocol, Queue, sleep, get_event_loop, new_event_loop, set_event_loop, create_task, to_thread
 from threading import Thread
+from time import time as walltime
 from json import loads, dumps
 from logging import basicConfig, getLogger, INFO, DEBUG, StreamHandler, Formatter, LoggerAdapter
 from logging.handlers import TimedRotatingFileHandler
-from requests import post
-from requests import codes
+from requests import Session
 from re import split as resplit
 
 # pypi
@@ -14,6 +14,9 @@ from websockets import connect, ConnectionClosed
 from websockets.server import serve
 from serial_asyncio import create_serial_connection
 
+# homegrown
+from outbox import Outbox, InvalidMessage
+
 class ReaderClosed(Exception): pass
 
 basicConfig(
@@ -36,14 +39,25 @@ getLogger('websockets.server').setLevel(INFO)
 backenduri = 'ws://tm.localhost:8080/barcode_scanner'
 backendpost = 'http://tm.localhost:8080/_postbib'
 
+# seconds to wait for the backend to respond
+BACKEND_TIMEOUT = 10
+
+# pause reading from the serial port when this many messages are waiting to be saved to the outbox,
+# resume when below LOW_WATER
+HIGH_WATER = 1000
+LOW_WATER = 100
+
+# seconds between checks for the reader being stopped
+STOP_POLL = 0.3
+
 # connection status is global -- is there any way to get a class status from an async protocol?
 connected = False
 
 # stop_reader flag
 stop_reader = False
 
-# queue messages from input protocol for sending to backend
-queued_msgs = []
+# keep-alive connections to the backend are reused across messages
+session = Session()
 
 # save latest raceid
 raceid = 0
@@ -72,6 +86,9 @@ class InputChunkProtocol(Protocol):
     def __init__(self):
         super().__init__()
         self.log_handler = None
+        # [(msg, received), ...] for saver()
+        self.queue = Queue()
+        self.paused = False
         global connected
         connected = False
     
@@ -94,6 +111,7 @@ class InputChunkProtocol(Protocol):
         return super().connection_lost(exc)
 
     def data_received(self, data):
+        received = walltime()
         data = data.decode()
         log.debug(f'barcode scanner data received: {data}')
         
@@ -118,49 +136,90 @@ class InputChunkProtocol(Protocol):
             
             try:
                 log.debug(f'barcode scanner msg processed: {msg}')
-                # each msg is a bib number
-                queued_msgs.append({'opcode':'scannedbib', 'raceid': raceid, 'bibno': msg})
+                # each msg is a bib number, queue for saver()
+                self.queue.put_nowait(({'opcode':'scannedbib', 'raceid': raceid, 'bibno': msg}, received))
 
             except ValueError:
                 log.error(f'could not decode message: {msg}')
         
-        # stop callbacks again immediately
-        self.pause_reading()
+        # flow control, if saver() is falling behind
+        if not self.paused and self.queue.qsize() > HIGH_WATER:
+            log.warning(f'{self.queue.qsize()} messages waiting, pausing reading')
+            self.pause_reading()
 
     def pause_reading(self):
         # This will stop the callbacks to data_received
+        self.paused = True
         self.transport.pause_reading()
 
     def resume_reading(self):
         # This will start the callbacks to data_received again with all data that has been received in the meantime.
+        self.paused = False
         self.transport.resume_reading()
     
     def set_logging_path(self, logging_path):
         self.logging_path = logging_path
         log.error(f'need to set logging path in logger')
         
-def send_to_backend(data):
-    """send data to backend
+def send_to_backend(client, seq, data):
+    """send data to backend, called by outbox
 
     Args:
+        client (str): outbox client id
+        seq (int): message sequence number within outbox
         data (dict): dict to serialize and send
+
+    Returns:
+        bool: True if backend accepted the message, False if it failed to apply it
+    
+    Raises:
+        InvalidMessage: if the backend says the message can never be applied
+        RequestException: if the backend couldn't be reached
     """
     log.debug(f'sending to backend: {data}')
-    rsp = post(backendpost, json=data)
-    if rsp.status_code != codes.ok:
-        log.error(f'error sending to backend: status = {rsp.status_code}')
-    else:
-        respdata = loads(rsp.text)
-        if respdata['status'] != 'success':
-            log.error(f'error sending to backend: response = {respdata["error"]}')
+    rsp = session.post(backendpost, json={**data, 'client': client, 'seq': seq}, timeout=BACKEND_TIMEOUT)
+    rsp.raise_for_status()
+    respdata = loads(rsp.text)
+    if respdata['status'] != 'success':
+        if respdata.get('invalid', False):
+            raise InvalidMessage(respdata['error'])
+        log.error(f'error sending to backend: response = {respdata["error"]}')
+        return False
+    return True
+
+# messages are saved until the backend has them
+outbox = Outbox('barcode-scanner', send_to_backend)
+
+async def saver(protocol):
+    """save messages from the protocol to the outbox as soon as they arrive
+    
+    the outbox fsyncs, so this is done in a worker thread to keep reading
+
+    Args:
+        protocol (InputChunkProtocol): protocol with queue of messages
+    """
+    while True:
+        msg, received = await protocol.queue.get()
+        try:
+            await to_thread(outbox.put, msg, received)
+        except Exception as e:
+            log.error(f'error saving to outbox: {e}, message: {msg}')
+        finally:
+            protocol.queue.task_done()
         
+        if protocol.paused and protocol.queue.qsize() < LOW_WATER:
+            log.info('resuming reading')
+            protocol.resume_reading()
+
 async def reader(port, logging_path):
     log.info(f'barcode scanner async reader started with port {port}')
     readloop = get_event_loop()
     transport, protocol = await create_serial_connection(readloop, InputChunkProtocol, port)
     protocol.set_logging_path(logging_path)
+    savetask = create_task(saver(protocol))
 
     try:
+        # messages are handled as they arrive, see InputChunkProtocol.data_received() and saver()
         while True:
             global stop_reader
             if stop_reader:
@@ -169,18 +228,12 @@ async def reader(port, logging_path):
                 transport.close()
                 raise ReaderClosed
             
-            await sleep(0.3)
-            
-            # send any queued messages
-            global queued_msgs
-            if queued_msgs:
-                while len(queued_msgs) > 0:
-                    msg = queued_msgs.pop(0)
-                    send_to_backend(msg)
-
-            protocol.resume_reading()
+            await sleep(STOP_POLL)
     
     except ReaderClosed:
+        # save what has been read, it's only going to local disk
+        await protocol.queue.join()
+        savetask.cancel()
         return
 
 def reader_thread(port, logging_path):
@@ -226,8 +279,13 @@ async def controller(websocket):
             await websocket.send(dumps({'connected': connected}))
 
 async def main():
-    async with serve(controller, host="localhost", port=8082):
-        await Future() # run forever
+    # send messages saved in the outbox, including any left from the last run
+    drainer = create_task(outbox.drain())
+    try:
+        async with serve(controller, host="localhost", port=8082):
+            await Future() # run forever
+    finally:
+        drainer.cancel()
     
 if __name__ == "__main__":
     try:
@@ -0,0 +1,292 @@
+"""durable outbox for messages to the backend
+
+Messages are appended to the outbox file and fsync'd before they are sent, so nothing is lost if
+the backend is slow or down, or the client is restarted. drain() sends the messages in order,
+retrying with backoff, and records the last sequence number the backend acknowledged. The backend
+ignores a message it has already accepted, keyed by (client, seq), so a message which is resent
+because its acknowledgement was lost is only applied once.
+
+A message is retried until the backend accepts it, unless the backend marks it as invalid, i.e.,
+it can never be applied. Then it is written to the dead letter file and skipped, so it doesn't
+hold up the messages behind it.
+
+outbox file is json lines
+    {"client": "<client id>", "seq": <last seq before the first message>}
+    {"seq": <seq>, "time": <time received from device>, "msg": {...}}
+    ...
+
+acknowledgement file has the outbox's client id and the last seq the backend acknowledged
+    {"client": "<client id>", "seq": <seq>}
+it is ignored if its client id isn't the outbox's, e.g., the outbox file was lost, so messages in a new 
+outbox aren't skipped
+
+dead letter file is json lines
+    {"client": "<client id>", "seq": <seq>, "time": <time received from device>, "msg": {...}, "error": "<error>"}
+
+the latency from when a message was received from the device until the backend acknowledged it
+is logged periodically as a histogram
+
+NOTE: the same file is used by tm-reader-client, barcode-scanner-client and trident-reader-client,
+as each is built separately
+"""
+
+# standard
+from asyncio import Event, sleep, to_thread, get_running_loop
+from threading import Lock
+from time import time
+from bisect import bisect_left
+from json import loads, dumps
+from os import fsync, replace, makedirs, getenv
+from os.path import join, exists
+from logging import getLogger
+from uuid import uuid4
+
+log = getLogger('outbox')
+
+# outbox file is rewritten when all messages have been acknowledged and it has at least this many
+COMPACT_COUNT = 1000
+# seconds between retries, doubled after each failure
+BACKOFF_MIN = 0.5
+BACKOFF_MAX = 30
+# latency histogram bucket upper bounds, ms, and seconds between latency log messages
+LATENCY_BUCKETS = [10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000]
+LATENCY_LOG_INTERVAL = 60
+
+class InvalidMessage(Exception):
+    """raised by send() if the backend says the message can never be applied"""
+
+class LatencyHistogram():
+    """histogram of latencies
+
+    Args:
+        buckets ([float, ...], optional): bucket upper bounds, ms. Defaults to LATENCY_BUCKETS.
+    """
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.reset()
+
+    def reset(self):
+        # last count is for latencies over the last bucket
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def add(self, ms):
+        self.counts[bisect_left(self.buckets, ms)] += 1
+        self.count += 1
+        self.total += ms
+        self.max = max(self.max, ms)
+
+    def __str__(self):
+        buckets = ' '.join(f'<={bound}ms:{count}' for bound, count in zip(self.buckets, self.counts))
+        return (f'n={self.count} avg={self.total / self.count if self.count else 0:.0f}ms max={self.max:.0f}ms '
+                f'{buckets} >{self.buckets[-1]}ms:{self.counts[-1]}')
+
+class Outbox():
+    """append-only outbox, drained to the backend by drain()
+
+    Args:
+        name (str): client name, used for the file names and client id
+        send (callable): send(client, seq, msg), called in a worker thread. Returns True if the backend
+            accepted the message, False if the backend failed to apply it, e.g., database unavailable; 
+            raises InvalidMessage if the backend says the message is invalid, or another exception if the 
+            backend could not be reached
+        directory (str, optional): directory for the outbox files. Defaults to OUTBOX_DIR or LOGGING_DIR
+            environment variable, or the current directory.
+    """
+    def __init__(self, name, send, directory=None):
+        self.send = send
+        directory = directory or getenv('OUTBOX_DIR') or getenv('LOGGING_DIR') or '.'
+        makedirs(directory, exist_ok=True)
+        self.path = join(directory, f'{name}-outbox.jsonl')
+        self.ackpath = join(directory, f'{name}-outbox.ack')
+        self.deadpath = join(directory, f'{name}-outbox.dead.jsonl')
+
+        # put() is called from the reader thread, drain() runs in the controller's event loop
+        self.lock = Lock()
+        self.loop = None
+        self.ready = None
+
+        # earlier versions wrote only the seq, which is taken to be for the existing outbox
+        ackclient, acked = None, 0
+        if exists(self.ackpath):
+            with open(self.ackpath) as f:
+                try:
+                    ack = loads(f.read() or '0')
+                except ValueError:
+                    log.error(f'ignoring corrupt outbox acknowledgement file {self.ackpath}')
+                    ack = 0
+            if isinstance(ack, dict):
+                ackclient, acked = ack['client'], ack['seq']
+            else:
+                acked = ack
+
+        # [(seq, msg, received), ...] in the outbox file
+        messages = []
+        self.client = None
+        self.seq = 0
+        if exists(self.path):
+            with open(self.path, 'rb') as f:
+                for line in f:
+                    try:
+                        record = loads(line)
+                    except ValueError:
+                        # partial line written when the client was stopped
+                        log.error(f'ignoring corrupt outbox line: {line}')
+                        continue
+                    self.seq = max(self.seq, record['seq'])
+                    if 'client' in record:
+                        self.client = record['client']
+                    else:
+                        messages.append((record['seq'], record['msg'], record.get('time', time())))
+
+        # new client id if the outbox is new, so the backend doesn't confuse its seq with a previous outbox's
+        if not self.client:
+            self.client = f'{name}-{uuid4().hex[:12]}'
+
+        # acknowledgement is only for this outbox
+        if (ackclient or self.client) != self.client or not exists(self.path):
+            if acked:
+                log.warning(f'outbox {self.client}: ignoring acknowledgement of seq {acked} for {ackclient or "previous outbox"}')
+            acked = 0
+        self.acked = acked
+
+        # [(seq, msg, received), ...] not acknowledged yet
+        self.pending = [m for m in messages if m[0] > self.acked]
+
+        self.latency = LatencyHistogram()
+        self.latencylogged = time()
+
+        # drop acknowledged messages, and any partial line
+        self.file = None
+        self._rewrite()
+        if self.pending:
+            log.info(f'outbox {self.client}: {len(self.pending)} messages to replay')
+
+    def _rewrite(self):
+        """rewrite the outbox file with only the pending messages"""
+        if self.file:
+            self.file.close()
+
+        tmppath = self.path + '.tmp'
+        with open(tmppath, 'wb') as f:
+            firstseq = self.pending[0][0] - 1 if self.pending else self.seq
+            f.write((dumps({'client': self.client, 'seq': firstseq}) + '\n').encode())
+            for seq, msg, received in self.pending:
+                f.write((dumps({'seq': seq, 'time': received, 'msg': msg}) + '\n').encode())
+            f.flush()
+            fsync(f.fileno())
+        replace(tmppath, self.path)
+
+        self.file = open(self.path, 'ab')
+        self.count = len(self.pending)
+
+    def put(self, msg, received=None):
+        """save a message in the outbox, to be sent by drain()
+
+        Args:
+            msg (dict): message to send
+            received (float, optional): time the message was received from the device. Defaults to now.
+        """
+        received = received or time()
+        with self.lock:
+            self.seq += 1
+            self.file.write((dumps({'seq': self.seq, 'time': received, 'msg': msg}) + '\n').encode())
+            self.file.flush()
+            fsync(self.file.fileno())
+            self.pending.append((self.seq, msg, received))
+            self.count += 1
+
+        if self.loop:
+            self.loop.call_soon_threadsafe(self.ready.set)
+
+    def ack(self, seq):
+        """message has been handled by the backend
+
+        Args:
+            seq (int): message's seq
+        """
+        with self.lock:
+            received = self.pending.pop(0)[2]
+            self.acked = seq
+            self.latency.add((time() - received) * 1000)
+
+            # if this is lost, the message is resent and the backend ignores it, so no need to fsync
+            tmppath = self.ackpath + '.tmp'
+            with open(tmppath, 'w') as f:
+                f.write(dumps({'client': self.client, 'seq': seq}))
+            replace(tmppath, self.ackpath)
+
+            if not self.pending and self.count >= COMPACT_COUNT:
+                self._rewrite()
+
+    def deadletter(self, seq, msg, received, error):
+        """save a message the backend can't apply in the dead letter file, before it's acknowledged
+
+        Args:
+            seq (int): message's seq
+            msg (dict): message
+            received (float): time the message was received from the device
+            error (str): why the backend couldn't apply the message
+        """
+        with open(self.deadpath, 'ab') as f:
+            f.write((dumps({'client': self.client, 'seq': seq, 'time': received, 'msg': msg, 'error': error}) + '\n').encode())
+            f.flush()
+            fsync(f.fileno())
+
+    async def drain(self):
+        """send messages to the backend in order, until cancelled"""
+        self.loop = get_running_loop()
+        self.ready = Event()
+        backoff = BACKOFF_MIN
+
+        while True:
+            with self.lock:
+                first = self.pending[0] if self.pending else None
+
+            # wait for put(), which sets ready after appending to pending
+            if not first:
+                self.ready.clear()
+                with self.lock:
+                    empty = not self.pending
+                if empty:
+                    await self.ready.wait()
+                continue
+
+            seq, msg, received = first
+            try:
+                accepted = await to_thread(self.send, self.client, seq, msg)
+
+            # backend can never apply this message, save it for later investigation and go on to the next
+            except InvalidMessage as e:
+                log.error(f'outbox {self.client}: backend says seq {seq} is invalid, saved to {self.deadpath}: {e}')
+                await to_thread(self.deadletter, seq, msg, received, str(e))
+                self.ack(seq)
+                backoff = BACKOFF_MIN
+                continue
+
+            # backend can't be reached, keep trying
+            except Exception as e:
+                log.error(f'outbox {self.client}: error sending seq {seq}, {len(self.pending)} pending, retry in {backoff}s: {e}')
+                await sleep(backoff)
+                backoff = min(backoff * 2, BACKOFF_MAX)
+                continue
+
+            # backend failed to apply the message, e.g., database unavailable or lock timeout, keep trying
+            if not accepted:
+                log.error(f'outbox {self.client}: backend failed to apply seq {seq}, {len(self.pending)} pending, retry in {backoff}s')
+                await sleep(backoff)
+                backoff = min(backoff * 2, BACKOFF_MAX)
+                continue
+
+            backoff = BACKOFF_MIN
+            self.ack(seq)
+            if time() - self.latencylogged >= LATENCY_LOG_INTERVAL:
+                self.loglatency()
+
+    def loglatency(self):
+        """log latency from device to backend acknowledgement since the last time this was logged"""
+        log.info(f'outbox {self.client}: latency {self.latency}')
+        self.latency.reset()
+        self.latencylogged = time()
@@ -1,9 +1,11 @@
 # standard
-from asyncio import run, Future, get_event_loop, new_event_loop, set_event_loop, sleep, wait_for, TimeoutError
+from asyncio import run, Future, Queue, Event, new_event_loop, set_event_loop, get_running_loop, sleep, create_task, to_thread, wait_for, TimeoutError
 from threading import Thread
+from time import time as walltime, monotonic
+from gzip import compress
 from json import loads, dumps
 from logging import basicConfig, getLogger, INFO, DEBUG, LoggerAdapter
-from requests import post
+from requests import post, Session
 from requests import codes
 from traceback import format_exception_only
 
@@ -12,6 +14,9 @@ from websockets.server import serve
 from telnetlib3 import open_connection
 from ping3 import ping
 
+# homegrown
+from outbox import Outbox, InvalidMessage
+
 class ReaderClosed(Exception): pass
 
 basicConfig(
@@ -29,18 +34,46 @@ backenduri = 'ws://tm.localhost:8080/trident_reader'
 backendpost = 'http://tm.localhost:8080/_livechipreads'
 chipstatuspost = 'http://tm.localhost:8080/_chipreaderstatus'
 
+# seconds to wait for the backend to respond
+BACKEND_TIMEOUT = 10
+
+# maximum characters per telnet read
+READ_SIZE = 65536
+# chip reads are sent in batches of at most BATCH_LINES, waiting at most BATCH_WAIT seconds for a batch to fill
+BATCH_LINES = 1000
+BATCH_WAIT = 0.2
+# messages at least this many bytes are compressed
+COMPRESS_MIN = 1024
+# seconds without data before pinging the trident reader
+HEALTH_INTERVAL = 1
+# seconds between checks for the reader being stopped
+STOP_POLL = 0.3
+
+# separates chip reads
+SEP = '\r\n'
+
 # connection status is global
 connected = False
 
 # detailed status is global, values must match api.py and results.js
 detailedstatus = 'disconnected'
 
+# controller's event loop and event for status_sender(), set when it starts
+mainloop = None
+statuschanged = None
+
+# time data was last received from the trident reader
+lastreceived = 0
+
 # stop_reader flag
 stop_reader = False
 
 # save latest raceid
 raceid = 0
 
+# keep-alive connections to the backend are reused across chip read messages
+session = Session()
+
 class LoggerAdapter(LoggerAdapter):
     """Add connection ID and client IP address to websockets logs."""
     def process(self, msg, kwargs):
@@ -54,14 +87,95 @@ class LoggerAdapter(LoggerAdapter):
             xff = '??'
         return f"{websocket.id} {xff} {msg}", kwargs
 
-def save_reads_to_db(data):
-    """save relevant chip reads to the database, uses current raceid
+def send_reads_to_backend(client, seq, msg):
+    """send chip reads to backend, called by outbox
+
+    Args:
+        client (str): outbox client id
+        seq (int): message sequence number within outbox
+        msg (dict): {'raceid': raceid, 'data': data}
+
+    Returns:
+        bool: True if backend accepted the message, False if it failed to apply it
+    
+    Raises:
+        InvalidMessage: if the backend says the message can never be applied
+        RequestException: if the backend couldn't be reached
+    """
+    body = dumps({**msg, 'client': client, 'seq': seq}).encode()
+    headers = {'Content-Type': 'application/json'}
+    size = len(body)
+    if size >= COMPRESS_MIN:
+        body = compress(body)
+        headers['Content-Encoding'] = 'gzip'
+    
+    started = monotonic()
+    rsp = session.post(backendpost, data=body, headers=headers, timeout=BACKEND_TIMEOUT)
+    rsp.raise_for_status()
+    respdata = loads(rsp.text)
+    if respdata['status'] != 'success':
+        if respdata.get('invalid', False):
+            raise InvalidMessage(respdata['error'])
+        log.error(f'error sending to backend: response = {respdata["error"]}')
+        return False
+    log.info(f'sent seq {seq}: {msg["data"].count(SEP) + 1} lines, {size} bytes ({len(body)} sent) in {(monotonic() - started) * 1000:.0f}ms, '
+             f'saved {respdata.get("saved")}, merged {respdata.get("merged")}, ignored {respdata.get("ignored")}')
+    return True
+
+# messages are saved until the backend has them
+outbox = Outbox('trident-reader', send_reads_to_backend)
+
+async def saver(queue):
+    """save chip reads to the outbox in batches, uses current raceid
+    
+    a batch is saved when it has BATCH_LINES lines, or BATCH_WAIT seconds after its first read
+    arrived, whichever comes first. The outbox fsyncs, so this is done in a worker thread to keep reading
 
     Args:
-        data (dict): dict to serialize and send
+        queue (Queue): [(data, received), ...] where data is chip reads, separated by CRLF
     """
-    log.debug(f'sending to backend: raceid {raceid}, data {data}')
-    rsp = post(backendpost, json={'raceid': raceid, 'data': data})
+    while True:
+        data, received = await queue.get()
+        lines = data.split(SEP)
+        count = 1
+        
+        # collect more reads until the batch is full or it's time to send
+        deadline = monotonic() + BATCH_WAIT
+        while len(lines) < BATCH_LINES:
+            try:
+                data, _ = await wait_for(queue.get(), timeout=max(deadline - monotonic(), 0))
+            except TimeoutError:
+                break
+            lines += data.split(SEP)
+            count += 1
+        
+        try:
+            # a single read may have had more than a batch's worth
+            for start in range(0, len(lines), BATCH_LINES):
+                batch = lines[start:start+BATCH_LINES]
+                await to_thread(outbox.put, {'raceid': raceid, 'data': SEP.join(batch)}, received)
+                log.debug(f'batch of {len(batch)} lines saved {(walltime() - received) * 1000:.0f}ms after first read')
+        except Exception as e:
+            log.error(f'error saving to outbox: {e}, lines: {lines}')
+        finally:
+            for i in range(count):
+                queue.task_done()
+
+def check_update_status(newstatus):
+    """update the detailed status, which is sent to the backend by status_sender()
+
+    Args:
+        newstatus (str): new status
+    """
+    global detailedstatus
+    
+    detailedstatus = newstatus
+    if mainloop:
+        mainloop.call_soon_threadsafe(statuschanged.set)
+
+def send_status(status):
+    # set reader_id appropriately for #82
+    rsp = post(chipstatuspost, json={'status':status, 'reader_id':'A'}, timeout=BACKEND_TIMEOUT)
     if rsp.status_code != codes.ok:
         log.error(f'error sending to backend: status = {rsp.status_code}')
     else:
@@ -69,92 +183,121 @@ def save_reads_to_db(data):
         if respdata['status'] != 'success':
             log.error(f'error sending to backend: response = {respdata["error"]}')
 
-def check_update_status(newstatus):
-    global detailedstatus
+async def status_sender():
+    """send the detailed status to the backend when it changes
     
-    laststatus = detailedstatus
-    detailedstatus = newstatus
-    if detailedstatus != laststatus:
-        # set reader_id appropriately for #82
-        rsp = post(chipstatuspost, json={'status':detailedstatus, 'reader_id':'A'})
-        if rsp.status_code != codes.ok:
-            log.error(f'error sending to backend: status = {rsp.status_code}')
-        else:
-            respdata = loads(rsp.text)
-            if respdata['status'] != 'success':
-                log.error(f'error sending to backend: response = {respdata["error"]}')
+    runs in the controller's event loop, so a slow backend doesn't hold up reading. If the status 
+    changes while one is being sent, only the latest is sent
+    """
+    global mainloop, statuschanged
+    mainloop = get_running_loop()
+    statuschanged = Event()
+    laststatus = 'disconnected'
+    
+    while True:
+        await statuschanged.wait()
+        statuschanged.clear()
+        
+        status = detailedstatus
+        if status == laststatus:
+            continue
+        try:
+            await to_thread(send_status, status)
+            laststatus = status
+        except Exception as e:
+            log.error(f'error sending status to backend: {e}')
+            await sleep(HEALTH_INTERVAL)
+            statuschanged.set()
 
-async def shell(reader, writer):
+async def health(ipaddr):
+    """check the trident reader can be reached when no data is arriving
+
+    Args:
+        ipaddr (str): trident reader's ip address
+    """
+    while True:
+        await sleep(HEALTH_INTERVAL)
+        
+        # data is arriving, so we're connected
+        if walltime() - lastreceived < HEALTH_INTERVAL:
+            continue
+        
+        pingtime = await to_thread(ping, ipaddr, timeout=1)
+        # got a response -- we are connected
+        if pingtime:
+            check_update_status('connected')
+        elif pingtime == False:
+            check_update_status('network-unreachable')
+        else: # None
+            check_update_status('no-response')
+
+async def watch_stop(reader, writer):
+    """end the shell if the reader is stopped or the connection is closed
+
+    Args:
+        reader (TelnetReader): telnet reader
+        writer (TelnetWriter): telnet writer
+    """
     global stop_reader
+    while True:
+        await sleep(STOP_POLL)
+        if stop_reader:
+            log.info('trident reader reader stopped')
+            stop_reader = False
+            reader.feed_eof()
+            return
+        if writer.connection_closed:
+            log.info('discovered connection closed; stopping trident reader')
+            reader.feed_eof()
+            return
+
+async def shell(reader, writer):
+    global connected, lastreceived
 
     log.info(f'trident telnet shell entered')
-    readloop = get_event_loop()
     # protocol.set_logging_path(logging_path)
-    SEP = '\r\n'
+    
+    # telnet connection is open, until the shell ends
+    connected = True
     
     residual = ''
-    pingtime = 0
     ipaddr = writer.transport.get_extra_info('peername')[0]
     
+    # reads are handled as they arrive; status and stop are handled in other tasks
+    queue = Queue()
+    tasks = [create_task(saver(queue)), create_task(health(ipaddr)), create_task(watch_stop(reader, writer))]
+    
     try:
         while True:
-            if stop_reader:
-                log.info('trident reader reader stopped')
-                stop_reader = False
-                raise ReaderClosed
+            # returns what is available, empty at eof
+            data = await reader.read(READ_SIZE)
+            if not data:
+                break
             
-            # read anything which came in, but don't wait too long
-            # https://stackoverflow.com/a/76405900/799921
-            try:
-                # let some messages come in for a bit, don't sleep negative for long ping response
-                await sleep(max(1-pingtime, 0))
-
-                # timeout allows this not to hang if no data, so we can get the stop_reader control
-                # make sure the buffer is big enough to handle the sleep's worth of data
-                data = await wait_for(reader.read(4096), timeout=0.1)
-                msgs = residual + data
-
-                # if we received something, we're connected
-                check_update_status('connected')
-
-                # split into messages for ease of residual processing
-                # the last bit didn't end in SEP, or is empty
-                splitmsgs = msgs.split(SEP)
-                residual = splitmsgs.pop()
-                
-                # send any received messages
-                if splitmsgs:
-                    save_reads_to_db(SEP.join(splitmsgs))
-
-            except TimeoutError:
-                pingtime = ping(ipaddr, timeout=1)
-                # got a response -- we are connected
-                if pingtime:
-                    check_update_status('connected')
-                
-                else:
-                    if pingtime == False:
-                        check_update_status('network-unreachable')
-                    else: # None
-                        check_update_status('no-response')
-                    pingtime = 1
+            # if we received something, we're connected
+            lastreceived = walltime()
+            check_update_status('connected')
+            
+            # split into messages for ease of residual processing
+            # the last bit didn't end in SEP, or is empty
+            splitmsgs = (residual + data).split(SEP)
+            residual = splitmsgs.pop()
             
-            finally:
-                # connection management
-                global connected
-                connected = not (reader.at_eof() or writer.connection_closed)
-                if not connected:
-                    log.info('discovered connection closed; stopping trident reader')
-                    stop_reader = False
-                    raise ReaderClosed
-                    
-
-    except (ReaderClosed, ConnectionAbortedError) as e:
-        reader.feed_eof()
+            # save any received messages
+            if splitmsgs:
+                queue.put_nowait((SEP.join(splitmsgs), lastreceived))
+
+    except ConnectionAbortedError:
+        pass
+
+    finally:
+        # save what has been read, it's only going to local disk
+        await queue.join()
+        for task in tasks:
+            task.cancel()
         writer.close()
         connected = False
         check_update_status('disconnected')
-        return
 
 def reader_thread(ipaddr, fport, logging_path):
     log.info(f'in reader_thread')
@@ -210,8 +353,15 @@ async def controller(websocket):
             await websocket.send(dumps({'connected': connected, 'detailedstatus': detailedstatus}))
 
 async def main():
-    async with serve(controller, host="localhost", port=8083):
-        await Future() # run forever
+    # send messages saved in the outbox, including any left from the last run
+    drainer = create_task(outbox.drain())
+    statustask = create_task(status_sender())
+    try:
+        async with serve(controller, host="localhost", port=8083):
+            await Future() # run forever
+    finally:
+        drainer.cancel()
+        statustask.cancel()
     
 if __name__ == "__main__":
     try: